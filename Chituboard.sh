@@ -199,6 +199,9 @@ fi
 
 info "Storage file formatted successfully."
 
+# Let OctoPrint update the image directly, see writeUsbImage in the README
+sudo chown "${USER}:${USER}" /piusb.bin
+
 # Create the mount point for the container file
 sudo mkdir -p /home/"${USER}"/.octoprint/uploads/resin
 
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the numpy layer cipher against the former byte-by-byte keyring.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_cipher [size_in_bytes [repeats]]
+
+A random layer of the given size (default 1 MB) is decrypted with both
+implementations, for the CTB and the FDG key schedule. The results are
+checked to be identical.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from octoprint_chituboard.file_formats.cipher import cipher86, cipherFDG
+
+
+def legacy_cipher86(seed: int, slicenum: int, data: bytes) -> bytes:
+	"""Byte by byte keyring as it was before the numpy rewrite."""
+	initial = seed*0x2d83cdac + 0xd8a83423
+	key = (slicenum*0x1e1530cd + 0xec3d47cd) * initial
+	out = bytearray()
+	index = 0
+	for i in data:
+		k = key >> (8 * index)
+		index += 1
+		if index & 3 == 0:
+			key = key + initial
+			index = 0
+		out.extend([i ^ k.to_bytes((k.bit_length() + 7) // 8, "little")[0]])
+	return bytes(out)
+
+
+def legacy_cipherFDG(seed: int, slicenum: int, data: bytes) -> bytes:
+	"""Byte by byte keyring as it was before the numpy rewrite."""
+	initial = seed - 0x1dcb76c3 ^ 0x257e2431
+	key = initial*0x82391efd * (slicenum ^ 0x110bdacd)
+	out = bytearray()
+	index = 0
+	for i in data:
+		k = key >> (8 * index)
+		index += 1
+		if index & 3 == 0:
+			key = key + initial
+			index = 0
+		out.extend([i ^ k.to_bytes((k.bit_length() + 7) // 8, "little")[0]])
+	return bytes(out)
+
+
+def _best_of(repeats, func, *args):
+	best = None
+	for _ in range(repeats):
+		start = time.perf_counter()
+		result = func(*args)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+
+def main(argv):
+	size = int(argv[1]) if len(argv) > 1 else 1 << 20
+	repeats = int(argv[2]) if len(argv) > 2 else 5
+
+	data = np.random.default_rng(0).integers(0, 256, size, dtype=np.uint8).tobytes()
+	# seeds large enough that the legacy keyring never runs out of key bytes
+	seed, slicenum = 0x5eed1234, 42
+	for name, fast, legacy in (
+		("cipher86", cipher86, legacy_cipher86),
+		("cipherFDG", cipherFDG, legacy_cipherFDG),
+	):
+		fast_time, result = _best_of(repeats, fast, seed, slicenum, data)
+		legacy_time, expected = _best_of(1, legacy, seed, slicenum, data)
+		assert result == expected, "{} output differs".format(name)
+		print("{:<10} {} bytes: numpy {:8.4f} s, legacy {:8.3f} s, {:8.1f}x".format(
+			name, size, fast_time, legacy_time, legacy_time / fast_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of publishing a sliced file to the USB drive image with the
+FAT32 writer, instead of through a loop mount.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_fat_image image.bin [size_mb]
+
+image.bin is a FAT32 image that is not mounted, e.g. a copy of /piusb.bin
+or one made with "mkdosfs -F 32 -C image.bin 1024". A random file of
+size_mb (default 150) is added, replaced and deleted again, the listed
+size is checked after each step.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from octoprint_chituboard.fat_image import FatImage
+
+NAME = "bench_fat_image.ctb"
+
+
+def timed(label, size, action):
+	start = time.perf_counter()
+	result = action()
+	elapsed = time.perf_counter() - start
+	rate = " {:8.1f} MB/s".format(size / elapsed / 1e6) if size else ""
+	print("{:22} {:8.3f} s{}".format(label + ":", elapsed, rate))
+	return result
+
+
+def listed_size(image):
+	for entry in image.list_files():
+		if entry.name == NAME:
+			return entry.size
+	return None
+
+
+def main(argv):
+	if len(argv) < 2:
+		print(__doc__)
+		sys.exit(1)
+	size = int(float(argv[2]) * 1024 * 1024) if len(argv) > 2 else 150 * 1024 * 1024
+	image = FatImage(argv[1])
+
+	with tempfile.NamedTemporaryFile(suffix=".ctb") as source:
+		for _ in range(0, size, 1 << 20):
+			source.write(os.urandom(min(1 << 20, size - source.tell())))
+		source.flush()
+
+		timed("add", size, lambda: image.add_file(NAME, source.name))
+		assert listed_size(image) == size
+		timed("replace", size, lambda: image.add_file(NAME, source.name))
+		assert listed_size(image) == size
+		files = timed("list", 0, image.list_files)
+		print("{} files in the image".format(len(files)))
+		timed("delete", 0, lambda: image.delete_file(NAME))
+		assert listed_size(image) is None
+
+
+if __name__ == "__main__":
+	main(sys.argv)
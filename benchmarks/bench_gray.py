@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the numpy grey RLE layer decoder against the former pure
+Python pixel loop.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_gray [width height [repeats]]
+
+Without arguments a synthetic anti-aliased 2560x1440 layer is encoded and
+decoded with both implementations. The results are checked to be identical.
+"""
+
+import struct
+import sys
+from typing import List
+
+import numpy as np
+
+from octoprint_chituboard.file_formats.rle import decode_gray
+
+from .bench_rle7 import _best_of, synthetic_layer
+
+
+def legacy_read_grayarray(width: int, height: int, data: bytes):
+	"""Pure Python decoder as it was before the numpy rewrite."""
+	limit = width * height
+	array: List[List[int]] = [[]]
+	lastColor = 0xff
+	(i, x) = (0, 0)
+	n = 0
+	while n < len(data):
+		code = struct.unpack_from("<B", data, n)[0]
+		n += 1
+		if (code & 0x80) == 0x80:
+			lastColor = ((code & 0x7f) << 1) | (code & 1)
+			if lastColor >= 0xfc:
+				lastColor = 0xff
+			if i < limit:
+				array[-1] += [lastColor]
+				x += 1
+				if x == width:
+					x = 0
+					array.append([])
+			i += 1
+		else:
+			index = 0
+			while index < int(code):
+				if i < limit:
+					array[-1] += [lastColor]
+					x += 1
+					if x == width:
+						x = 0
+						array.append([])
+				i += 1
+				index += 1
+
+	array.pop()
+	return array
+
+
+def encode_gray(image: np.ndarray) -> bytes:
+	"""
+	Minimal grey RLE encoder for 7-bit images, used to build test layers.
+	Each run is one colour byte followed by repeat bytes.
+	"""
+	flat = image.ravel()
+	starts = np.flatnonzero(np.diff(flat, prepend=-1))
+	lengths = np.diff(np.append(starts, len(flat)))
+	out = bytearray()
+	for value, length in zip(flat[starts].tolist(), lengths.tolist()):
+		out.append(0x80 | value)
+		length -= 1
+		while length > 0:
+			run = min(length, 0x7f)
+			out.append(run)
+			length -= run
+	return bytes(out)
+
+
+def main(argv):
+	width = int(argv[1]) if len(argv) > 1 else 2560
+	height = int(argv[2]) if len(argv) > 2 else 1440
+	repeats = int(argv[3]) if len(argv) > 3 else 3
+
+	data = encode_gray(synthetic_layer(width, height))
+	print("layer {}x{}, {} encoded bytes".format(width, height, len(data)))
+
+	numpy_time, image = _best_of(repeats, decode_gray, width, height, data)
+	print("decode_gray (numpy):   {:8.3f} s".format(numpy_time))
+
+	legacy_time, legacy = _best_of(1, legacy_read_grayarray, width, height, data)
+	print("legacy python loop:    {:8.3f} s".format(legacy_time))
+
+	assert np.array_equal(image, np.array(legacy, dtype=np.uint8)), "decoders disagree"
+	print("speedup:               {:8.1f}x".format(legacy_time / numpy_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the header-only read_header against the full read of the
+file format readers, as used for file lists.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_read_header folder [count]
+
+Scans count (default 500) entries of the sliced files in folder, cycling
+through them if the folder holds fewer, once with read_header and once
+with read. The fields both return are checked to be identical.
+"""
+
+import itertools
+import os
+import pathlib
+import sys
+import time
+
+from octoprint_chituboard.file_formats.utils import UnsupportedFileFormat, get_file_format
+
+# fields of SlicedModelHeader that read returns as well
+SHARED_FIELDS = (
+	"filename",
+	"bed_size_mm",
+	"height_mm",
+	"layer_height_mm",
+	"layer_count",
+	"resolution",
+	"print_time_secs",
+	"volume",
+	"slicer_version",
+	"printer_name",
+)
+
+
+def sliced_files(folder: str):
+	"""(path, reader) of the supported files in folder."""
+	files = []
+	for name in sorted(os.listdir(folder)):
+		path = os.path.join(folder, name)
+		if not os.path.isfile(path):
+			continue
+		try:
+			files.append((pathlib.Path(path), get_file_format(path)))
+		except UnsupportedFileFormat:
+			continue
+	return files
+
+
+def scan(files, count: int, read):
+	start = time.perf_counter()
+	results = [read(file_format, path) for path, file_format in itertools.islice(itertools.cycle(files), count)]
+	return time.perf_counter() - start, results
+
+
+def main(argv):
+	if len(argv) < 2:
+		print(__doc__)
+		sys.exit(1)
+	count = int(argv[2]) if len(argv) > 2 else 500
+
+	files = sliced_files(argv[1])
+	if not files:
+		print("no sliced files in {}".format(argv[1]))
+		sys.exit(1)
+	print("{} sliced files, scanning {}".format(len(files), count))
+
+	header_time, headers = scan(files, count, lambda file_format, path: file_format.read_header(path))
+	print("read_header:           {:8.3f} s".format(header_time))
+
+	read_time, models = scan(files, count, lambda file_format, path: file_format.read(path))
+	print("read:                  {:8.3f} s".format(read_time))
+
+	for header, model in zip(headers, models):
+		for field in SHARED_FIELDS:
+			assert getattr(header, field) == getattr(model, field), "{} differs for {}".format(field, header.filename)
+	print("speedup:               {:8.1f}x".format(read_time / header_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the serial receive hook, replaying a serial log through the
+former chain of rewrites and through the prefix dispatcher.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_receive_hook [serial.log [repeats]]
+
+serial.log is an OctoPrint serial log, only its "Recv:" lines are replayed.
+Without one a short recorded session of a Chitu board (connect, M4000 and
+M27 polling while printing, end of print) is used. The rewritten lines of
+both hooks are checked to be identical, apart from banners with version
+and identifier on one line, which the former chain rewrote with the
+previous version. Those are checked on their own.
+"""
+
+import sys
+import time
+
+from octoprint.events import Events
+
+from octoprint_chituboard import LINE_BANNER, Chituboard, classify_line
+
+# normally registered by OctoPrint's plugin manager from register_custom_events
+if not hasattr(Events, "PLUGIN_CHITUBOARD_LAYER_CHANGE"):
+	Events.PLUGIN_CHITUBOARD_LAYER_CHANGE = "plugin_chituboard_layer_change"
+
+RECORDED_SESSION = [
+	"ok V4.13.3_LCDC",
+	"ok CBD make it.Date:Mar 20 2020 Time:14:28:59",
+	"ok",
+	"ok C: X:0.000000 Y:0.000000 Z:155.000000 E:0.000000",
+	"ok",
+	"ok B:0/0 X:0.000 Y:0.000 Z:155.000 F:256/256 D:0/0/0 T:0",
+	"wait",
+	"wait",
+	"ok N:0",
+	"ok B:24/30 X:0.000 Y:0.000 Z:0.050 F:256/256 D:35814/2405219/0 T:0",
+	"SD printing byte 35814/2405219",
+	"ok",
+	"ok B:24/30 X:0.000 Y:0.000 Z:0.100 F:256/256 D:72345/2405219/0 T:0",
+	"SD printing byte 72345/2405219",
+	"ok",
+	"ok B:24/30 X:0.000 Y:0.000 Z:0.150 F:256/256 D:108233/2405219/0 T:0",
+	"SD printing byte 108233/2405219",
+	"ok",
+	"ok",
+	"ok",
+	"SD printing byte 2405219/2405219",
+	"ok",
+	"SD printing byte 2405219/2405219",
+	"Error:It's not printing now!",
+	"ok",
+]
+
+# M4002 reply of firmwares that send version and identifier together
+COMBINED_BANNER = "ok V4.13.3_LCDC CBD make it.Date:Mar 20 2020 Time:14:28:59"
+
+
+class _Comm():
+	STATE_OPERATIONAL = "operational"
+	STATE_PAUSED = "paused"
+
+	def _changeState(self, state):
+		pass
+
+
+class _Printer():
+	"""Just enough of Sla_printer for the rewrites to run."""
+
+	def __init__(self):
+		self._comm = _Comm()
+
+	def is_pausing(self):
+		return False
+
+	def is_printing(self):
+		return False
+
+	def is_finishing(self):
+		return False
+
+	def unselect_file(self):
+		pass
+
+	def log_lines(self, *lines):
+		pass
+
+
+def legacy_receive_modifier(plugin, comm_instance, line, *args, **kwargs):
+	"""The receive hook as it was before the prefix dispatch."""
+	line = plugin._rewrite_wait_to_busy(line)
+	line = plugin._rewrite_identifier(line)
+	line, end_msg = plugin._rewrite_print_finished(line)
+	line = plugin._rewrite_start(line)
+	line = plugin._rewrite_m4000_response(line)
+	line = plugin._rewrite_m114_response(line)
+	line = plugin._rewrite_error(line)
+	if end_msg == True:
+		try:
+			plugin._printer._comm._changeState(plugin._printer._comm.STATE_OPERATIONAL)
+			plugin._printer._comm._currentFile = None
+		except Exception:
+			plugin._logger.exception("Error while changing state")
+	return line
+
+
+def read_serial_log(path):
+	lines = []
+	with open(path, encoding="utf-8", errors="replace") as file:
+		for entry in file:
+			_, sep, line = entry.partition(" - Recv: ")
+			if sep:
+				lines.append(line.rstrip("\r\n"))
+	return lines
+
+
+def _plugin():
+	plugin = Chituboard()
+	plugin._printer = _Printer()
+	plugin._logger.disabled = True
+	return plugin
+
+
+def _replay(hook, lines, repeats):
+	plugin = _plugin()
+	best = None
+	for _ in range(repeats):
+		plugin.finished_print = None
+		start = time.perf_counter()
+		result = [hook(plugin, None, line) for line in lines]
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+
+def check_banner():
+	plugin = _plugin()
+	line = Chituboard.get_gcode_receive_modifier(plugin, None, COMBINED_BANNER)
+	assert line.startswith("ok start"), "combined banner not taken as start: {!r}".format(line)
+	assert "FIRMWARE_NAME:CBD made it PROTOCOL_VERSION:V4.13.3_LCDC " in line, \
+		"combined banner identifier not rewritten: {!r}".format(line)
+	assert plugin.firmware_version == "V4.13.3_LCDC"
+
+
+def main(argv):
+	lines = read_serial_log(argv[1]) if len(argv) > 1 else RECORDED_SESSION * 400
+	repeats = int(argv[2]) if len(argv) > 2 else 5
+
+	legacy_time, expected = _replay(legacy_receive_modifier, lines, repeats)
+	dispatch_time, result = _replay(Chituboard.get_gcode_receive_modifier, lines, repeats)
+	differ = [
+		line for line, rewritten, legacy in zip(lines, result, expected)
+		if rewritten != legacy and classify_line(line) != LINE_BANNER
+	]
+	assert not differ, "rewritten lines differ, first: {!r}".format(differ[0])
+	check_banner()
+	print("{} lines: dispatch {:8.2f} us/line, legacy {:8.2f} us/line, {:6.1f}x".format(
+		len(lines),
+		dispatch_time / len(lines) * 1e6,
+		legacy_time / len(lines) * 1e6,
+		legacy_time / dispatch_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the numpy RGB15 preview decoder against the former pure
+Python pixel loop.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_rgb15 [width height [repeats]]
+
+Without arguments a synthetic preview at the size of the CTB high
+resolution preview (400x300) is encoded and decoded with both
+implementations. The legacy decoder returned 5 bit components, they are
+scaled to 8 bit before the results are checked to be identical.
+"""
+
+import struct
+import sys
+from typing import List
+
+import numpy as np
+
+from octoprint_chituboard.file_formats.rle import REPEAT_RGB15_MASK, decode_rgb15
+
+from .bench_rle7 import _best_of, synthetic_layer
+
+
+def legacy_read_image(width: int, height: int, data: bytes):
+	"""Pure Python decoder as it was before the numpy rewrite, without the PNG step."""
+	array: List[List[int]] = [[]]
+
+	(i, x) = (0, 0)
+	while i < len(data):
+		color16 = int(struct.unpack_from("<H", data, i)[0])
+		i += 2
+		repeat = 1
+		if color16 & REPEAT_RGB15_MASK:
+			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
+			i += 2
+
+		(r, g, b) = (
+			(color16 >> 0) & 0x1F,
+			(color16 >> 6) & 0x1F,
+			(color16 >> 11) & 0x1F,
+		)
+
+		while repeat > 0:
+			array[-1] += [r, g, b]
+			repeat -= 1
+
+			x += 1
+			if x == width:
+				x = 0
+				array.append([])
+
+	array.pop()
+	return array
+
+
+def synthetic_preview(width: int, height: int) -> np.ndarray:
+	"""A ``height x width x 3`` array of 5 bit components."""
+	grey = synthetic_layer(width, height) >> 3
+	return np.stack([grey, grey >> 1, 0x1F - grey], axis=-1)
+
+
+def encode_rgb15(image: np.ndarray) -> bytes:
+	"""
+	Minimal RGB15 encoder for images of 5 bit components, used to build
+	test previews. Repeated colours become runs of at most 0x1000 pixels.
+	"""
+	pixels = image.reshape(-1, 3).astype(np.uint16)
+	words = pixels[:, 0] | pixels[:, 1] << 6 | pixels[:, 2] << 11
+	starts = np.flatnonzero(np.diff(words, prepend=-1))
+	lengths = np.diff(np.append(starts, len(words)))
+	out = bytearray()
+	for color, length in zip(words[starts].tolist(), lengths.tolist()):
+		while length > 0:
+			run = min(length, 0x1000)
+			if run == 1:
+				out += struct.pack("<H", color)
+			else:
+				out += struct.pack("<HH", color | REPEAT_RGB15_MASK, run - 1)
+			length -= run
+	return bytes(out)
+
+
+def main(argv):
+	width = int(argv[1]) if len(argv) > 1 else 400
+	height = int(argv[2]) if len(argv) > 2 else 300
+	repeats = int(argv[3]) if len(argv) > 3 else 5
+
+	data = encode_rgb15(synthetic_preview(width, height))
+	print("preview {}x{}, {} encoded bytes".format(width, height, len(data)))
+
+	numpy_time, image = _best_of(repeats, decode_rgb15, width, height, data)
+	print("decode_rgb15 (numpy):  {:8.4f} s".format(numpy_time))
+
+	legacy_time, legacy = _best_of(1, legacy_read_image, width, height, data)
+	print("legacy python loop:    {:8.4f} s".format(legacy_time))
+
+	legacy = np.array(legacy, dtype=np.uint8).reshape(height, width, 3)
+	assert np.array_equal(image, (legacy << 3) | (legacy >> 2)), "decoders disagree"
+	print("speedup:               {:8.1f}x".format(legacy_time / numpy_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
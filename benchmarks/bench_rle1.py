@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the numpy RLE1 layer decoder against the former pure Python
+pixel loop.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_rle1 [width height [repeats]]
+
+Without arguments a synthetic 2560x1440 layer, the Photon resolution, is
+encoded and decoded with both implementations, and once more into a
+bit-packed array. The results are checked to be identical.
+"""
+
+import struct
+import sys
+from typing import List
+
+import numpy as np
+
+from octoprint_chituboard.file_formats.rle import decode_rle1
+
+from .bench_rle7 import _best_of, synthetic_layer
+
+
+def legacy_read_rle1array(width: int, height: int, data: bytes):
+	"""Pure Python decoder as it was before the numpy rewrite."""
+	array: List[List[int]] = [[]]
+
+	(i, x) = (0, 0)
+	while i < len(data) and len(array) < height+1:
+		grey = struct.unpack_from("<B", data, i)[0]
+		i += 1
+		nr = grey & ~(1 << 7)  # turn highest bit of
+		L = grey >> 7  # only read 1st bit
+		repeat = 1
+		if grey & ~(1 << 7):
+			repeat = nr
+	
+		while repeat > 0:
+			array[-1] += [L]
+			repeat -= 1
+	
+			x += 1
+			if x == width:
+				x = 0
+				array.append([])
+	
+	array.pop()
+	return array
+
+
+def encode_rle1(image: np.ndarray) -> bytes:
+	"""Minimal RLE1 encoder for 1-bit images, used to build test layers."""
+	flat = image.ravel()
+	starts = np.flatnonzero(np.diff(flat, prepend=-1))
+	lengths = np.diff(np.append(starts, len(flat)))
+	out = bytearray()
+	for value, length in zip(flat[starts].tolist(), lengths.tolist()):
+		while length > 0:
+			run = min(length, 0x7f)
+			out.append(value << 7 | run)
+			length -= run
+	return bytes(out)
+
+
+def main(argv):
+	width = int(argv[1]) if len(argv) > 1 else 2560
+	height = int(argv[2]) if len(argv) > 2 else 1440
+	repeats = int(argv[3]) if len(argv) > 3 else 3
+
+	data = encode_rle1((synthetic_layer(width, height) > 0).astype(np.uint8))
+	print("layer {}x{}, {} encoded bytes".format(width, height, len(data)))
+
+	numpy_time, image = _best_of(repeats, decode_rle1, width, height, data)
+	print("decode_rle1 (numpy):   {:8.3f} s, {} bytes".format(numpy_time, image.nbytes))
+
+	packed_time, packed = _best_of(repeats, lambda: decode_rle1(width, height, data, packed=True))
+	print("bit-packed:            {:8.3f} s, {} bytes".format(packed_time, packed.nbytes))
+
+	legacy_time, legacy = _best_of(1, legacy_read_rle1array, width, height, data)
+	print("legacy python loop:    {:8.3f} s".format(legacy_time))
+
+	assert np.array_equal(image, np.array(legacy, dtype=np.uint8)), "decoders disagree"
+	assert np.array_equal(np.unpackbits(packed, axis=1, count=width), image), "packed output differs"
+	print("speedup:               {:8.1f}x".format(legacy_time / numpy_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the numpy RLE4 layer decoder against the former pure Python
+pixel loop.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_rle4 [width height [repeats]]
+
+Without arguments a synthetic anti-aliased layer at the Photon Mono X
+resolution (3840x2400) is encoded and decoded with both implementations.
+The results are checked to be identical.
+"""
+
+import struct
+import sys
+from typing import List
+
+import numpy as np
+
+from octoprint_chituboard.file_formats.rle import decode_rle4
+
+from .bench_rle7 import _best_of, synthetic_layer
+
+ANTIALIAS = 0xff
+
+
+def legacy_read_rle4array(width: int, height: int, antialias: int, data: bytes):
+	"""Pure Python decoder as it was before the numpy rewrite."""
+	array: List[List[int]] = [[]]
+
+	(i, x) = (0, 0)
+	while i < len(data):
+		grey = struct.unpack_from("<B", data, i)[0]
+		color = 0
+		nr = grey & 0xf  # turn highest bit of
+		L = grey >> 4  # only read 1st bit
+		repeat = 1
+		if L == 0x0:
+			color = 0x00
+			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
+			i += 1
+		elif L == 0xf:
+			color = 0xff - 1
+			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
+			i += 1
+		else:
+			color = L << 4 | L
+			color &= antialias
+		i+=1
+
+		while repeat > 0:
+			array[-1] += [color]
+			repeat -= 1
+
+			x += 1
+			if x == width:
+				x = 0
+				array.append([])
+
+	array.pop()
+	return array
+
+
+def encode_rle4(image: np.ndarray) -> bytes:
+	"""
+	Minimal RLE4 encoder for 4-bit images, used to build test layers.
+	Black and white become runs of at most 0xfff pixels, grey levels
+	single pixel tokens.
+	"""
+	flat = image.ravel()
+	starts = np.flatnonzero(np.diff(flat, prepend=-1))
+	lengths = np.diff(np.append(starts, len(flat)))
+	out = bytearray()
+	for value, length in zip(flat[starts].tolist(), lengths.tolist()):
+		if value in (0x0, 0xf):
+			while length > 0:
+				run = min(length, 0xfff)
+				out += struct.pack(">H", value << 12 | run)
+				length -= run
+		else:
+			out += bytes([value << 4]) * length
+	return bytes(out)
+
+
+def main(argv):
+	width = int(argv[1]) if len(argv) > 1 else 3840
+	height = int(argv[2]) if len(argv) > 2 else 2400
+	repeats = int(argv[3]) if len(argv) > 3 else 3
+
+	data = encode_rle4(synthetic_layer(width, height) >> 3)
+	print("layer {}x{}, {} encoded bytes".format(width, height, len(data)))
+
+	numpy_time, image = _best_of(repeats, decode_rle4, width, height, ANTIALIAS, data)
+	print("decode_rle4 (numpy):   {:8.3f} s".format(numpy_time))
+
+	legacy_time, legacy = _best_of(1, legacy_read_rle4array, width, height, ANTIALIAS, data)
+	print("legacy python loop:    {:8.3f} s".format(legacy_time))
+
+	assert np.array_equal(image, np.array(legacy, dtype=np.uint8)), "decoders disagree"
+	print("speedup:               {:8.1f}x".format(legacy_time / numpy_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
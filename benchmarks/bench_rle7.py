@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the numpy RLE7 layer decoder against the former pure Python
+pixel loop.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_rle7 [width height [repeats]]
+
+Without arguments a synthetic anti-aliased 3840x2400 layer is encoded and
+decoded with both implementations. The results are checked to be identical.
+"""
+
+import struct
+import sys
+import time
+from typing import List
+
+import numpy as np
+
+from octoprint_chituboard.file_formats.rle import decode_rle7
+
+
+def legacy_read_rle7array(width: int, height: int, data: bytes):
+	"""Pure Python decoder as it was before the numpy rewrite."""
+	array: List[List[int]] = [[]]
+
+	(i, x) = (0, 0)
+	while i < len(data):
+		grey = struct.unpack_from("<B", data, i)[0]
+		code = grey
+		repeat = 1
+		if (grey & 0x80) == 0x80:
+			code = code & 0x7f
+			i += 1
+			rlen = struct.unpack_from("<B", data, i)[0]
+			if (rlen & 0x80) == 0:
+				repeat = rlen
+			elif (rlen & 0xC0) == 0x80:
+				repeat2 = struct.unpack_from("<B", data, i+1)[0]
+				repeat = (rlen & 0x3f) << 8 | repeat2
+				i += 1
+			elif (rlen & 0xE0) == 0xC0:
+				repeat2 = struct.unpack_from("<B", data, i+1)[0]
+				repeat3 = struct.unpack_from("<B", data, i+2)[0]
+				repeat = ((rlen & 0x1F) << 8 | repeat2) << 8 | repeat3
+				i += 2
+			elif (rlen & 0xF0) == 0xE0:
+				repeat2 = struct.unpack_from("<B", data, i+1)[0]
+				repeat3 = struct.unpack_from("<B", data, i+2)[0]
+				repeat4 = struct.unpack_from("<B", data, i+3)[0]
+				repeat = (((rlen & 0xf) << 8 | repeat2) << 8 | repeat3) << 8 | repeat4
+				i += 3
+			else:
+				return array
+
+		if code != 0:
+			code = (code << 1) | 1
+
+		while repeat > 0:
+			array[-1] += [code]
+			repeat -= 1
+
+			x += 1
+			if x == width:
+				x = 0
+				array.append([])
+		i += 1
+
+	array.pop()
+	return array
+
+
+def encode_rle7(image: np.ndarray) -> bytes:
+	"""Minimal RLE7 encoder for 7-bit images, used to build test layers."""
+	flat = image.ravel()
+	starts = np.flatnonzero(np.diff(flat, prepend=-1))
+	lengths = np.diff(np.append(starts, len(flat)))
+	out = bytearray()
+	for value, length in zip(flat[starts].tolist(), lengths.tolist()):
+		if length == 1:
+			out.append(value)
+			continue
+		out.append(0x80 | value)
+		if length <= 0x7f:
+			out.append(length)
+		elif length <= 0x3fff:
+			out += struct.pack(">H", 0x8000 | length)
+		elif length <= 0x1fffff:
+			out += struct.pack(">I", 0xC0000000 | length << 8)[:3]
+		else:
+			out += struct.pack(">I", 0xE0000000 | length)
+	return bytes(out)
+
+
+def synthetic_layer(width: int, height: int) -> np.ndarray:
+	"""A few anti-aliased discs, similar to a typical resin print layer."""
+	rng = np.random.default_rng(0)
+	yy, xx = np.mgrid[0:height, 0:width]
+	image = np.zeros((height, width), dtype=np.uint8)
+	for _ in range(8):
+		cx, cy = rng.integers(0, width), rng.integers(0, height)
+		radius = rng.integers(min(width, height) // 20, min(width, height) // 5)
+		distance = np.hypot(xx - cx, yy - cy)
+		image = np.maximum(image, np.clip((radius - distance) * 32, 0, 127).astype(np.uint8))
+	return image
+
+
+def _best_of(repeats, func, *args):
+	best = None
+	for _ in range(repeats):
+		start = time.perf_counter()
+		result = func(*args)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+
+def main(argv):
+	width = int(argv[1]) if len(argv) > 1 else 3840
+	height = int(argv[2]) if len(argv) > 2 else 2400
+	repeats = int(argv[3]) if len(argv) > 3 else 3
+
+	data = encode_rle7(synthetic_layer(width, height))
+	print("layer {}x{}, {} encoded bytes".format(width, height, len(data)))
+
+	numpy_time, image = _best_of(repeats, decode_rle7, width, height, data)
+	print("decode_rle7 (numpy):   {:8.3f} s".format(numpy_time))
+
+	legacy_time, legacy = _best_of(1, legacy_read_rle7array, width, height, data)
+	print("legacy python loop:    {:8.3f} s".format(legacy_time))
+
+	assert np.array_equal(image, np.array(legacy, dtype=np.uint8)), "decoders disagree"
+	print("speedup:               {:8.1f}x".format(legacy_time / numpy_time))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
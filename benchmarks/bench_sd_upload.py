@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the SD card upload over the serial port against a fake Chitu
+board on a pseudo terminal, stop-and-wait against the pipelined window.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_sd_upload [size_kb] [baudrate] [error_rate]
+
+Uploads size_kb (default 256) random kilobytes with windows of 1, 2 and 4
+chunks. The fake board takes as long for every packet as the given
+baudrate (default 115200) needs to carry it plus 2ms to write it to the SD
+card, and every reply takes another 16ms to arrive. It answers error_rate
+(default 0.01) of the packets with a resend and drops as many replies.
+The received file is checked to be identical.
+"""
+
+import os
+import pty
+import queue
+import random
+import sys
+import threading
+import time
+import tty
+
+import serial
+
+from octoprint_chituboard.chitu_comm import END_OF_PACKET, TRAILER, ReceivedRanges, checksum
+from octoprint_chituboard.sla_transfer import MAX_CHUNK_SIZE, ChituUploader
+
+SD_WRITE_SECS = 0.002
+# round trip of a reply, USB serial adapters hold back data for up to 16ms
+ROUND_TRIP_SECS = 0.016
+
+
+class FakeChituBoard(threading.Thread):
+	"""
+	Receives M28/M29 uploads on the master side of a pseudo terminal.
+	Packets are found in the byte stream by their trailer, whose offset has
+	to continue the previous packet or go back to data already received.
+	"""
+
+	def __init__(self, fd, baudrate, error_rate, seed=0):
+		super().__init__(name="fake_chitu_board")
+		self.daemon = True
+		self._fd = fd
+		self._byte_secs = 10.0 / baudrate
+		self._error_rate = error_rate
+		self._random = random.Random(seed)
+		self._buffer = bytearray()
+		self.data = bytearray()
+		self.received = None
+		self.done = threading.Event()
+		self._replies = queue.Queue()
+		threading.Thread(target=self._send_replies, name="fake_chitu_replies", daemon=True).start()
+
+	def run(self):
+		try:
+			while not self.done.is_set():
+				chunk = os.read(self._fd, 65536)
+				if not chunk:
+					return
+				self._buffer += chunk
+				while self._handle():
+					pass
+		except OSError:
+			return
+
+	def _reply(self, text):
+		self._replies.put((time.monotonic() + ROUND_TRIP_SECS, text))
+
+	def _send_replies(self):
+		while True:
+			due, text = self._replies.get()
+			time.sleep(max(due - time.monotonic(), 0))
+			try:
+				os.write(self._fd, (text + "\n").encode("latin-1"))
+			except OSError:
+				return
+
+	def _handle(self):
+		if self.received is None or self._buffer.startswith(b"M29\n"):
+			end = self._buffer.find(b"\n")
+			if end < 0:
+				return False
+			line = bytes(self._buffer[:end]).decode("latin-1").strip()
+			del self._buffer[:end + 1]
+			self._command(line)
+			return True
+		return self._packet()
+
+	def _command(self, line):
+		if line.startswith("M28"):
+			self.received = ReceivedRanges()
+			self._stream_next = 0
+			self._reply("ok")
+		elif line.startswith("M29"):
+			if self.received is None:
+				# like the board, no upload to end is fine
+				self._reply("ok")
+				return
+			missing = self.received.first_missing()
+			if missing != self.received.end:
+				self._reply("resend {}".format(missing))
+				return
+			self.received = None
+			self._reply("ok")
+			self.done.set()
+
+	def _packet(self):
+		for end in range(TRAILER.size, min(len(self._buffer), MAX_CHUNK_SIZE + TRAILER.size) + 1):
+			if self._buffer[end - 1] != END_OF_PACKET:
+				continue
+			size = end - TRAILER.size
+			offset, packet_checksum, _ = TRAILER.unpack_from(self._buffer, size)
+			if offset != self._stream_next and offset > self.received.first_missing():
+				continue
+			if checksum(bytes(self._buffer[:size + 4])) != packet_checksum:
+				continue
+			data = bytes(self._buffer[:size])
+			del self._buffer[:end]
+			self._stream_next = offset + size
+			time.sleep(end * self._byte_secs + SD_WRITE_SECS)
+			self._receive(offset, data)
+			return True
+		return False
+
+	def _receive(self, offset, data):
+		roll = self._random.random()
+		if roll < self._error_rate:
+			# corrupted on the wire
+			self._reply("resend {}".format(self.received.first_missing()))
+			return
+		if len(self.data) < offset + len(data):
+			self.data.extend(bytes(offset + len(data) - len(self.data)))
+		self.data[offset:offset + len(data)] = data
+		self.received.add(offset, offset + len(data))
+		missing = self.received.first_missing()
+		if missing != offset + len(data):
+			self._reply("resend {}".format(missing))
+		elif roll < 2 * self._error_rate:
+			# reply lost on the wire
+			return
+		else:
+			self._reply("ok")
+
+
+def upload(path, size, window, baudrate, error_rate):
+	master, slave = pty.openpty()
+	tty.setraw(slave)
+	board = FakeChituBoard(master, baudrate, error_rate)
+	board.start()
+	try:
+		with serial.Serial(os.ttyname(slave), baudrate, timeout=1.0) as port:
+			uploader = ChituUploader(port, window=window, ack_timeout=1.0)
+			start = time.perf_counter()
+			uploader.upload(path, "bench.ctb")
+			elapsed = time.perf_counter() - start
+	finally:
+		os.close(slave)
+		os.close(master)
+	return elapsed, uploader, bytes(board.data[:size])
+
+
+def main(argv):
+	size = int(argv[1]) * 1024 if len(argv) > 1 else 256 * 1024
+	baudrate = int(argv[2]) if len(argv) > 2 else 115200
+	error_rate = float(argv[3]) if len(argv) > 3 else 0.01
+
+	data = random.Random(1).randbytes(size) if hasattr(random.Random, "randbytes") else os.urandom(size)
+	path = "/tmp/bench_sd_upload.bin"
+	with open(path, "wb") as file:
+		file.write(data)
+	print("{} KB at {} baud, {:.1%} resends and lost replies".format(size // 1024, baudrate, error_rate))
+
+	try:
+		for window in (1, 2, 4):
+			elapsed, uploader, received = upload(path, size, window, baudrate, error_rate)
+			assert received == data, "received file differs for window {}".format(window)
+			print("window {}: {:8.2f} s {:8.1f} KB/s, chunk {:5d} B, {} resends, {} timeouts".format(
+				window, elapsed, size / 1024 / elapsed, uploader.chunk_size, uploader.resends, uploader.timeouts))
+	finally:
+		os.remove(path)
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# coding=utf-8
+"""
+Benchmark of the serial receive path during a print, against the
+simulated Chitu board instead of a printer.
+
+Usage (from the repository root, inside OctoPrint's virtualenv):
+
+	python -m benchmarks.bench_virtual_board sliced_file [speed]
+
+Prints sliced_file on the virtual board at speed (default 1000) times the
+real print time, polling M4000 and M27 like OctoPrint does as fast as the
+board answers. Every reply goes through the plugin's receive hook, every
+reported file position is looked up in the layer table and estimated by
+the print time estimator. The layers are checked to only go forward and
+end at the file's last one.
+"""
+
+import os
+import pathlib
+import re
+import sys
+import tempfile
+import time
+
+import octoprint.settings
+
+from octoprint_chituboard import Chituboard
+from octoprint_chituboard.file_formats.utils import get_file_format
+from octoprint_chituboard.sla_estimator import LayerTimes, SLAPrintTimeEstimator
+from octoprint_chituboard.virtual_chitu import VirtualChituBoard
+
+from .bench_receive_hook import _plugin
+
+REGEX_SD_PRINTING_BYTE = re.compile(r"SD printing byte (?P<current>\d+)/(?P<total>\d+)")
+
+
+def main(argv):
+	if len(argv) < 2:
+		print(__doc__)
+		sys.exit(1)
+	path = os.path.abspath(argv[1])
+	speed = float(argv[2]) if len(argv) > 2 else 1000.0
+
+	# the estimator reads its thresholds from OctoPrint's settings
+	octoprint.settings.settings(init=True, basedir=tempfile.mkdtemp())
+
+	model = get_file_format(path).read(pathlib.Path(path))
+	layer_times = LayerTimes(model.layer_table)
+	print("{}: {} layers, {:.0f} s print time, simulated {:.1f} s".format(
+		model.filename, len(model.layer_table), layer_times.total, layer_times.total / speed))
+
+	board = VirtualChituBoard(os.path.dirname(path), speed=speed, read_timeout=1.0)
+	plugin = _plugin()
+	position = [None]
+	estimator = SLAPrintTimeEstimator("local", layer_times, lambda: position[0])
+
+	board.write("M6030 ':{}' I1\n".format(os.path.basename(path)).encode("latin-1"))
+	board.readline()
+
+	lines = estimates = 0
+	hook_time = track_time = 0.0
+	layers = []
+	printing = True
+	start = time.perf_counter()
+	while printing:
+		for command in (b"M4000\n", b"M27\n"):
+			board.write(command)
+			while True:
+				line = board.readline().decode("latin-1").strip()
+				hook_start = time.perf_counter()
+				line = Chituboard.get_gcode_receive_modifier(plugin, None, line)
+				hook_time += time.perf_counter() - hook_start
+				lines += 1
+				if line == "Not SD printing":
+					printing = False
+				match = REGEX_SD_PRINTING_BYTE.search(line)
+				if match:
+					track_start = time.perf_counter()
+					position[0] = model.locate_layer(int(match.group("current")))
+					print_time = (time.perf_counter() - start) * speed
+					estimator.estimate(
+						int(match.group("current")) / int(match.group("total")), print_time, print_time, None, None)
+					track_time += time.perf_counter() - track_start
+					estimates += 1
+					if not layers or layers[-1] != position[0][0]:
+						layers.append(position[0][0])
+				if line.startswith("ok") or line == "Not SD printing":
+					break
+	elapsed = time.perf_counter() - start
+
+	assert layers == sorted(layers), "layers went backwards"
+	assert layers[-1] == len(model.layer_table), "print ended at layer {}".format(layers[-1])
+	print("{} lines in {:.2f} s, {:8.0f} lines/s, {} of {} layers seen".format(
+		lines, elapsed, lines / elapsed, len(layers), len(model.layer_table)))
+	print("receive hook:          {:8.2f} us/line".format(hook_time / lines * 1e6))
+	print("layer and estimate:    {:8.2f} us/report".format(track_time / max(estimates, 1) * 1e6))
+
+
+if __name__ == "__main__":
+	main(sys.argv)
@@ -4,10 +4,19 @@
 import os, sys
 import logging
 import re
+import subprocess
+import threading
+import time
 import flask
 
+# the format modules and numpy, png and typedstruct are loaded on first
+# use, on_after_startup logs how long loading the plugin itself took
+_load_start = time.perf_counter()
+
 from .sla_analyser import sla_AnalysisQueue
 from .sla_printer import Sla_printer, gcode_modifier
+from .sla_cache import init_model_cache, init_preview_cache, preview_cache
+from .sla_layers import DEFAULT_MAX_WIDTH, IMAGE_FORMATS, init_layer_image_cache, layer_image_cache, webp_supported
 
 import octoprint.plugin
 import octoprint.util
@@ -18,6 +27,8 @@ import octoprint.filemanager
 import octoprint.filemanager.util
 from octoprint.util import dict_merge
 from octoprint.filemanager import ContentTypeMapping
+from octoprint.filemanager.destinations import FileDestinations
+from octoprint.access.permissions import Permissions
 from octoprint.printer.estimation import PrintTimeEstimator
 from octoprint.events import eventManager, Events
 
@@ -29,8 +40,45 @@ REGEX_XYZE0 = re.compile(r"(?P<axis>[XYZE])(?=[XYZE]|\s|$)")
 parse_m4000 = re.compile('B:(\d+)\/(\d+)')
 regex_sdPrintingByte = re.compile(r"(?P<current>[0-9]+)/(?P<total>[0-9]+)")
 
+# kinds of printer responses the receive hook rewrites
+LINE_WAIT = "wait"
+LINE_IDENTIFIER = "identifier"
+LINE_SD_STATUS = "sd_status"
+LINE_START = "start"
+LINE_BANNER = "banner"
+LINE_M4000 = "m4000"
+LINE_M114 = "m114"
+LINE_NOT_PRINTING = "not_printing"
+
+def classify_line(line):
+	"""
+	Cheap prefix and substring checks to find the one rewrite a received
+	line needs, in the order the rewrites used to be chained. Returns None
+	for lines that are passed through unchanged, like a plain "ok".
+	"""
+	if line == "ok" or not line:
+		# by far the most frequent response
+		return None
+	if line.startswith("wait"):
+		return LINE_WAIT
+	if "CBD make it" in line or "ZWLF make it" in line:
+		# some firmwares answer M4002 with version and identifier on one line
+		return LINE_BANNER if line.startswith("ok V") else LINE_IDENTIFIER
+	if "SD printing byte" in line:
+		return LINE_SD_STATUS
+	if line.startswith("ok V"):
+		return LINE_START
+	if "B:" in line or "D:" in line or "b:" in line or "d:" in line:
+		return LINE_M4000
+	if "C: X:" in line:
+		return LINE_M114
+	if "not printing now" in line:
+		return LINE_NOT_PRINTING
+	return None
+
 class Chituboard(   octoprint.plugin.SettingsPlugin,
 					octoprint.plugin.SimpleApiPlugin,
+					octoprint.plugin.BlueprintPlugin,
 					octoprint.plugin.ProgressPlugin,
 					octoprint.plugin.AssetPlugin,
 					octoprint.plugin.TemplatePlugin,
@@ -49,6 +97,9 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		self.gcode_modifier = gcode_modifier()
 		self._logged_replacement = {}
 		self._logger = logging.getLogger("octoprint.plugins.Chituboard")
+		self._chitu_comm = None
+		self._usb_image = None
+		self._usb_image_lock = threading.Lock()
 		self._initialized = True
 
 	@property
@@ -90,63 +141,153 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		return handled
 	
 	def on_api_get(self, request):
-		result = "-"
-		if self._printer._sliced_model_file and self._printer.is_printing():
-			result = "{}/{}".format(
-				self._printer.get_current_layer(),
-				self._printer._sliced_model_file.layer_count
-			)
-		return flask.jsonify(layerString = result)
+		if not self._printer.is_printing():
+			return flask.jsonify(layerString = "-", layerProgress = None)
+		return flask.jsonify(**self._layer_status())
 	
+	@octoprint.plugin.BlueprintPlugin.route("/preview/<string:origin>/<path:path>", methods=["GET"])
+	def get_preview(self, origin, path):
+		"""
+		Preview of a stored sliced file as PNG, rendered once into the
+		preview cache. The ETag changes with the file, so clients keep their
+		copy and only revalidate it.
+		"""
+		if not Permissions.FILES_DOWNLOAD.can():
+			flask.abort(403)
+		if origin != FileDestinations.LOCAL or not self._file_manager.file_exists(origin, path):
+			flask.abort(404)
+		cache = preview_cache()
+		if cache is None:
+			flask.abort(503)
+		preview = cache.get_or_render(self._file_manager.path_on_disk(origin, path))
+		if preview is None:
+			flask.abort(404)
+
+		etag, data = preview
+		response = flask.make_response(data)
+		response.mimetype = "image/png"
+		response.set_etag(etag)
+		response.cache_control.private = True
+		response.cache_control.no_cache = True
+		return response.make_conditional(flask.request)
+
+	@octoprint.plugin.BlueprintPlugin.route("/layer/<string:layer>", methods=["GET"])
+	def get_selected_layer_image(self, layer):
+		"""
+		Layer image of the selected file, layer is the 1 based layer number
+		or "current" for the layer being printed.
+		"""
+		if not Permissions.FILES_DOWNLOAD.can():
+			flask.abort(403)
+		path = getattr(self._printer, "_sliced_model_path", None)
+		if path is None:
+			flask.abort(404)
+		if layer == "current":
+			layer = self._printer.get_current_layer()
+		return self._layer_image_response(path, layer)
+
+	@octoprint.plugin.BlueprintPlugin.route("/layer/<string:layer>/<string:origin>/<path:path>", methods=["GET"])
+	def get_layer_image(self, layer, origin, path):
+		"""
+		Layer image of a stored file, layer is the 1 based layer number.
+		"""
+		if not Permissions.FILES_DOWNLOAD.can():
+			flask.abort(403)
+		if origin != FileDestinations.LOCAL or not self._file_manager.file_exists(origin, path):
+			flask.abort(404)
+		return self._layer_image_response(self._file_manager.path_on_disk(origin, path), layer)
+
+	def _layer_image_response(self, path, layer):
+		"""
+		Renders the layer downscaled to the max_width query parameter, as
+		the format parameter asks for, png or webp.
+		"""
+		try:
+			layer = int(layer)
+		except (TypeError, ValueError):
+			# also "-" if no current layer is known
+			flask.abort(404)
+		max_width = flask.request.args.get("max_width", DEFAULT_MAX_WIDTH, type=int)
+		image_format = flask.request.args.get("format", "png").lower()
+		if layer < 1 or max_width < 1 or image_format not in IMAGE_FORMATS:
+			flask.abort(400)
+		if image_format == "webp" and not webp_supported():
+			flask.abort(400, description="WebP needs Pillow to be installed")
+		cache = layer_image_cache()
+		if cache is None:
+			flask.abort(503)
+		try:
+			image = cache.get_or_render(path, layer - 1, max_width, image_format)
+		except IndexError:
+			flask.abort(404)
+		if image is None:
+			flask.abort(404)
+
+		etag, data = image
+		response = flask.make_response(data)
+		response.mimetype = "image/" + image_format
+		response.set_etag(etag)
+		response.cache_control.private = True
+		response.cache_control.no_cache = True
+		return response.make_conditional(flask.request)
+
+	def is_blueprint_csrf_protected(self):
+		return True
+
 	def on_print_progress(self, storage, path, progress):
 		if not self._printer.is_printing():
 			return
+		self._plugin_manager.send_plugin_message("Chituboard",self._layer_status())
+
+	def _layer_status(self):
+		"""
+		Current layer as "layer/count" plus the fraction of the current
+		layer's image read so far.
+		"""
 		result = "-"
+		layer_progress = None
 		if self._printer._sliced_model_file:
+			current = self._printer.get_current_layer_progress()
+			if current is not None:
+				layer, layer_progress = current
+			else:
+				layer = "-"
 			result = "{}/{}".format(
-				self._printer.get_current_layer(),
+				layer,
 				self._printer._sliced_model_file.layer_count
 			)
-		self._plugin_manager.send_plugin_message("Chituboard",dict(layerString = result))
+		return dict(layerString = result, layerProgress = layer_progress)
 	
 	@staticmethod
 	def register_custom_events(*args, **kwargs):
-		return ["layer_change"]
+		return ["layer_change", "transfer_progress"]
 
 	def analysis_commands(self,*args, **kwargs):
 		import click
 		@click.command(name="sla_analysis")
 		@click.argument("name", default=None)
-		def sla_analysis(name):
+		@click.option("--header-only", is_flag=True, help="Only read the print settings from the file's headers.")
+		def sla_analysis(name, header_only):
 			"""
 			Analyze files created in chitubox, photon workshop and Lychee.
 			Will be used in analysis queue
 			"""
-			import time, yaml
+			import dataclasses
 			from pathlib import Path
+			import yaml
 			from octoprint.util import monotonic_time
-			start_time = monotonic_time()
 			from .file_formats.utils import get_file_format
+			from .sla_analyser import analyse_sliced_file
+			start_time = monotonic_time()
 			if os.path.isabs(name):
-				file_format = get_file_format(name)
-				sliced_model_file = file_format.read(Path(name))
+				if header_only:
+					header = get_file_format(name).read_header(Path(name))
+					result = dataclasses.asdict(header, dict_factory=lambda items: {
+						key: list(value) if isinstance(value, tuple) else value for key, value in items})
+				else:
+					result = analyse_sliced_file(name)
 				click.echo("DONE:{}s".format(monotonic_time() - start_time))
 				click.echo("RESULTS:")
-				result = {
-					"filename": sliced_model_file.filename,
-					"path": name,
-					"bed_size_mm": list(sliced_model_file.bed_size_mm),
-					"height_mm": round(sliced_model_file.height_mm, 4),
-					"layer_count": sliced_model_file.layer_count,
-					"layer_height_mm": round(sliced_model_file.layer_height_mm, 4),
-					"resolution": list(sliced_model_file.resolution),
-					"print_time_secs": sliced_model_file.print_time_secs,
-					"total_time": sliced_model_file.print_time_secs/60,
-					"volume": sliced_model_file.volume,
-					"printer name": sliced_model_file.printer_name,
-					"printing_area": sliced_model_file.printing_area,
-					"dimensions": sliced_model_file.dimensions,
-					}
 				click.echo(yaml.safe_dump(result,default_flow_style=False, indent=2, allow_unicode=False))
 			else:
 				click.echo("ERROR: not absolute path, nothing to analyse")
@@ -161,8 +302,17 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 			defaultBaudRate = 115200,
 			additionalPorts = "/dev/ttyS0",
 			layerImgDisplay = False,
+			analysisInProcess = True,
+			analyseAllLayers = True,
+			modelCacheSize = 16,
+			previewCacheSize = 8,
+			layerImageCacheEntries = 32,
 			workAsFlashDrive = True,
+			writeUsbImage = False,
+			usbImage = "/piusb.bin",
 			chitu_comm = False,
+			virtualChitu = False,
+			virtualChituSpeed = 1.0,
 			photonFileEditor = False,
 			useHeater = False,
 			heaterTemp = 30,
@@ -178,13 +328,129 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		
 	def on_settings_initialized(self):
 		self._logger.info("Octoprint-Chituboard: load settings finished")
+		# parsed sliced files are cached in the data folder, size in MB
+		init_model_cache(
+			os.path.join(self.get_plugin_data_folder(), "model_cache"),
+			self._settings.get_int(["modelCacheSize"]) * 1024 * 1024)
+		init_preview_cache(
+			os.path.join(self.get_plugin_data_folder(), "previews"),
+			self._settings.get_int(["previewCacheSize"]) * 1024 * 1024)
+		init_layer_image_cache(self._settings.get_int(["layerImageCacheEntries"]))
+		self._register_file_formats()
+
+	def _register_file_formats(self):
+		"""
+		Adds the formats other plugins return from the
+		octoprint.plugin.chituboard.file_formats hook, a list of
+		file_formats.utils.FileFormatSpec each.
+		"""
+		from .file_formats.utils import register_file_format
+		for name, hook in self._plugin_manager.get_hooks("octoprint.plugin.chituboard.file_formats").items():
+			try:
+				for spec in hook():
+					register_file_format(spec)
+					self._logger.info("Registered {} file format of plugin {}".format(spec.name, name))
+			except Exception:
+				self._logger.exception("Error registering the file formats of plugin {}".format(name))
 
 	def on_after_startup(self):
-		self._logger.info("Octoprint-Chituboard plugin startup")
+		self._logger.info("Octoprint-Chituboard plugin startup, plugin module loaded in {:.1f}ms".format(
+			_load_time * 1000))
+		if self._settings.get_boolean(["chitu_comm"]):
+			from .chitu_comm import chitu_comm
+			self._chitu_comm = chitu_comm(self)
+			self._chitu_comm.start_listen_reqest()
+		if self._settings.get_boolean(["writeUsbImage"]):
+			from .fat_image import FatImage
+			self._usb_image = FatImage(self._settings.get(["usbImage"]))
+
+	def on_event(self, event, payload):
+		if event in (Events.FILE_ADDED, Events.FILE_REMOVED) and self._usb_image is not None:
+			if payload.get("storage") != FileDestinations.LOCAL or "sla_bin" not in payload.get("type", []):
+				return
+			thread = threading.Thread(
+				target=self._update_usb_image, args=(event, payload["name"], payload["path"]), name="usb_image")
+			thread.daemon = True
+			thread.start()
+
+	def _update_usb_image(self, event, name, path):
+		"""
+		Adds or deletes a sliced file in the image the printer sees as USB
+		drive, without mounting it, and makes the printer read it again.
+		The image only has a root folder, so files of the same name in
+		different upload folders share one entry: while one of them is in
+		the image the others are not added, and removing one puts another
+		of that name in its place.
+		"""
+		from .fat_image import FatImageError, signal_media_change
+		try:
+			with self._usb_image_lock:
+				others = [other for other in self._local_files_named(name) if other != path]
+				if event == Events.FILE_ADDED:
+					if others and self._usb_image.has_file(name):
+						self._logger.warning("Not adding {} to {}, it already holds {} of the same name".format(
+							path, self._usb_image.path, others[0]))
+						return
+					self._usb_image.add_file(name, self._file_manager.path_on_disk(FileDestinations.LOCAL, path))
+				elif others:
+					self._logger.info("Replacing {} in {} with {}".format(path, self._usb_image.path, others[0]))
+					self._usb_image.add_file(name, self._file_manager.path_on_disk(FileDestinations.LOCAL, others[0]))
+				elif not self._usb_image.delete_file(name):
+					return
+			if not signal_media_change(self._usb_image.path):
+				self._logger.warning("No USB gadget serves {}, the printer won't see {} until it is reloaded".format(
+					self._usb_image.path, name))
+		except (FatImageError, OSError, subprocess.CalledProcessError):
+			self._logger.exception("Error updating {} in {}".format(name, self._usb_image.path))
+
+	def _local_files_named(self, name):
+		"""Paths in the uploads folder of the files called name, ignoring case like FAT does."""
+		uploads = self._settings.global_get_basefolder("uploads")
+		name = name.lower()
+		paths = []
+		for root, _, files in os.walk(uploads):
+			for file_name in files:
+				if file_name.lower() == name:
+					paths.append(os.path.relpath(os.path.join(root, file_name), uploads).replace(os.sep, "/"))
+		return sorted(paths)
+
+	def on_shutdown(self):
+		if self._chitu_comm is not None:
+			self._chitu_comm.shutdownService()
 
 	def get_sla_analysis_factory(*args, **kwargs):
 		return dict(sla_bin=sla_AnalysisQueue)
 
+	def get_sla_estimator_factory(self, *args, **kwargs):
+		return self._create_print_time_estimator
+
+	def _create_print_time_estimator(self, job_type):
+		from .sla_estimator import create_estimator
+		return create_estimator(job_type, self._printer)
+
+	def get_virtual_chitu_factory(self, comm_instance, port, baudrate, read_timeout, *args, **kwargs):
+		"""
+		Serial port of the simulated board for connections to VIRTUAL_CHITU,
+		printing the files in the uploads folder virtualChituSpeed times
+		faster than the real printer.
+		"""
+		if not self._settings.get_boolean(["virtualChitu"]):
+			return None
+		from .virtual_chitu import VIRTUAL_PORT, VirtualChituBoard
+		if port != VIRTUAL_PORT:
+			return None
+		return VirtualChituBoard(
+			self._settings.global_get_basefolder("uploads"),
+			speed=self._settings.get_float(["virtualChituSpeed"]),
+			read_timeout=float(read_timeout),
+			baudrate=baudrate)
+
+	def get_additional_port_names(self, *args, **kwargs):
+		if self._settings.get_boolean(["virtualChitu"]):
+			from .virtual_chitu import VIRTUAL_PORT
+			return [VIRTUAL_PORT]
+		return []
+
 	def get_sla_printer_factory(self,components):
 		"""
 		Replace octoprint standard.py with new version
@@ -216,13 +482,12 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		}
 		
 	def get_gcode_receive_modifier(self, comm_instance, line, *args, **kwargs):
-		line = self._rewrite_wait_to_busy(line)
-		line = self._rewrite_identifier(line)
+		kind = classify_line(line)
+		if kind is None:
+			return line
+		if kind != LINE_SD_STATUS:
+			return self._line_rewriters[kind](self, line)
 		line, end_msg = self._rewrite_print_finished(line)
-		line = self._rewrite_start(line)
-		line = self._rewrite_m4000_response(line)
-		line = self._rewrite_m114_response(line)
-		line = self._rewrite_error(line)
 		if end_msg == True:
 			try:
 				self._printer._comm._changeState(self._printer._comm.STATE_OPERATIONAL)
@@ -234,10 +499,8 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 	def _rewrite_m4000_response(self,line):
 		rewritten = None
 		matchB = self.parse_M4000["floatB"].search(line)
-		matchD = self.parse_M4000["floatD"].search(line)
-		matchX = self.parse_M4000["floatX"].search(line)
-		matchY = self.parse_M4000["floatY"].search(line)
-		matchZ = self.parse_M4000["floatZ"].search(line)
+		# the pause state only matters while pausing, skip parsing it otherwise
+		matchD = self._printer.is_pausing() and self.parse_M4000["floatD"].search(line)
 		
 		if matchB:
 			try:
@@ -247,7 +510,7 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 				self._logger.info("Error parsing M400 response ", type(inst), inst)
 			else:
 				rewritten = line.replace(matchB.group(0), " T:0 /0 B:{} /{}\r\n".format(actual,target))
-		if matchD and self._printer.is_pausing():
+		if matchD:
 			try:
 				current = int(matchD.group('current'))
 				total = int(matchD.group('total'))
@@ -258,9 +521,9 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 				if paused == 1 and current > 0:
 					self._printer._comm._record_pause_data = True
 					self._printer._comm._changeState(self._printer._comm.STATE_PAUSED)
-					Xpos = matchX.group("value")
-					Ypos = matchY.group("value")
-					Zpos = matchZ.group("value")
+					Xpos = self.parse_M4000["floatX"].search(line).group("value")
+					Ypos = self.parse_M4000["floatY"].search(line).group("value")
+					Zpos = self.parse_M4000["floatZ"].search(line).group("value")
 					self._logger.info("printer paused from parse M4000")
 					rewritten = "ok X:{} Y:{} Z:{} E:0.000000".format(Xpos, Ypos, Zpos)
 					
@@ -287,7 +550,7 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 	
 	def _rewrite_start(self, line):
 		if line.startswith('ok V'):
-			self.firmware_version = line[3:]
+			self.firmware_version = line[3:].split()[0]
 			self._log_replacement("start command",line, "ok start", only_once=True)	
 			return 'ok start' + line
 		return line
@@ -316,6 +579,10 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 			self._log_replacement("identifier", line, rewritten)
 			return rewritten
 		return line
+
+	def _rewrite_banner(self, line):
+		# the version has to be known before the identifier is rewritten
+		return self._rewrite_identifier(self._rewrite_start(line))
 		
 	def _rewrite_end_msg(self,line):
 		if "End read" in line:
@@ -366,6 +633,16 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 							return line, False
 		return line, False
 		
+	_line_rewriters = {
+		LINE_WAIT: _rewrite_wait_to_busy,
+		LINE_IDENTIFIER: _rewrite_identifier,
+		LINE_START: _rewrite_start,
+		LINE_BANNER: _rewrite_banner,
+		LINE_M4000: _rewrite_m4000_response,
+		LINE_M114: _rewrite_m114_response,
+		LINE_NOT_PRINTING: _rewrite_error,
+	}
+		
 	def _log_replacement(self, t, orig, repl, only_once=False):
 		if not only_once or not self._logged_replacement.get(t, False):
 			self._logger.info("Replacing {} with {}".format(orig, repl))
@@ -396,6 +673,8 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 			}
 			}
 
+_load_time = time.perf_counter() - _load_start
+
 __plugin_pythoncompat__ = ">=3.9,<4"
 
 def __plugin_load__():
@@ -408,8 +687,11 @@ def __plugin_load__():
 		"octoprint.comm.protocol.gcode.queuing": (__plugin_implementation__.gcode_modifier.get_gcode_queuing_modifier,1),
 		"octoprint.filemanager.extension_tree"  : __plugin_implementation__.get_extension_tree,
 		"octoprint.filemanager.analysis.factory": __plugin_implementation__.get_sla_analysis_factory,
+		"octoprint.printer.estimation.factory": __plugin_implementation__.get_sla_estimator_factory,
 		"octoprint.printer.factory"			 : (__plugin_implementation__.get_sla_printer_factory,1),
 		"octoprint.comm.protocol.gcode.received": (__plugin_implementation__.get_gcode_receive_modifier,1),
 		"octoprint.cli.commands": __plugin_implementation__.analysis_commands,
-		"octoprint.events.register_custom_events": __plugin_implementation__.register_custom_events
+		"octoprint.events.register_custom_events": __plugin_implementation__.register_custom_events,
+		"octoprint.comm.transport.serial.factory": __plugin_implementation__.get_virtual_chitu_factory,
+		"octoprint.comm.transport.serial.additional_port_names": __plugin_implementation__.get_additional_port_names
 	}
\ No newline at end of file
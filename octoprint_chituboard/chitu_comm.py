@@ -1,225 +1,322 @@
 # coding=utf-8
-#from socket import *
+import asyncio
+import bisect
+import logging
+import os
 import socket
-import netifaces as ni
-from uuid import getnode as get_mac
-from octoprint.filemanager.destinations import FileDestinations
-import octoprint.filemanager
-import multiprocessing
 import struct
+import threading
+from typing import List, Optional
+from uuid import getnode as get_mac
 
 import octoprint.util
-import logging
-import threading
-import select
-#https://docs.python.org/3/library/socket.html
+from octoprint.filemanager.destinations import FileDestinations
+from octoprint.filemanager.util import DiskFileWrapper
 
 PRINTERNAME = "Mars 2"
+PORT = 3000
+
+# data packets end with the file offset of their payload, a checksum byte and 0x83
+TRAILER = struct.Struct("<IBB")
+END_OF_PACKET = 0x83
+# files being received get this suffix, so nothing picks them up half written
+PARTIAL_SUFFIX = ".part"
+
+OK = b"ok"
+
+
+def checksum(data) -> int:
+    """XOR of all bytes of data, the checksum of a data packet's payload and offset."""
+    import numpy as np
+    return int(np.bitwise_xor.reduce(np.frombuffer(data, dtype=np.uint8), initial=0))
+
+
+def pack_chunk(offset: int, data) -> bytes:
+    """Data packet of an upload, data followed by its offset, checksum and 0x83."""
+    body = bytes(data) + struct.pack("<I", offset)
+    return body + bytes((checksum(body), END_OF_PACKET))
+
+
+def parse_filename(data: bytes, command: bytes) -> Optional[str]:
+    """
+    File name argument of an M28 or M6030 packet, e.g. "M28 model.ctb" or
+    "M6030 ':model.ctb' I1". Only the base name is used, so a packet can
+    not write outside the upload folder.
+    """
+    args = data[len(command):].decode("latin-1").strip()
+    if "'" in args:
+        args = args.split("'")[1]
+    elif args:
+        args = args.split()[0]
+    name = os.path.basename(args.lstrip(":"))
+    return name or None
+
+
+class ReceivedRanges():
+    """
+    Sparse set of the byte ranges of a file received so far, as sorted,
+    disjoint, non-adjacent [start, end) ranges. A file received in order
+    is a single range however many packets it took.
+    """
+
+    def __init__(self):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def add(self, start: int, end: int):
+        # all ranges touching [start, end) are merged into one
+        first = bisect.bisect_left(self._ends, start)
+        last = bisect.bisect_right(self._starts, end)
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def covers(self, start: int, end: int) -> bool:
+        index = bisect.bisect_right(self._starts, start) - 1
+        return index >= 0 and self._ends[index] >= end
+
+    def first_missing(self) -> int:
+        """Offset of the first byte not received, everything before it is."""
+        if self._starts and self._starts[0] == 0:
+            return self._ends[0]
+        return 0
+
+    @property
+    def end(self) -> int:
+        return self._ends[-1] if self._ends else 0
+
+
+class Upload():
+    """
+    File received over the network, every chunk is written in place at the
+    offset its packet carries. Chunks already received are not written
+    again.
+    """
+
+    def __init__(self, name, partial_path):
+        self.name = name
+        self.partial_path = partial_path
+        self.received = ReceivedRanges()
+        self._fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    @property
+    def size(self) -> int:
+        return self.received.end
+
+    @property
+    def complete(self) -> bool:
+        return self.received.first_missing() == self.received.end
+
+    def write(self, offset: int, data):
+        end = offset + len(data)
+        if self.received.covers(offset, end):
+            return
+        os.pwrite(self._fd, data, offset)
+        self.received.add(offset, end)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def abort(self):
+        self.close()
+        try:
+            os.remove(self.partial_path)
+        except OSError:
+            pass
+
+
+class ChituboxProtocol(asyncio.DatagramProtocol):
+    """Answers every datagram with the reply chitu_comm.handle_datagram returns."""
+
+    def __init__(self, comm):
+        self._comm = comm
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            reply = self._comm.handle_datagram(data)
+        except Exception:
+            self._comm._logger.exception("Error handling a packet from {}".format(addr[0]))
+            return
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+
+    def error_received(self, exc):
+        self._comm._logger.debug("Chitubox receiver socket error: {}".format(exc))
+
 
 class chitu_comm():
+    """
+    Receives files from Chitubox over the network like a Chitu board with
+    WiFi does: M99999 discovery, M4001 printer info, M28/M29 upload with
+    M4012 progress queries and M6030 to print the uploaded file.
+
+    Packets are handled on an asyncio event loop in a daemon thread, data
+    packets are told apart from commands on their raw bytes and written
+    with os.pwrite at their offset, without decoding or copying them.
+    """
 
-    def __init__(self,sel):
+    def __init__(self, sel):
 
         self.sup = sel
+        self._logger = logging.getLogger(__name__)
 
-        self.file_is_uploading = False
         self.ip = "0.0.0.0"
-
         for addr in octoprint.util.interface_addresses():
             if addr != "127.0.0.1":
                 self.ip = addr
 
-        self.mac = "0:0:0:0"
-                
+        self.mac = ":".join("{:02X}".format(b) for b in get_mac().to_bytes(6, "big"))
         self.name = "Octoprint"
         self.version = "V1.4.1"
         self.id = "28,00,26,00,0d,50,48,50"
         self.z_step_hight = "0.000625"
-        self.ok_answer = str.encode("ok")
+        self.upload = None
         self.nameLastUploadedFile = None
-        self.file_handler = None
-        self.uploaded_file_path = None
-        self.shutdownSig = False
-
         self.last_file_position_count = 0
-        
-
-        def get_host_ip(self, parameter_list):
-            #[ad["addr"] for ad in ni.ifaddresses(interface)[ni.AF_INET]
-            pass
-            #TODO: implemet
 
-        def get_host_mac(self, parameter_list):
-            pass
-            #TODO: implemet
+        self._loop = None
+        self.listen_thread = None
+        self._commands = (
+            (b"M99999", self._discover),
+            (b"M4001", self._printer_info),
+            (b"M4012", self._upload_progress),
+            (b"M28", self._start_upload),
+            (b"M29", self._end_upload),
+            (b"M6030", self._start_print),
+        )
 
-        def set_host_ip(self, parameter_list):
-            pass    #':'.join(("%012X" % get_mac())[i:i+2] for i in range(0, 12, 2))
-            #TODO: implemet
+    def start_listen_reqest(self, port=PORT):
+        self._loop = asyncio.new_event_loop()
+        self.listen_thread = threading.Thread(target=self._listen, args=(port,), name="chitu_comm")
+        self.listen_thread.daemon = True
+        self.listen_thread.start()
 
-        def set_host_mac(self, parameter_list):
-            pass
-            #TODO: implemet
+    def shutdownService(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
 
-        def find_host_ip(self, parameter_list):
-            pass
-            #TODO: implemet #gethostbyname(gethostname())
+    def _listen(self, port):
+        asyncio.set_event_loop(self._loop)
+        transport = None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind(("", port))
+            transport, _ = self._loop.run_until_complete(
+                self._loop.create_datagram_endpoint(lambda: ChituboxProtocol(self), sock=sock))
+            self._logger.info("Chitubox file receiver is now listening on port {}".format(port))
+            self._loop.run_forever()
+        except Exception:
+            self._logger.exception("Chitubox file receiver stopped")
+        finally:
+            if transport is not None:
+                transport.close()
+            if self.upload is not None:
+                self.upload.abort()
+                self.upload = None
+            self._loop.close()
 
-        def find_host_mac(self, parameter_list):
-            pass
-            #TODO: implemet
-
-    def printstartCP(self,cb=None):
-        if cb is not None:
-            self.printCB = cb
-    # ~ def process_m99999(message):
-        # ~ """
-        # ~ M99999 is used to process Chitubox brocast requests
-        # ~ """
-        # ~ resp = "ok. NAME:{0} IP:{1} \n".format(PRINTERNAME, localIp)
-        # ~ s.sendto(resp, address)
-        # ~ if debug:
-            # ~ print("Info: Received broadcast request from {0}\n".format(address[0]))
-            # ~ print("Recv: {0}\nSend: {1}".format(str(message), resp))
-    
-    def shutdownService(self):
-        pass
-        #self.process_conn.send("shutdown")
+    def handle_datagram(self, data: bytes) -> Optional[bytes]:
+        """Handles one packet and returns the reply to send, if any."""
+        if self.upload is not None and len(data) > TRAILER.size and data[-1] == END_OF_PACKET:
+            return self._receive_chunk(data)
+        for command, handler in self._commands:
+            if data.startswith(command):
+                return handler(data)
+        self._logger.debug("Ignoring unknown packet of {} bytes".format(len(data)))
+        return None
 
-    def start_listen_reqest(self):
-        
-        self.listen_thread = threading.Thread(target=self.listen_request)
-        self.listen_thread.daemon = True
-        self.listen_thread.start()
-        
+    def _receive_chunk(self, data: bytes) -> bytes:
         """
-        self.process_conn, child_conn = multiprocessing.Pipe()
-        self.udp_process = multiprocessing.Process(target=self.listen_request,args=(child_conn,))
-
-        self.udp_process.start()
+        Writes a data packet and asks for the first missing byte if there is
+        a gap before the packet, or after it if the following data has
+        already been received. Chitubox then continues sending from there,
+        so only the lost chunks are sent again.
         """
-    def listen_request(self):
-        self.file_is_uploading = False
-        
-        self.s=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        
-        self.s.bind(('',3000))
-        self.s.settimeout(2)
-        port = 3000
-        self._logger.info("Info: Chitubox file receiver is now listening on the port {0}\n".format(str(port)))
-        # ~ file_handler = None
-        # ~ uploaded_file_path = None
-        # ~ shutdownSig = False
-        
-        while True:
-            #print(conn.recv())
-            #if conn.recv() == "shutdown":
-            #    self.s.close()
-            #    break
-            try:
-                m = self.s.recvfrom(4096)
-            except socket.timeout:
-                continue
-    
-            except KeyboardInterrupt:
-                self.s.close()
-                break
-            ############################################
-            #file upload processing
-            ############################################
-            
-            if self.file_is_uploading is True:
-                if "M4012 I1" in m[0].decode('latin-1'):
-                    self._logger.info("recive M4012 I1")
-                    
-                    #print("%s count" % (struct.unpack("<i",message_end_part)[0] 
-                    
-                    answer = "ok "+ str(last_file_position_count)+"/1"
-                    answer_as_bytes = str.encode(answer)
-                    self.s.sendto(answer_as_bytes,m[1])
-                    
-                    continue     
-    
-    
-                if "M29" in m[0].decode('latin-1'):
-                    self._logger.info("recive M29 end file upload")
-                    self.sup._logger.info("end fileupload of file: "+uploaded_file_path)
-    
-                    self.file_handler.close()
-    
-                    self.file_is_uploading = False
-    
-                    self.s.sendto(self.ok_answer,m[1])
-                    continue
-    
-                message_end_part = m[0][len(m[0])-6:len(m[0])-2]
-                last_file_position_count = struct.unpack("<i",message_end_part)[0] + len(m[0])-6
-    
-    
-                #TODO:byte len(m[0])-1 ist die "prüfsumme" 
-                # muss noch validiert werden.
-                #wenn prüfsumme falsch sende resend antwort
-                """
-                if (receivedText.Find("resend") != wxNOT_FOUND)
-                {
-                    long resend_index = getValue(receivedText, "resend ", -1);
-                    photonFile->Seek(resend_index, wxFromStart);
-                }
-                
-                """
-    
-                self.file_handler.write(m[0][0:len(m[0])-6])
-    
-                last_file_position_count = struct.unpack("<i",message_end_part)[0] + len(m[0])-6
-    
-                self.s.sendto(self.ok_answer,m[1])
-                continue
-    
-            #############################################
-    
-            if m[0] == b'M99999':#to find printer in network
-                self._logger.info("recive M99999 broadcast message")
-    
-                answer = 'ok MAC:'+ self.mac +' IP:'+self.ip.encode("utf-8")+' VER:'+self.version+' ID:'+self.id+' NAME:'+self.name
-                answer_as_bytes = str.encode(answer)
-                self.s.sendto(answer_as_bytes,m[1])
-                continue
-    
-            if m[0] == b'M4001':
-                #ok X:0.012500 Y:0.012500 Z:0.000625 E:0.001340 T:0/0/0/155/1 U:'GBK' B:1
-                #self.log.info("recive M4001 init Message")
-                answer = "ok X:0.012500 Y:0.012500 Z:"+self.z_step_hight+" E:0.001340 T:0/0/0/155/1 U:'GBK' B:1"
-                answer_as_bytes = str.encode(answer)
-                self.s.sendto(answer_as_bytes,m[1])
-                continue
-    
-            ############################################
-            #file upload
-            ############################################
-            if "M28" in m[0].decode('latin-1'):
-                self._logger.info("recive M28 start Fileupload")
-                
-                self.nameLastUploadedFile = m[0][3:len(m[0])].decode('latin-1')
-                self.uploaded_file_path = self.sup._settings.global_get_basefolder("watched") + "/" + self.nameLastUploadedFile
-    
-                try:
-                    self.file_handler = open(self.uploaded_file_path, "wb")
-                except OSError as e:
-                    self.sup._logger.info("cant write to file "+ file_path +" , throwing error")
-                
-                self.file_is_uploading = True
-                self.s.sendto(self.ok_answer,m[1])
-                continue
-    
-            if "M6030" in m[0].decode('latin-1'):
-                print("recive M6030 start Print")
-    
-                filenameToSelect = self.sup._file_manager.path_on_disk(FileDestinations.LOCAL, self.nameLastUploadedFile)
-                print(filenameToSelect)
-                self.sup.sla_printer.select_file(filenameToSelect, False, printAfterSelect=True)
-    
-                self.s.sendto(self.ok_answer,m[1])
-                continue
-            ##self._storage(destination).file_in_path(path, file)
+        size = len(data) - TRAILER.size
+        offset, packet_checksum, _ = TRAILER.unpack_from(data, size)
+        if checksum(memoryview(data)[:size + 4]) != packet_checksum:
+            self._logger.warning("Checksum error in the packet at offset {}, asking for it again".format(offset))
+            return "resend {}".format(offset).encode("latin-1")
+
+        self.upload.write(offset, memoryview(data)[:size])
+        missing = self.upload.received.first_missing()
+        self.last_file_position_count = missing
+        if missing != offset + size:
+            self._logger.debug("Packet at offset {}, asking for {}".format(offset, missing))
+            return "resend {}".format(missing).encode("latin-1")
+        return OK
+
+    def _discover(self, data):
+        self._logger.info("received M99999 broadcast message")
+        return "ok MAC:{} IP:{} VER:{} ID:{} NAME:{}".format(
+            self.mac, self.ip, self.version, self.id, self.name).encode("latin-1")
+
+    def _printer_info(self, data):
+        return "ok X:0.012500 Y:0.012500 Z:{} E:0.001340 T:0/0/0/155/1 U:'GBK' B:1".format(
+            self.z_step_hight).encode("latin-1")
+
+    def _upload_progress(self, data):
+        return "ok {}/1".format(self.last_file_position_count).encode("latin-1")
+
+    def _start_upload(self, data):
+        name = parse_filename(data, b"M28")
+        if name is None:
+            return b"Error: no file name"
+        if self.upload is not None:
+            self._logger.warning("Dropping unfinished upload of {}".format(self.upload.name))
+            self.upload.abort()
+            self.upload = None
+
+        partial_path = os.path.join(self.sup._settings.global_get_basefolder("uploads"), name + PARTIAL_SUFFIX)
+        try:
+            self.upload = Upload(name, partial_path)
+        except OSError:
+            self._logger.exception("Can't write to file {}".format(partial_path))
+            return b"Error: can't write file"
+        self.last_file_position_count = 0
+        self._logger.info("received M28, start upload of {}".format(name))
+        return OK
+
+    def _end_upload(self, data):
+        if self.upload is None:
+            return OK
+        if not self.upload.complete:
+            missing = self.upload.received.first_missing()
+            self._logger.warning("Upload of {} ended with data missing at offset {}".format(self.upload.name, missing))
+            return "resend {}".format(missing).encode("latin-1")
+        upload, self.upload = self.upload, None
+        upload.close()
+        try:
+            self.sup._file_manager.add_file(
+                FileDestinations.LOCAL,
+                upload.name,
+                DiskFileWrapper(upload.name, upload.partial_path, move=True),
+                allow_overwrite=True)
+        except Exception:
+            self._logger.exception("Can't add uploaded file {}".format(upload.name))
+            upload.abort()
+            return b"Error: can't save file"
+        self.nameLastUploadedFile = upload.name
+        self._logger.info("received M29, end upload of {} ({} bytes)".format(upload.name, upload.size))
+        return OK
+
+    def _start_print(self, data):
+        name = parse_filename(data, b"M6030") or self.nameLastUploadedFile
+        if name is None:
+            return b"Error: no file name"
+        self._logger.info("received M6030, start print of {}".format(name))
+        self.sup._printer.select_file(name, False, printAfterSelect=True)
+        return OK
@@ -0,0 +1,513 @@
+# coding=utf-8
+
+import contextlib
+import datetime
+import errno
+import glob
+import logging
+import os
+import re
+import struct
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterator, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+	import numpy as np
+
+DIR_ENTRY = struct.Struct("<11sBBBHHHHHHHI")
+LFN_ENTRY = struct.Struct("<B10sBBB12sH4s")
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+# NTRes flags of short names whose base name or extension is lower case
+LOWER_CASE_BASE = 0x08
+LOWER_CASE_EXT = 0x10
+
+END_OF_DIRECTORY = 0x00
+DELETED = 0xE5
+# an 0xE5 first character is stored as 0x05, 0xE5 marks deleted entries
+KANJI_E5 = 0x05
+LAST_LFN = 0x40
+LFN_CHARS = 13
+
+# FAT32 entries are 28 bits, the upper 4 are reserved and kept as they are
+FAT_MASK = 0x0FFFFFFF
+END_OF_CHAIN = 0x0FFFFFFF
+MIN_END_OF_CHAIN = 0x0FFFFFF8
+MAX_FILE_SIZE = 0xFFFFFFFF
+MAX_NAME_LENGTH = 255
+
+COPY_CHUNK_SIZE = 1 << 20
+
+REGEX_SHORT_NAME_INVALID = re.compile(r"[^A-Z0-9!#$%&'()\-@^_`{}~]")
+
+# "file" attributes of the luns of the USB mass storage gadget, loaded as
+# g_mass_storage module or set up through configfs
+LUN_FILE_PATTERNS = (
+	"/sys/devices/platform/soc/*.usb/gadget*/lun*/file",
+	"/sys/devices/platform/*.usb/gadget*/lun*/file",
+	"/sys/kernel/config/usb_gadget/*/functions/mass_storage.*/lun.*/file",
+)
+
+
+class FatImageError(Exception):
+	pass
+
+
+@dataclass(frozen=True)
+class DirectoryEntry:
+	"""File or folder in the root directory, slots are the indexes of its long name and 8.3 entries."""
+	name: str
+	short_name: bytes
+	attributes: int
+	first_cluster: int
+	size: int
+	slots: Tuple[int, ...]
+
+	@property
+	def is_directory(self) -> bool:
+		return bool(self.attributes & ATTR_DIRECTORY)
+
+
+def short_name_checksum(short_name: bytes) -> int:
+	checksum = 0
+	for byte in short_name:
+		checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+	return checksum
+
+def short_name(name: str, existing: Set[bytes]) -> Tuple[bytes, bool]:
+	"""
+	8.3 name for name not in existing, and whether a long name is needed
+	as well, e.g. "MODEL~1  CTB" and True for "model.ctb".
+	"""
+	base, dot, extension = name.rpartition(".")
+	if not dot:
+		base, extension = name, ""
+
+	def clean(part):
+		return REGEX_SHORT_NAME_INVALID.sub("_", part.upper().replace(" ", "").replace(".", ""))
+
+	short_base = clean(base) or "_"
+	short_extension = clean(extension)[:3]
+	if short_base == base and short_extension == extension and len(base) <= 8:
+		candidate = (base.ljust(8) + extension.ljust(3)).encode("ascii")
+		if candidate not in existing:
+			return candidate, False
+
+	for number in range(1, 1000000):
+		tail = "~{}".format(number)
+		candidate = ((short_base[:8 - len(tail)] + tail).ljust(8) + short_extension.ljust(3)).encode("ascii")
+		if candidate not in existing:
+			return candidate, True
+	raise FatImageError("No free short name for {}".format(name))
+
+def display_short_name(short_name: bytes, flags: int) -> str:
+	base = short_name[:8].decode("latin-1").rstrip()
+	extension = short_name[8:].decode("latin-1").rstrip()
+	if base[:1] == chr(KANJI_E5):
+		base = chr(DELETED) + base[1:]
+	if flags & LOWER_CASE_BASE:
+		base = base.lower()
+	if flags & LOWER_CASE_EXT:
+		extension = extension.lower()
+	return base + "." + extension if extension else base
+
+def fat_timestamp(when: datetime.datetime) -> Tuple[int, int]:
+	"""(date, time) of when in the FAT encoding, 2 second resolution."""
+	date = ((max(when.year, 1980) - 1980) << 9) | (when.month << 5) | when.day
+	time = (when.hour << 11) | (when.minute << 5) | (when.second // 2)
+	return date, time
+
+def long_name_entries(name: str, short: bytes) -> List[bytes]:
+	"""Long name entries of name in the order they are stored, last part first."""
+	chars = name.encode("utf-16-le")
+	if len(chars) // 2 > MAX_NAME_LENGTH:
+		raise FatImageError("{} is longer than {} characters".format(name, MAX_NAME_LENGTH))
+	if (len(chars) // 2) % LFN_CHARS:
+		chars += b"\x00\x00"
+	chars += b"\xff" * (-len(chars) % (LFN_CHARS * 2))
+	checksum = short_name_checksum(short)
+
+	count = len(chars) // (LFN_CHARS * 2)
+	entries = []
+	for number in range(count, 0, -1):
+		part = chars[(number - 1) * LFN_CHARS * 2:number * LFN_CHARS * 2]
+		order = number | (LAST_LFN if number == count else 0)
+		entries.append(LFN_ENTRY.pack(order, part[:10], ATTR_LONG_NAME, 0, checksum, part[10:22], 0, part[22:]))
+	return entries
+
+def is_loop_mounted(path) -> bool:
+	"""Whether a loop device is backed by path, e.g. mounted through /etc/fstab."""
+	path = os.path.realpath(path)
+	for backing_file in glob.glob("/sys/block/loop*/loop/backing_file"):
+		try:
+			with open(backing_file) as file:
+				if os.path.realpath(file.read().strip()) == path:
+					return True
+		except OSError:
+			continue
+	return False
+
+def _write_sysfs(path, value: str):
+	try:
+		with open(path, "w") as file:
+			file.write(value + "\n")
+	except PermissionError:
+		subprocess.run(["sudo", "-n", "tee", path], input=(value + "\n").encode(),
+			stdout=subprocess.DEVNULL, check=True)
+
+def signal_media_change(image_path) -> bool:
+	"""
+	Ejects image_path from the USB gadget luns serving it and inserts it
+	again, the printer then rereads the FAT and directory instead of using
+	what it has cached. Needs the gadget loaded with removable=1, like
+	Chituboard.sh does. Returns False if no lun serves image_path.
+	"""
+	image_path = os.path.realpath(image_path)
+	changed = False
+	for lun_file in sorted(set(path for pattern in LUN_FILE_PATTERNS for path in glob.glob(pattern))):
+		try:
+			with open(lun_file) as file:
+				current = file.read().strip()
+		except OSError:
+			continue
+		if not current or os.path.realpath(current) != image_path:
+			continue
+		forced_eject = os.path.join(os.path.dirname(lun_file), "forced_eject")
+		if os.path.exists(forced_eject):
+			# ejects even if the printer prevents medium removal
+			_write_sysfs(forced_eject, "1")
+		else:
+			_write_sysfs(lun_file, "")
+		_write_sysfs(lun_file, image_path)
+		changed = True
+	return changed
+
+
+class FatImage():
+	"""
+	Adds and deletes files in the root directory of a FAT32 image without
+	mounting it, as served by the USB mass storage gadget to the printer.
+
+	Only the data clusters of a file, its directory entries, the FAT
+	sectors of its cluster chain and the free cluster count are written,
+	data first and directory entries last, so an interrupted update leaves
+	lost clusters at worst. Files are stored in one contiguous run of
+	clusters if the image has one free.
+
+	The image must not be mounted at the same time, the kernel would not
+	see these writes and overwrite them from its cache.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._logger = logging.getLogger(__name__)
+		self._lock = threading.Lock()
+		self._fd = None
+
+	def list_files(self) -> List[DirectoryEntry]:
+		with self._lock, self._opened(write=False):
+			return [entry for entry in self._entries() if not entry.is_directory]
+
+	def has_file(self, name: str) -> bool:
+		with self._lock, self._opened(write=False):
+			return self._find(name) is not None
+
+	def add_file(self, name: str, source_path):
+		"""Copies source_path into the image as name, replacing a file of that name."""
+		size = os.path.getsize(source_path)
+		if size > MAX_FILE_SIZE:
+			raise FatImageError("{} is too large for FAT32".format(name))
+		if "/" in name or "\\" in name or name in ("", ".", ".."):
+			raise FatImageError("Invalid file name {}".format(name))
+
+		with self._lock, self._opened(write=True):
+			existing = self._find(name)
+			if existing is not None and existing.is_directory:
+				raise FatImageError("{} is a folder".format(name))
+
+			count = -(-size // self._cluster_size)
+			if existing is not None and count > self._free_clusters():
+				# no room for both, the old file goes first
+				self._delete(existing)
+				existing = None
+			clusters = self._allocate(count)
+			self._copy(source_path, clusters, size)
+			self._link(clusters)
+
+			first_cluster = int(clusters[0]) if len(clusters) else 0
+			entries = self._make_entries(name, existing, first_cluster, size)
+			if existing is not None:
+				self._mark_deleted(existing)
+			slots = self._free_slots(len(entries))
+			for slot, entry in zip(slots, entries):
+				self._set_entry(slot, entry)
+
+			# data, then the new chain, then the entries pointing at it
+			os.fdatasync(self._fd)
+			self._write_fat()
+			self._write_directory()
+			if existing is not None:
+				self._free(existing.first_cluster)
+				self._write_fat()
+			self._write_free_count()
+			os.fdatasync(self._fd)
+		self._logger.info("Added {} ({} bytes, {} clusters) to {}".format(name, size, len(clusters), self.path))
+
+	def delete_file(self, name: str) -> bool:
+		"""Deletes name from the image, returns False if there is no such file."""
+		with self._lock, self._opened(write=True):
+			existing = self._find(name)
+			if existing is None:
+				return False
+			if existing.is_directory:
+				raise FatImageError("{} is a folder".format(name))
+			self._delete(existing)
+			os.fdatasync(self._fd)
+		self._logger.info("Deleted {} from {}".format(name, self.path))
+		return True
+
+	@contextlib.contextmanager
+	def _opened(self, write: bool):
+		"""Opens the image and reads its geometry, FAT and root directory."""
+		import numpy as np
+		if write and is_loop_mounted(self.path):
+			raise FatImageError("{} is mounted, unmount it first".format(self.path))
+		self._fd = os.open(self.path, os.O_RDWR if write else os.O_RDONLY)
+		try:
+			self._read_geometry()
+			fat = os.pread(self._fd, (self._cluster_count + 2) * 4, self._fat_offset)
+			self._fat: "np.ndarray" = np.frombuffer(fat, dtype="<u4").copy()
+			self._dirty_fat_sectors: Set[int] = set()
+			self._directory_clusters = self._chain(self._root_cluster)
+			self._directory = bytearray(b"".join(
+				os.pread(self._fd, self._cluster_size, self._cluster_offset(cluster))
+				for cluster in self._directory_clusters))
+			self._dirty_slots: Set[int] = set()
+			yield
+		finally:
+			os.close(self._fd)
+			self._fd = None
+
+	def _read_geometry(self):
+		boot = os.pread(self._fd, 512, 0)
+		if len(boot) < 512 or boot[510:512] != b"\x55\xaa":
+			raise FatImageError("{} has no FAT boot sector".format(self.path))
+		(bytes_per_sector, sectors_per_cluster, reserved_sectors, fat_count,
+			root_entries, total_sectors_16, _, fat_size_16) = struct.unpack_from("<HBHBHHBH", boot, 11)
+		(total_sectors_32, fat_size, ext_flags, _, root_cluster, fs_info_sector) = struct.unpack_from(
+			"<IIHHIH", boot, 32)
+		if root_entries or fat_size_16 or not fat_size or not bytes_per_sector or not sectors_per_cluster:
+			raise FatImageError("{} is not a FAT32 image".format(self.path))
+
+		self._sector_size = bytes_per_sector
+		self._cluster_size = bytes_per_sector * sectors_per_cluster
+		self._fat_offset = reserved_sectors * bytes_per_sector
+		self._fat_size = fat_size * bytes_per_sector
+		data_sectors = (total_sectors_16 or total_sectors_32) - reserved_sectors - fat_count * fat_size
+		self._data_offset = (reserved_sectors + fat_count * fat_size) * bytes_per_sector
+		self._cluster_count = min(data_sectors // sectors_per_cluster, self._fat_size // 4 - 2)
+		self._root_cluster = root_cluster
+		self._fs_info_offset = fs_info_sector * bytes_per_sector if 0 < fs_info_sector < reserved_sectors else None
+		# with mirroring disabled only the active FAT is used
+		self._fats = [ext_flags & 0x0F] if ext_flags & 0x80 else list(range(fat_count))
+
+	def _cluster_offset(self, cluster: int) -> int:
+		return self._data_offset + (cluster - 2) * self._cluster_size
+
+	def _chain(self, cluster: int) -> List[int]:
+		chain = []
+		while 2 <= cluster < MIN_END_OF_CHAIN:
+			if cluster >= len(self._fat) or len(chain) > self._cluster_count:
+				raise FatImageError("Broken cluster chain in {}".format(self.path))
+			chain.append(cluster)
+			cluster = int(self._fat[cluster]) & FAT_MASK
+		return chain
+
+	def _entries(self) -> Iterator[DirectoryEntry]:
+		long_name_parts: List[bytes] = []
+		long_name_slots: List[int] = []
+		long_name_checksum = None
+		for slot in range(len(self._directory) // DIR_ENTRY.size):
+			raw = self._directory[slot * DIR_ENTRY.size:(slot + 1) * DIR_ENTRY.size]
+			if raw[0] == END_OF_DIRECTORY:
+				return
+			if raw[0] == DELETED:
+				long_name_parts, long_name_slots = [], []
+				continue
+			if raw[11] & 0x3F == ATTR_LONG_NAME:
+				order, name_1, _, _, checksum, name_2, _, name_3 = LFN_ENTRY.unpack(raw)
+				if order & LAST_LFN:
+					long_name_parts, long_name_slots, long_name_checksum = [], [], checksum
+				long_name_parts.append(name_1 + name_2 + name_3)
+				long_name_slots.append(slot)
+				continue
+
+			(short, attributes, flags, _, _, _, _, cluster_high, _, _, cluster_low, size) = DIR_ENTRY.unpack(raw)
+			name = display_short_name(short, flags)
+			slots = (slot,)
+			if long_name_parts and long_name_checksum == short_name_checksum(short):
+				name = b"".join(reversed(long_name_parts)).decode("utf-16-le", "replace").split("\x00")[0]
+				slots = tuple(long_name_slots) + slots
+			long_name_parts, long_name_slots = [], []
+			if not attributes & ATTR_VOLUME_ID:
+				yield DirectoryEntry(name, short, attributes, (cluster_high << 16) | cluster_low, size, slots)
+
+	def _find(self, name: str) -> Optional[DirectoryEntry]:
+		name = name.lower()
+		for entry in self._entries():
+			if entry.name.lower() == name or display_short_name(entry.short_name, 0).lower() == name:
+				return entry
+		return None
+
+	def _make_entries(self, name, existing, first_cluster, size) -> List[bytes]:
+		short_names = set(entry.short_name for entry in self._entries() if entry != existing)
+		if existing is not None and existing.name == name:
+			short, needs_long_name = existing.short_name, len(existing.slots) > 1
+		else:
+			short, needs_long_name = short_name(name, short_names)
+		date, time = fat_timestamp(datetime.datetime.now())
+		entry = DIR_ENTRY.pack(
+			short, ATTR_ARCHIVE, 0, 0, time, date, date, first_cluster >> 16, time, date, first_cluster & 0xFFFF, size)
+		return (long_name_entries(name, short) if needs_long_name else []) + [entry]
+
+	def _allocate(self, count: int) -> "np.ndarray":
+		"""count free clusters, the first run of count contiguous ones if there is one."""
+		import numpy as np
+		if count == 0:
+			return np.zeros(0, dtype=np.int64)
+		free = np.flatnonzero((self._fat[2:] & FAT_MASK) == 0) + 2
+		if len(free) < count:
+			raise FatImageError("{} has {} bytes free, {} needed".format(
+				self.path, len(free) * self._cluster_size, count * self._cluster_size))
+		breaks = np.flatnonzero(np.diff(free) != 1) + 1
+		starts = np.concatenate(([0], breaks))
+		ends = np.concatenate((breaks, [len(free)]))
+		runs = np.flatnonzero(ends - starts >= count)
+		if len(runs):
+			start = starts[runs[0]]
+			return free[start:start + count]
+		return free[:count]
+
+	def _free_clusters(self) -> int:
+		import numpy as np
+		return int(np.count_nonzero((self._fat[2:] & FAT_MASK) == 0))
+
+	def _delete(self, entry: DirectoryEntry):
+		self._mark_deleted(entry)
+		self._write_directory()
+		self._free(entry.first_cluster)
+		self._write_fat()
+		self._write_free_count()
+
+	def _set_fat(self, cluster: int, value: int):
+		self._fat[cluster] = (int(self._fat[cluster]) & ~FAT_MASK & 0xFFFFFFFF) | value
+		self._dirty_fat_sectors.add(cluster * 4 // self._sector_size)
+
+	def _link(self, clusters):
+		for cluster, following in zip(clusters[:-1], clusters[1:]):
+			self._set_fat(int(cluster), int(following))
+		if len(clusters):
+			self._set_fat(int(clusters[-1]), END_OF_CHAIN)
+
+	def _free(self, first_cluster: int):
+		for cluster in self._chain(first_cluster):
+			self._set_fat(cluster, 0)
+
+	def _copy(self, source_path, clusters, size: int):
+		"""Copies the file into clusters, one write per contiguous run of them."""
+		import numpy as np
+		runs = np.split(clusters, np.flatnonzero(np.diff(clusters) != 1) + 1) if len(clusters) else []
+		source = os.open(source_path, os.O_RDONLY)
+		try:
+			position = 0
+			for run in runs:
+				length = min(len(run) * self._cluster_size, size - position)
+				self._copy_range(source, position, self._cluster_offset(int(run[0])), length)
+				position += length
+		finally:
+			os.close(source)
+
+	def _copy_range(self, source, source_offset: int, offset: int, length: int):
+		end = source_offset + length
+		while source_offset < end:
+			count = min(end - source_offset, COPY_CHUNK_SIZE * 64)
+			try:
+				copied = os.copy_file_range(source, self._fd, count, source_offset, offset)
+			except (AttributeError, OSError) as e:
+				if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+					raise
+				# no in kernel copy, e.g. across file systems before Linux 5.3
+				copied = os.pwrite(self._fd, os.pread(source, min(count, COPY_CHUNK_SIZE), source_offset), offset)
+			if copied <= 0:
+				raise FatImageError("{} changed while copying it".format(source))
+			source_offset += copied
+			offset += copied
+
+	def _free_slots(self, count: int) -> List[int]:
+		"""Indexes of count consecutive free directory entries, growing the directory if needed."""
+		while True:
+			run = []
+			for slot in range(len(self._directory) // DIR_ENTRY.size):
+				if self._directory[slot * DIR_ENTRY.size] in (END_OF_DIRECTORY, DELETED):
+					run.append(slot)
+					if len(run) == count:
+						return run
+				else:
+					run = []
+			self._grow_directory()
+
+	def _grow_directory(self):
+		cluster = int(self._allocate(1)[0])
+		os.pwrite(self._fd, bytes(self._cluster_size), self._cluster_offset(cluster))
+		self._set_fat(self._directory_clusters[-1], cluster)
+		self._set_fat(cluster, END_OF_CHAIN)
+		self._directory_clusters.append(cluster)
+		self._directory += bytes(self._cluster_size)
+
+	def _set_entry(self, slot: int, entry: bytes):
+		self._directory[slot * DIR_ENTRY.size:(slot + 1) * DIR_ENTRY.size] = entry
+		self._dirty_slots.add(slot)
+
+	def _mark_deleted(self, entry: DirectoryEntry):
+		for slot in entry.slots:
+			self._directory[slot * DIR_ENTRY.size] = DELETED
+			self._dirty_slots.add(slot)
+
+	def _write_fat(self):
+		sectors = sorted(self._dirty_fat_sectors)
+		self._dirty_fat_sectors = set()
+		entries_per_sector = self._sector_size // 4
+		start = 0
+		while start < len(sectors):
+			end = start + 1
+			while end < len(sectors) and sectors[end] == sectors[end - 1] + 1:
+				end += 1
+			data = self._fat[sectors[start] * entries_per_sector:(sectors[end - 1] + 1) * entries_per_sector].tobytes()
+			for fat in self._fats:
+				os.pwrite(self._fd, data, self._fat_offset + fat * self._fat_size + sectors[start] * self._sector_size)
+			start = end
+
+	def _write_directory(self):
+		entries_per_cluster = self._cluster_size // DIR_ENTRY.size
+		for slot in sorted(self._dirty_slots):
+			cluster = self._directory_clusters[slot // entries_per_cluster]
+			offset = self._cluster_offset(cluster) + (slot % entries_per_cluster) * DIR_ENTRY.size
+			os.pwrite(self._fd, self._directory[slot * DIR_ENTRY.size:(slot + 1) * DIR_ENTRY.size], offset)
+		self._dirty_slots = set()
+
+	def _write_free_count(self):
+		"""Updates the free cluster count and next free hint of the FSInfo sector, if it is valid."""
+		import numpy as np
+		if self._fs_info_offset is None:
+			return
+		fs_info = os.pread(self._fd, 512, self._fs_info_offset)
+		if fs_info[:4] != b"RRaA" or fs_info[484:488] != b"rrAa":
+			return
+		free = np.flatnonzero((self._fat[2:] & FAT_MASK) == 0)
+		next_free = int(free[0]) + 2 if len(free) else 0xFFFFFFFF
+		os.pwrite(self._fd, struct.pack("<II", len(free), next_free), self._fs_info_offset + 488)
@@ -1,10 +1,45 @@
 import pathlib
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Sequence, Tuple
+from functools import cached_property
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
 
-import png
+if TYPE_CHECKING:
+	# numpy and png are only loaded with the format modules
+	import png
 
+	import numpy as np
+
+	from .layers import LayerIndex, LayerSource, LayerTable, MappedLayers
+
+# longest printer name read_header reads, guards against corrupt offsets
+MAX_PRINTER_NAME_SIZE = 1024
+
+
+class ReadAborted(Exception):
+	"""Raised by SlicedModelFile.read once its is_aborted returns True."""
+
+
+@dataclass(frozen=True)
+class SlicedModelHeader:
+	"""
+	Print settings of a sliced file as stored in its headers, returned by
+	SlicedModelFile.read_header without reading the layer table or images.
+	"""
+	filename: str
+	bed_size_mm: Tuple[float, float, float]
+	height_mm: float
+	layer_height_mm: float
+	layer_count: int
+	resolution: Tuple[int, int]
+	print_time_secs: int
+	volume: float
+	layer_exposure_secs: float
+	bottom_exposure_secs: float
+	bottom_layer_count: int
+	layer_off_time_secs: float
+	slicer_version: str
+	printer_name: str
 
 @dataclass(frozen=True)
 class SlicedModelFile(ABC):
@@ -16,23 +51,78 @@ class SlicedModelFile(ABC):
 	resolution: Tuple[int, int]
 	print_time_secs: int
 	volume: int
-	end_byte_offset_by_layer: Sequence[int]
+	layer_table: "LayerTable"
 	slicer_version: str
 	printer_name: str
 	printing_area: dict
 	dimensions: dict
 
+	@property
+	def end_byte_offset_by_layer(self) -> "np.ndarray":
+		return self.layer_table.end_offsets
+
+	@cached_property
+	def layer_index(self) -> "LayerIndex":
+		"""
+		Sorted index over end_byte_offset_by_layer, built once per file.
+		"""
+		from .layers import LayerIndex
+		return LayerIndex(self.layer_table.end_offsets)
+
+	def locate_layer(self, position: int) -> Tuple[int, float]:
+		"""
+		1 based layer number at byte position and the fraction of that
+		layer's image that has been read.
+		"""
+		if not len(self.layer_table):
+			raise ValueError("{} has no layers".format(self.filename))
+		layer, fraction = self.layer_index.locate(position)
+		return layer + 1, fraction
+
+	@classmethod
+	@abstractmethod
+	def read(self, path: pathlib.Path, is_aborted: Optional[Callable[[], bool]] = None) -> "SlicedModelFile":
+		"""
+		Reads the headers, the layer table and the first layer of the file
+		at path. is_aborted is polled while the layer table is read and
+		before the layer is decoded, ReadAborted is raised if it returns
+		True.
+		"""
+		...
+
 	@classmethod
 	@abstractmethod
-	def read(self, path: pathlib.Path) -> "SlicedModelFile":
+	def read_header(cls, path: pathlib.Path) -> SlicedModelHeader:
+		"""
+		Reads only the fixed size headers of the file at path, its cost does
+		not depend on the layer count. For file lists and uploads, use read
+		for the offset table and the printing area.
+		"""
 		...
 
 	@classmethod
 	@abstractmethod
-	def read_preview(cls, path: pathlib.Path) -> png.Image:
+	def read_preview(cls, path: pathlib.Path) -> "png.Image":
 		...
 		
 	@classmethod
 	@abstractmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "SlicedModelFile":
 		...
+
+	@classmethod
+	@abstractmethod
+	def layer_source(cls, path: pathlib.Path) -> "LayerSource":
+		...
+
+	@classmethod
+	def open_layers(cls, path: pathlib.Path) -> "MappedLayers":
+		"""
+		Memory-maps the file at path for random access to its layers, to
+		be used as a context manager:
+
+			with CTBFile.open_layers(path) as layers:
+				image = layers.decode_layer(42)
+		"""
+		from .layers import MappedLayers
+		return MappedLayers(path, cls.layer_source(path))
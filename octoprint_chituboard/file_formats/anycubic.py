@@ -0,0 +1,39 @@
+import os
+from typing import Tuple
+
+# (name, extension, resolution, pixel size in um, bed size in mm) of the
+# Anycubic printers, models sharing an LCD are told apart by the extension
+ANYCUBIC_PRINTERS: Tuple[Tuple[str, str, Tuple[int, int], float, Tuple[float, float, float]], ...] = (
+	("Anycubic Photon S", ".pws", (1440, 2560), 47.25, (68.04, 120.96, 165)),
+	("Anycubic Photon Zero", ".pw0", (480, 854), 115.5, (55.44, 98.64, 150)),
+	("Anycubic Photon Mono", ".pwmo", (1620, 2560), 51.0, (82.62, 130.56, 165)),
+	("Anycubic Photon Mono SE", ".pwms", (1620, 2560), 51.0, (82.62, 130.56, 160)),
+	("Anycubic Photon Mono X", ".pwmx", (3840, 2400), 50.0, (192, 120, 245)),
+)
+# printer of files neither the header nor the extension names one for
+UNKNOWN_PRINTER_INFO: Tuple[str, float, float, float] = ("Anycubic Photon", 68.04, 120.96, 165)
+
+# how far the pixel size of a file may be off from its printer's
+PIXEL_SIZE_TOLERANCE_UM = 0.5
+
+
+def printer_info(resolution_x: int, resolution_y: int, pixel_size_um: float, filename: str) -> Tuple[str, float, float, float]:
+	"""
+	Name and bed size (x, y, z) of the printer a file was sliced for, found
+	by the resolution and pixel size in its header. The extension only
+	decides between printers with the same LCD, or if no printer matches,
+	e.g. for files from a slicer profile of a printer not listed here.
+	"""
+	(_, extension) = os.path.splitext(filename)
+	extension = extension.lower()
+	matches = [
+		printer for printer in ANYCUBIC_PRINTERS
+		if sorted(printer[2]) == sorted((resolution_x, resolution_y))
+		and abs(printer[3] - pixel_size_um) <= PIXEL_SIZE_TOLERANCE_UM
+	]
+	if not matches:
+		matches = [printer for printer in ANYCUBIC_PRINTERS if printer[1] == extension]
+	if not matches:
+		return UNKNOWN_PRINTER_INFO
+	name, _, _, _, bed_size = next((printer for printer in matches if printer[1] == extension), matches[0])
+	return (name,) + bed_size
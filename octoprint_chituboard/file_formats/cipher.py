@@ -1,6 +1,21 @@
 from dataclasses import dataclass
 import numpy as np
 
+MASK32: int = 0xffffffff
+
+def _keystream(initial: int, key: int, index: int, length: int) -> np.ndarray:
+	"""
+	Returns ``length`` keystream bytes starting at byte ``index`` of ``key``.
+	The keystream is the little endian byte sequence of the 32-bit words
+	key, key + initial, key + 2*initial, ... so all words of a layer are
+	generated at once with wrapping uint32 arithmetic.
+	"""
+	words = np.arange((index + length + 3) // 4, dtype=np.uint32)
+	words *= np.uint32(initial)
+	words += np.uint32(key)
+	stream = words.astype("<u4", copy=False).view(np.uint8)
+	return stream[index:index + length]
+
 
 @dataclass
 class Keyring86:
@@ -10,33 +25,34 @@ class Keyring86:
 
 # Key encoding provided by:
 # https://github.com/cbiffle/catibo/blob/master/doc/cbddlp-ctb.adoc
-	@classmethod
 	def __init__(self, seed: int, slicenum: int):
-		initial = int(seed)*int(0x2d83cdac) + int(0xd8a83423)
-		key = (int(slicenum*int(0x1e1530cd)) + int(0xec3d47cd)) * int(initial)
-		self.initial = int(initial)
-		self.key =  int(key)
+		initial = (int(seed)*0x2d83cdac + 0xd8a83423) & MASK32
+		key = ((int(slicenum)*0x1e1530cd + 0xec3d47cd) * initial) & MASK32
+		self.initial = initial
+		self.key = key
 		self.index = 0
-	
-	@classmethod
+
+	def _advance(self, count: int):
+		position = self.index + count
+		self.key = (self.key + self.initial * (position >> 2)) & MASK32
+		self.index = position & 3
+
 	def Next(self) -> bytes:
-		k = int(self.key >> int((8 * self.index)))
-		self.index += 1
-		if self.index&3 == 0:
-			self.key = int(self.key + self.initial)
-			self.index = 0
-		return k.to_bytes((k.bit_length() + 7) // 8, 'little')
-		#return k.to_bytes(4,'little')
-		#return k.tobytes()
-
-	@classmethod
+		k = (self.key >> (8 * self.index)) & 0xff
+		self._advance(1)
+		return bytes([k])
+
 	def Read(self, data: bytes) -> bytes:
-		out = bytearray()
-		for i in data:
-			temp = self.Next()
-			out.extend([i^temp[0]])
-		return bytes(out)
-		
+		"""
+		XORs ``data`` with the keystream in a single vector operation.
+		State lives on the instance, so several layers can be decrypted
+		concurrently with their own keyrings.
+		"""
+		buf = np.frombuffer(data, dtype=np.uint8)
+		out = np.bitwise_xor(buf, _keystream(self.initial, self.key, self.index, len(buf)))
+		self._advance(len(buf))
+		return out.tobytes()
+
 def cipher86(seed, slicenum, data):
 	if seed == 0:
 		return data
@@ -54,33 +70,33 @@ class KeyringFDG:
 
 # Key encoding provided by:
 # https://github.com/cbiffle/catibo/blob/master/doc/cbddlp-ctb.adoc
-	@classmethod
 	def __init__(self, seed: int, slicenum: int):
-		initial = int(seed)-int(0x1dcb76c3) ^ int(0x257e2431)
-		key = int(initial*int(0x82391efd)) * int(slicenum ^ int(0x110bdacd))
-		self.initial = int(initial)
-		self.key =  int(key)
+		initial = ((int(seed) - 0x1dcb76c3) ^ 0x257e2431) & MASK32
+		key = (initial * 0x82391efd * (int(slicenum) ^ 0x110bdacd)) & MASK32
+		self.initial = initial
+		self.key = key
 		self.index = 0
-	
-	@classmethod
+
+	def _advance(self, count: int):
+		position = self.index + count
+		self.key = (self.key + self.initial * (position >> 2)) & MASK32
+		self.index = position & 3
+
 	def Next(self) -> bytes:
-		k = int(self.key >> int((8 * self.index)))
-		self.index += 1
-		if self.index&3 == 0:
-			self.key = int(self.key + self.initial)
-			self.index = 0
-		return k.to_bytes((k.bit_length() + 7) // 8, 'little')
-		#return k.to_bytes(4,'little')
-		#return k.tobytes()
-
-	@classmethod
+		k = (self.key >> (8 * self.index)) & 0xff
+		self._advance(1)
+		return bytes([k])
+
 	def Read(self, data: bytes) -> bytes:
-		out = bytearray()
-		for i in data:
-			temp = self.Next()
-			out.extend([i^temp[0]])
-		return bytes(out)
-		
+		"""
+		XORs ``data`` with the keystream in a single vector operation,
+		see :meth:`Keyring86.Read`.
+		"""
+		buf = np.frombuffer(data, dtype=np.uint8)
+		out = np.bitwise_xor(buf, _keystream(self.initial, self.key, self.index, len(buf)))
+		self._advance(len(buf))
+		return out.tobytes()
+
 def cipherFDG(seed, slicenum, data):
 	if seed == 0:
 		return data
@@ -88,4 +104,3 @@ def cipherFDG(seed, slicenum, data):
 		kr = KeyringFDG(seed,slicenum)
 		out = kr.Read(data)
 		return out
-
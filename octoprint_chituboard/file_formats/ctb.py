@@ -1,14 +1,14 @@
 import pathlib
-import struct
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Optional
 import numpy as np
 
 import png
 from typedstruct import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import MAX_PRINTER_NAME_SIZE, SlicedModelFile, SlicedModelHeader
 from .cipher import cipher86
+from .layers import LayerSource, LayerTable, bottom_layers, raise_if_aborted, read_layer_defs
 from .rle import *
 
 @dataclass(frozen=True)
@@ -106,6 +106,19 @@ class CTBLayerDef(LittleEndianStruct):
 	unknown_02: int = StructType.uint32()
 	unknown_03: int = StructType.uint32()
 
+# CTBLayerDef as numpy record, used to parse the whole table in one read
+CTB_LAYER_DEF = np.dtype([
+	("layer_height_mm", "<f4"),
+	("layer_exposure", "<f4"),
+	("layer_off_time", "<f4"),
+	("image_offset", "<u4"),
+	("image_length", "<u4"),
+	("unknown_01", "<u4"),
+	("image_info_size", "<u4"),
+	("unknown_02", "<u4"),
+	("unknown_03", "<u4"),
+])
+
 
 @dataclass(frozen=True)
 class CTBPreview(LittleEndianStruct):
@@ -115,62 +128,16 @@ class CTBPreview(LittleEndianStruct):
 	image_length: int = StructType.uint32()
 
 
-REPEAT_RGB15_MASK: int = 1 << 5
-
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	""" 
-	Decodes a RLE byte array from PhotonFile object to a pygame surface.
-	Based on https://github.com/Reonarudo/pcb2photon/issues/2
-	Encoding scheme:
-	The color (R,G,B) of a pixel spans 2 bytes (little endian) and each 
-	color component is 5 bits: RRRRR GGG GG X BBBBB
-	If the X bit is set, then the next 2 bytes (little endian) masked
-	with 0xFFF represents how many more times to repeat that pixel.
-	"""
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		# Combine 2 bytes Little Endian so we get RRRRR GGG GG X BBBBB (and advance read byte counter)
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-			
-		# Retrieve color components and make pygame color tuple
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		# If the X bit is set, then the next 2 bytes (little endian) 
-		# masked with 0xFFF represents how many more times to repeat that pixel.
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-	
 def _read_layer(width: int, height: int, seed:int, layernum:int, data: bytes) -> png.Image:
 	#data = cipher86(np.uint32(seed),np.uint32(layernum),data)
 	data = cipher86(seed,layernum,data)
 	
 	return read_rle7image(width, height, data)
 
-def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes):
+def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes, out=None):
 	#data = cipher(np.uint32(seed),np.uint32(layernum),data)
 	data = cipher86(seed,layernum,data)
-	return read_rle7array(width, height, data)
+	return decode_rle7(width, height, data, out)
 	
 def get_printarea(resolution,header,image):
 	resolutionX = header.resolution_x
@@ -195,10 +162,23 @@ def get_printarea(resolution,header,image):
 	return results
 
 
+def _layer_table(header, param, layer_defs) -> LayerTable:
+	count = len(layer_defs)
+	return LayerTable(
+		image_offset=layer_defs["image_offset"],
+		image_length=layer_defs["image_length"],
+		position_z_mm=layer_defs["layer_height_mm"],
+		exposure_secs=layer_defs["layer_exposure"],
+		off_time_secs=layer_defs["layer_off_time"],
+		lift_height_mm=bottom_layers(count, header.bottom_count, param.bottom_lift_height, param.lift_height),
+		lift_speed_mm_min=bottom_layers(count, header.bottom_count, param.bottom_lift_speed, param.lift_Speed),
+		retract_speed_mm_min=param.retract_Speed,
+	)
+
 @dataclass(frozen=True)
 class CTBFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "CTBFile":
+	def read(self, path: pathlib.Path, is_aborted: Optional[Callable[[], bool]] = None) -> "CTBFile":
 		with open(str(path), "rb") as file:
 			ctb_header = CTBHeader.unpack(file.read(CTBHeader.get_size()))
 			
@@ -211,19 +191,18 @@ class CTBFile(SlicedModelFile):
 			file.seek(ctb_slicer.machine_offset)
 			printer_name = file.read(ctb_slicer.machine_size).decode()
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, ctb_header.layer_count):
-				file.seek(ctb_header.layer_defs_offset + layer * CTBLayerDef.get_size())
-				layer_def = CTBLayerDef.unpack(file.read(CTBLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
-			
-			file.seek(ctb_header.layer_defs_offset + 0 * CTBLayerDef.get_size())
-			first_layer = CTBLayerDef.unpack(file.read(CTBLayerDef.get_size()))
+			layer_defs = read_layer_defs(
+				file,
+				ctb_header.layer_defs_offset,
+				ctb_header.layer_count,
+				CTB_LAYER_DEF,
+				is_aborted=is_aborted,
+			)
+			layer_table = _layer_table(ctb_header, ctb_param, layer_defs)
 			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			raise_if_aborted(is_aborted)
+			file.seek(int(layer_defs["image_offset"][0]))
+			data = file.read(int(layer_defs["image_length"][0]))
 			results = {}
 			image = _read_layer_array(
 				ctb_header.resolution_x,
@@ -232,7 +211,7 @@ class CTBFile(SlicedModelFile):
 				0,
 				data)
 			#try:
-			imlayer = np.array(image)
+			imlayer = np.asarray(image)
 			results = get_printarea(imlayer.shape,ctb_header,imlayer)
 			#except:
 			#	results["printing_area"] = {'minX': 0.0, 'minY': 0.0}
@@ -251,7 +230,7 @@ class CTBFile(SlicedModelFile):
 				resolution=(ctb_header.resolution_x, ctb_header.resolution_y),
 				print_time_secs=ctb_header.print_time,
 				volume=ctb_param.volume_ml,
-				end_byte_offset_by_layer=end_byte_offset_by_layer,
+				layer_table=layer_table,
 				slicer_version=".".join(
 					[
 						str(ctb_slicer.version_release),
@@ -265,6 +244,48 @@ class CTBFile(SlicedModelFile):
 				dimensions = results["dimensions"],
 			)
 	
+	@classmethod
+	def read_header(cls, path: pathlib.Path) -> SlicedModelHeader:
+		with open(str(path), "rb") as file:
+			ctb_header = CTBHeader.unpack(file.read(CTBHeader.get_size()))
+
+			file.seek(ctb_header.param_offset)
+			ctb_param = CTBParam.unpack(file.read(CTBParam.get_size()))
+
+			file.seek(ctb_header.slicer_offset)
+			ctb_slicer = CTBSlicer.unpack(file.read(CTBSlicer.get_size()))
+
+			file.seek(ctb_slicer.machine_offset)
+			printer_name = file.read(min(ctb_slicer.machine_size, MAX_PRINTER_NAME_SIZE)).decode()
+
+		return SlicedModelHeader(
+			filename=path.name,
+			bed_size_mm=(
+				round(ctb_header.bed_size_x_mm, 4),
+				round(ctb_header.bed_size_y_mm, 4),
+				round(ctb_header.bed_size_z_mm, 4),
+			),
+			height_mm=ctb_header.height_mm,
+			layer_height_mm=ctb_header.layer_height_mm,
+			layer_count=ctb_header.layer_count,
+			resolution=(ctb_header.resolution_x, ctb_header.resolution_y),
+			print_time_secs=ctb_header.print_time,
+			volume=ctb_param.volume_ml,
+			layer_exposure_secs=ctb_header.layer_exposure,
+			bottom_exposure_secs=ctb_header.bottom_exposure,
+			bottom_layer_count=ctb_header.bottom_count,
+			layer_off_time_secs=ctb_header.layer_off_time,
+			slicer_version=".".join(
+				[
+					str(ctb_slicer.version_release),
+					str(ctb_slicer.version_major),
+					str(ctb_slicer.version_minor),
+					str(ctb_slicer.version_patch),
+				]
+			),
+			printer_name=printer_name,
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "CTBFile":
 		with open(str(path), "rb") as file:
@@ -276,13 +297,13 @@ class CTBFile(SlicedModelFile):
 			file.seek(ctb_header.slicer_offset)
 			ctb_slicer = CTBSlicer.unpack(file.read(CTBSlicer.get_size()))
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, ctb_header.layer_count):
-				file.seek(ctb_header.layer_defs_offset + layer * CTBLayerDef.get_size())
-				layer_def = CTBLayerDef.unpack(file.read(CTBLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_defs(
+				file,
+				ctb_header.layer_defs_offset,
+				ctb_header.layer_count,
+				CTB_LAYER_DEF,
+			)
+			layer_table = _layer_table(ctb_header, ctb_param, layer_defs)
 
 			voume_ml = metadata["filament"]["tool0"]["volume"]
 			return CTBFile(
@@ -298,7 +319,7 @@ class CTBFile(SlicedModelFile):
 					resolution=(ctb_header.resolution_x, ctb_header.resolution_y),
 					print_time_secs = metadata["estimatedPrintTime"],
 					volume=metadata["filament"]["tool0"]["volume"],
-					end_byte_offset_by_layer=end_byte_offset_by_layer,
+					layer_table=layer_table,
 					slicer_version=".".join(
 						[
 							str(ctb_slicer.version_release),
@@ -312,6 +333,38 @@ class CTBFile(SlicedModelFile):
 					dimensions = metadata["dimensions"],
 				)
 
+	@classmethod
+	def layer_source(cls, path: pathlib.Path) -> LayerSource:
+		with open(str(path), "rb") as file:
+			ctb_header = CTBHeader.unpack(file.read(CTBHeader.get_size()))
+			layer_defs = read_layer_defs(
+				file,
+				ctb_header.layer_defs_offset,
+				ctb_header.layer_count,
+				CTB_LAYER_DEF,
+			)
+
+		def decode(index, data, out):
+			return _read_layer_array(
+				ctb_header.resolution_x,
+				ctb_header.resolution_y,
+				ctb_header.encryption_seed,
+				index,
+				data,
+				out)
+
+		return LayerSource(
+			ctb_header.resolution_x,
+			ctb_header.resolution_y,
+			(
+				ctb_header.bed_size_x_mm/ctb_header.resolution_x,
+				ctb_header.bed_size_y_mm/ctb_header.resolution_y,
+			),
+			ctb_header.layer_height_mm,
+			layer_defs,
+			decode,
+		)
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
@@ -323,4 +376,4 @@ class CTBFile(SlicedModelFile):
 			file.seek(preview.image_offset)
 			data = file.read(preview.image_length)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_image(preview.resolution_x, preview.resolution_y, data)
@@ -1,13 +1,14 @@
 import pathlib
-import struct
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Optional
 
+import numpy as np
 import png
 from typedstruct import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import MAX_PRINTER_NAME_SIZE, SlicedModelFile, SlicedModelHeader
 from .cipher import cipherFDG
+from .layers import LayerSource, LayerTable, bottom_layers, raise_if_aborted, read_layer_defs
 from .rle import *
 
 @dataclass(frozen=True)
@@ -84,6 +85,19 @@ class FDGLayerDef(LittleEndianStruct):
 	unknown_02: int = StructType.uint32()
 	unknown_03: int = StructType.uint32()
 
+# FDGLayerDef as numpy record, used to parse the whole table in one read
+FDG_LAYER_DEF = np.dtype([
+	("layer_height_mm", "<f4"),
+	("layer_exposure", "<f4"),
+	("layer_off_time", "<f4"),
+	("image_offset", "<u4"),
+	("image_length", "<u4"),
+	("unknown_01", "<u4"),
+	("image_info_size", "<u4"),
+	("unknown_02", "<u4"),
+	("unknown_03", "<u4"),
+])
+
 
 @dataclass(frozen=True)
 class FDGPreview(LittleEndianStruct):
@@ -93,50 +107,16 @@ class FDGPreview(LittleEndianStruct):
 	image_length: int = StructType.uint32()
 
 
-REPEAT_RGB15_MASK: int = 1 << 5
-
-
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-
 def _read_layer(width: int, height: int, seed:int, layernum:int, data: bytes) -> png.Image:
 	#data = cipherFDG(np.uint32(seed),np.uint32(layernum),data)
 	data = cipherFDG(seed,layernum,data)
 	
 	return read_grayimage(width, height, data)
 
-def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes):
+def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes, out=None):
 	#data = cipher(np.uint32(seed),np.uint32(layernum),data)
 	data = cipherFDG(seed,layernum,data)
-	return read_grayarray(width, height, data)
+	return decode_gray(width, height, data, out)
 	
 def get_printarea(resolution,header,image):
 	resolutionX = header.resolution_x
@@ -160,28 +140,40 @@ def get_printarea(resolution,header,image):
 	results["dimensions"] = {"width":width, "depth":depth, "height":height}
 	return results
 
+def _layer_table(header, layer_defs) -> LayerTable:
+	count = len(layer_defs)
+	return LayerTable(
+		image_offset=layer_defs["image_offset"],
+		image_length=layer_defs["image_length"],
+		position_z_mm=layer_defs["layer_height_mm"],
+		exposure_secs=layer_defs["layer_exposure"],
+		off_time_secs=layer_defs["layer_off_time"],
+		lift_height_mm=bottom_layers(count, header.bottom_layer_count, header.bottom_lift_height, header.lift_height),
+		lift_speed_mm_min=bottom_layers(count, header.bottom_layer_count, header.bottom_lift_speed, header.lift_speed),
+		retract_speed_mm_min=header.retract_speed,
+	)
+
 @dataclass(frozen=True)
 class FDGFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "FDGFile":
+	def read(self, path: pathlib.Path, is_aborted: Optional[Callable[[], bool]] = None) -> "FDGFile":
 		with open(str(path), "rb") as file:
 			fdg_header = FDGHeader.unpack(file.read(FDGHeader.get_size()))
 
 			file.seek(fdg_header.machine_offset)
 			printer_name = file.read(fdg_header.machine_size).decode()
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, fdg_header.layer_count):
-				file.seek(fdg_header.layer_defs_offset + layer * FDGLayerDef.get_size())
-				layer_def = FDGLayerDef.unpack(file.read(FDGLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
-			file.seek(fdg_header.layer_defs_offset + 0 * FDGLayerDef.get_size())
-			first_layer = FDGLayerDef.unpack(file.read(FDGLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			layer_defs = read_layer_defs(
+				file,
+				fdg_header.layer_defs_offset,
+				fdg_header.layer_count,
+				FDG_LAYER_DEF,
+				is_aborted=is_aborted,
+			)
+			layer_table = _layer_table(fdg_header, layer_defs)
+			raise_if_aborted(is_aborted)
+			file.seek(int(layer_defs["image_offset"][0]))
+			data = file.read(int(layer_defs["image_length"][0]))
 			results = {}
 			image = _read_layer_array(
 				fdg_header.resolution_x,
@@ -190,7 +182,7 @@ class FDGFile(SlicedModelFile):
 				0,
 				data)
 			#try:
-			imlayer = np.array(image)
+			imlayer = np.asarray(image)
 			results = get_printarea(imlayer.shape,fdg_header,imlayer)
 			
 
@@ -207,7 +199,7 @@ class FDGFile(SlicedModelFile):
 				resolution=(fdg_header.resolution_x, fdg_header.resolution_y),
 				print_time_secs=fdg_header.print_time,
 				volume=fdg_header.volume_milliliters,
-				end_byte_offset_by_layer=end_byte_offset_by_layer,
+				layer_table=layer_table,
 				slicer_version=".".join(
 					[
 						str(fdg_header.slicer_version_release),
@@ -221,6 +213,42 @@ class FDGFile(SlicedModelFile):
 				dimensions = results["dimensions"],
 			)
 			
+	@classmethod
+	def read_header(cls, path: pathlib.Path) -> SlicedModelHeader:
+		with open(str(path), "rb") as file:
+			fdg_header = FDGHeader.unpack(file.read(FDGHeader.get_size()))
+
+			file.seek(fdg_header.machine_offset)
+			printer_name = file.read(min(fdg_header.machine_size, MAX_PRINTER_NAME_SIZE)).decode()
+
+		return SlicedModelHeader(
+			filename=path.name,
+			bed_size_mm=(
+				round(fdg_header.bed_size_x_mm, 4),
+				round(fdg_header.bed_size_y_mm, 4),
+				round(fdg_header.bed_size_z_mm, 4),
+			),
+			height_mm=fdg_header.height_mm,
+			layer_height_mm=fdg_header.layer_height_mm,
+			layer_count=fdg_header.layer_count,
+			resolution=(fdg_header.resolution_x, fdg_header.resolution_y),
+			print_time_secs=fdg_header.print_time,
+			volume=fdg_header.volume_milliliters,
+			layer_exposure_secs=fdg_header.layer_exposure,
+			bottom_exposure_secs=fdg_header.bottom_exposure,
+			bottom_layer_count=fdg_header.bottom_layer_count,
+			layer_off_time_secs=fdg_header.light_off_time,
+			slicer_version=".".join(
+				[
+					str(fdg_header.slicer_version_release),
+					str(fdg_header.slicer_version_major),
+					str(fdg_header.slicer_version_minor),
+					str(fdg_header.slicer_version_patch),
+				]
+			),
+			printer_name=printer_name,
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "FDGFile":
 		with open(str(path), "rb") as file:
@@ -229,13 +257,13 @@ class FDGFile(SlicedModelFile):
 			file.seek(fdg_header.machine_offset)
 			printer_name = file.read(fdg_header.machine_size).decode()
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, fdg_header.layer_count):
-				file.seek(fdg_header.layer_defs_offset + layer * FDGLayerDef.get_size())
-				layer_def = FDGLayerDef.unpack(file.read(FDGLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_defs(
+				file,
+				fdg_header.layer_defs_offset,
+				fdg_header.layer_count,
+				FDG_LAYER_DEF,
+			)
+			layer_table = _layer_table(fdg_header, layer_defs)
 
 			voume_ml = metadata["filament"]["tool0"]["volume"]
 			return FDGFile(
@@ -251,7 +279,7 @@ class FDGFile(SlicedModelFile):
 					resolution=(fdg_header.resolution_x, fdg_header.resolution_y),
 					print_time_secs = metadata["estimatedPrintTime"],
 					volume=metadata["filament"]["tool0"]["volume"],
-					end_byte_offset_by_layer=end_byte_offset_by_layer,
+					layer_table=layer_table,
 					slicer_version=".".join(
 						[
 							str(fdg_header.slicer_version_release),
@@ -265,6 +293,38 @@ class FDGFile(SlicedModelFile):
 					dimensions = metadata["dimensions"],
 				)
 
+	@classmethod
+	def layer_source(cls, path: pathlib.Path) -> LayerSource:
+		with open(str(path), "rb") as file:
+			fdg_header = FDGHeader.unpack(file.read(FDGHeader.get_size()))
+			layer_defs = read_layer_defs(
+				file,
+				fdg_header.layer_defs_offset,
+				fdg_header.layer_count,
+				FDG_LAYER_DEF,
+			)
+
+		def decode(index, data, out):
+			return _read_layer_array(
+				fdg_header.resolution_x,
+				fdg_header.resolution_y,
+				fdg_header.encryption_seed,
+				index,
+				data,
+				out)
+
+		return LayerSource(
+			fdg_header.resolution_x,
+			fdg_header.resolution_y,
+			(
+				fdg_header.bed_size_x_mm/fdg_header.resolution_x,
+				fdg_header.bed_size_y_mm/fdg_header.resolution_y,
+			),
+			fdg_header.layer_height_mm,
+			layer_defs,
+			decode,
+		)
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
@@ -276,4 +336,4 @@ class FDGFile(SlicedModelFile):
 			file.seek(preview.image_offset)
 			data = file.read(preview.image_length)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_image(preview.resolution_x, preview.resolution_y, data)
@@ -0,0 +1,273 @@
+import mmap
+from typing import BinaryIO, Callable, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+from . import ReadAborted
+
+# layer defs read_layer_defs reads between abort checks
+LAYER_DEFS_CHUNK = 4096
+
+
+def raise_if_aborted(is_aborted: Optional[Callable[[], bool]]):
+	if is_aborted is not None and is_aborted():
+		raise ReadAborted()
+
+def read_layer_defs(
+	file: BinaryIO,
+	offset: int,
+	count: int,
+	dtype: np.dtype,
+	is_aborted: Optional[Callable[[], bool]] = None,
+) -> np.ndarray:
+	"""
+	Reads a whole layer definition table and returns it as a structured
+	array with one record per layer, so every field of the layer defs is
+	available as a column. Without is_aborted that is a single read,
+	otherwise it is polled every LAYER_DEFS_CHUNK layers and ReadAborted
+	raised if it returns True.
+	"""
+	file.seek(offset)
+	if is_aborted is None:
+		return np.frombuffer(file.read(count * dtype.itemsize), dtype=dtype, count=count)
+	data = bytearray()
+	for start in range(0, count, LAYER_DEFS_CHUNK):
+		raise_if_aborted(is_aborted)
+		data += file.read(min(LAYER_DEFS_CHUNK, count - start) * dtype.itemsize)
+	return np.frombuffer(bytes(data), dtype=dtype, count=count)
+
+def bottom_layers(count: int, bottom_count: int, bottom_value: float, value: float) -> np.ndarray:
+	"""
+	Per layer column of a setting that the header stores once for the
+	bottom layers and once for the others.
+	"""
+	return np.where(np.arange(count) < bottom_count, bottom_value, value)
+
+
+class LayerTable():
+	"""
+	Per layer print settings of a sliced file, one contiguous read-only
+	array per column, so a file with thousands of layers costs a few
+	bytes per layer instead of a list of Python objects.
+
+	position_z_mm is the height of the build plate after the layer, as
+	the layer defs store it. Speeds are in mm/min whatever unit the file
+	format uses. Columns the file does not store per layer are filled
+	with the value from its header.
+
+	tobytes writes the columns one after the other, frombytes maps them
+	back without copying.
+	"""
+
+	COLUMNS = (
+		("image_offset", "<u4"),
+		("image_length", "<u4"),
+		("position_z_mm", "<f4"),
+		("exposure_secs", "<f4"),
+		("off_time_secs", "<f4"),
+		("lift_height_mm", "<f4"),
+		("lift_speed_mm_min", "<f4"),
+		("retract_speed_mm_min", "<f4"),
+	)
+	ROW_SIZE = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS)
+
+	__slots__ = tuple(name for name, _ in COLUMNS) + ("_end_offsets",)
+
+	def __init__(self, **columns: Union[np.ndarray, float]):
+		"""
+		Takes every column in COLUMNS as keyword argument, scalars are
+		repeated for all layers.
+		"""
+		count = len(columns["image_offset"])
+		for name, dtype in self.COLUMNS:
+			# a read-only view, the caller's array stays writeable
+			column = np.ascontiguousarray(np.broadcast_to(columns.pop(name), (count,)), dtype=dtype).view()
+			column.flags.writeable = False
+			object.__setattr__(self, name, column)
+		if columns:
+			raise TypeError("Unknown layer table columns: {}".format(", ".join(sorted(columns))))
+		object.__setattr__(self, "_end_offsets", None)
+
+	def __setattr__(self, name, value):
+		raise AttributeError("LayerTable is read-only")
+
+	def __len__(self):
+		return len(self.image_offset)
+
+	def __reduce__(self):
+		return type(self).frombytes, (self.tobytes(),)
+
+	@property
+	def end_offsets(self) -> np.ndarray:
+		"""
+		End byte of every layer image, the file position the printer reports
+		once it has finished reading that layer.
+		"""
+		if self._end_offsets is None:
+			end_offsets = self.image_offset.astype(np.int64) + self.image_length
+			end_offsets.flags.writeable = False
+			object.__setattr__(self, "_end_offsets", end_offsets)
+		return self._end_offsets
+
+	@property
+	def layer_heights_mm(self) -> np.ndarray:
+		return np.diff(self.position_z_mm, prepend=np.float32(0))
+
+	def durations_secs(self) -> np.ndarray:
+		"""
+		Seconds every layer takes: its exposure and off time, lifting the
+		plate at the lift speed and lowering it again at the retract speed.
+		Moves without a speed count as instant.
+		"""
+		lift_height = self.lift_height_mm.astype(np.float64)
+		durations = self.exposure_secs + self.off_time_secs.astype(np.float64)
+		for speed in (self.lift_speed_mm_min, self.retract_speed_mm_min):
+			durations += np.divide(lift_height * 60, speed, out=np.zeros_like(lift_height), where=speed > 0)
+		return durations
+
+	def tobytes(self) -> bytes:
+		return b"".join(getattr(self, name).tobytes() for name, _ in self.COLUMNS)
+
+	@classmethod
+	def frombytes(cls, data) -> "LayerTable":
+		count, remainder = divmod(len(data), cls.ROW_SIZE)
+		if remainder:
+			raise ValueError("{} bytes is not a whole number of layers".format(len(data)))
+		columns = {}
+		offset = 0
+		for name, dtype in cls.COLUMNS:
+			columns[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+			offset += count * np.dtype(dtype).itemsize
+		return cls(**columns)
+
+
+class LayerIndex():
+	"""
+	Sorted end byte offsets of the layer images, for looking up the layer
+	the printer is at from the file position it reports.
+
+	A position p belongs to the first layer whose end offset is >= p, i.e.
+	layer i (0 based) spans (end[i - 1], end[i]]. Everything before the end
+	of the first layer, header included, counts as the first layer.
+	"""
+
+	def __init__(self, end_offsets: Sequence[int]):
+		self._ends = np.sort(np.asarray(end_offsets, dtype=np.int64))
+
+	def __len__(self):
+		return len(self._ends)
+
+	def layer_at(self, position: int) -> int:
+		"""
+		0 based index of the layer at byte position, in O(log n). Positions
+		past the last layer map to the last layer.
+		"""
+		return min(int(np.searchsorted(self._ends, position)), len(self._ends) - 1)
+
+	def locate(self, position: int) -> Tuple[int, float]:
+		"""
+		Returns (layer, fraction), the 0 based layer index at byte position
+		and how much of that layer's image has been read, from 0.0 to 1.0.
+		"""
+		layer = self.layer_at(position)
+		start = int(self._ends[layer - 1]) if layer > 0 else 0
+		end = int(self._ends[layer])
+		if end <= start:
+			return layer, 1.0
+		fraction = (position - start) / (end - start)
+		return layer, min(max(fraction, 0.0), 1.0)
+
+
+class LayerSource():
+	"""
+	Where the layer images of a sliced file are stored and how to decode
+	them, so any single layer can be decoded without parsing the headers
+	again.
+
+	decode is called as ``decode(index, data, out)`` with the encoded bytes
+	of layer index and a ``height x width`` uint8 array to decode into, or
+	None, and returns the decoded greyscale layer, 0 for unlit pixels up to
+	255 (254 for RLE4) for fully lit ones. 1 bit formats return 0 or 255.
+	"""
+
+	def __init__(
+		self,
+		width: int,
+		height: int,
+		pixel_size_mm: Tuple[float, float],
+		layer_height_mm: float,
+		layer_defs: np.ndarray,
+		decode: Callable[[int, bytes, Optional[np.ndarray]], np.ndarray],
+	):
+		self.width = width
+		self.height = height
+		self.pixel_size_mm = pixel_size_mm
+		self.layer_height_mm = layer_height_mm
+		self.image_offsets = layer_defs["image_offset"].astype(np.int64)
+		self.image_lengths = layer_defs["image_length"].astype(np.int64)
+		self._decode = decode
+
+	def __len__(self):
+		return len(self.image_offsets)
+
+	def read(self, file: BinaryIO, index: int) -> bytes:
+		file.seek(int(self.image_offsets[index]))
+		return file.read(int(self.image_lengths[index]))
+
+	def decode(self, index: int, data: bytes, out: Optional[np.ndarray] = None) -> np.ndarray:
+		return self._decode(index, data, out)
+
+
+class MappedLayers():
+	"""
+	Random access to the layer images of a memory-mapped sliced file, as
+	returned by SlicedModelFile.open_layers. layer returns the encoded bytes
+	of a layer without copying them, decode_layer the decoded layer. Views
+	returned by layer must not be used after the mapping was closed.
+	"""
+
+	def __init__(self, path, source: LayerSource):
+		self._source = source
+		self._file = open(str(path), "rb")
+		try:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		except Exception:
+			self._file.close()
+			raise
+		self._view = memoryview(self._map)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return len(self._source)
+
+	@property
+	def source(self) -> LayerSource:
+		return self._source
+
+	def layer(self, index: int) -> memoryview:
+		if not 0 <= index < len(self._source):
+			raise IndexError("layer {} out of range".format(index))
+		start = int(self._source.image_offsets[index])
+		end = start + int(self._source.image_lengths[index])
+		if end > len(self._view):
+			raise ValueError("layer {} ends past the end of the file".format(index))
+		return self._view[start:end]
+
+	def decode_layer(self, index: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+		return self._source.decode(index, self.layer(index), out)
+
+	def close(self):
+		self._view.release()
+		try:
+			self._map.close()
+		except BufferError:
+			# a view returned by layer is still alive, the mapping is
+			# unmapped once that is garbage collected
+			pass
+		self._file.close()
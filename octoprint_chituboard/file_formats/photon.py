@@ -1,12 +1,12 @@
 import pathlib
-import struct
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Optional
 
 import png, time
 from typedstruct import LittleEndianStruct, StructType
 import numpy as np
-from . import SlicedModelFile
+from . import MAX_PRINTER_NAME_SIZE, SlicedModelFile, SlicedModelHeader
+from .layers import LayerSource, LayerTable, bottom_layers, raise_if_aborted, read_layer_defs
 from .rle import *
 
 
@@ -101,6 +101,19 @@ class PhotonLayerDef(LittleEndianStruct):
 	unknown_03: int = StructType.uint32()  # 1c:
 	unknown_04: int = StructType.uint32()  # 20:
 
+# PhotonLayerDef as numpy record, used to parse the whole table in one read
+PHOTON_LAYER_DEF = np.dtype([
+	("layer_height_mm", "<f4"),
+	("layer_exposure", "<f4"),
+	("layer_off_time", "<f4"),
+	("image_offset", "<u4"),
+	("image_length", "<u4"),
+	("unknown_01", "<u4"),
+	("unknown_02", "<u4"),
+	("unknown_03", "<u4"),
+	("unknown_04", "<u4"),
+])
+
 
 @dataclass(frozen=True)
 class PhotonPreview(LittleEndianStruct):
@@ -114,46 +127,12 @@ class PhotonPreview(LittleEndianStruct):
 	unknown_04: int = StructType.uint32()
 
 
-REPEAT_RGB15_MASK: int = 1 << 5
-
-
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-	
 def _read_layer(width: int, height: int, layernum:int, data: bytes) -> png.Image:
 	
 	return read_rle1image(width, height, data)
 
-def _read_layer_array(width: int, height: int, layernum:int, data: bytes):
-	return read_rle1array(width, height, data)
+def _read_layer_array(width: int, height: int, layernum:int, data: bytes, out=None):
+	return decode_rle1(width, height, data, out)
 	
 def get_printarea(resolution,header,image):
 	resolutionX = header.resolution_x
@@ -178,10 +157,23 @@ def get_printarea(resolution,header,image):
 	return results
 
 
+def _layer_table(header, param, layer_defs) -> LayerTable:
+	count = len(layer_defs)
+	return LayerTable(
+		image_offset=layer_defs["image_offset"],
+		image_length=layer_defs["image_length"],
+		position_z_mm=layer_defs["layer_height_mm"],
+		exposure_secs=layer_defs["layer_exposure"],
+		off_time_secs=layer_defs["layer_off_time"],
+		lift_height_mm=bottom_layers(count, header.bottom_count, param.bottom_lift_height, param.lift_height),
+		lift_speed_mm_min=bottom_layers(count, header.bottom_count, param.bottom_lift_speed, param.lift_speed),
+		retract_speed_mm_min=param.retract_speed,
+	)
+
 @dataclass(frozen=True)
 class PhotonFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "PhotonFile":
+	def read(self, path: pathlib.Path, is_aborted: Optional[Callable[[], bool]] = None) -> "PhotonFile":
 		with open(str(path), "rb") as file:
 			photon_header = PhotonHeader.unpack(file.read(PhotonHeader.get_size()))
 			
@@ -194,20 +186,17 @@ class PhotonFile(SlicedModelFile):
 			file.seek(photon_slicer.machine_offset)
 			printer_name = file.read(photon_slicer.machine_size).decode()
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, photon_header.layer_count):
-				file.seek(
-					photon_header.layer_defs_offset + layer * PhotonLayerDef.get_size()
-				)
-				layer_def = PhotonLayerDef.unpack(file.read(PhotonLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
-			file.seek(photon_header.layer_defs_offset + 0 * PhotonLayerDef.get_size())
-			first_layer = PhotonLayerDef.unpack(file.read(PhotonLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			layer_defs = read_layer_defs(
+				file,
+				photon_header.layer_defs_offset,
+				photon_header.layer_count,
+				PHOTON_LAYER_DEF,
+				is_aborted=is_aborted,
+			)
+			layer_table = _layer_table(photon_header, photon_param, layer_defs)
+			raise_if_aborted(is_aborted)
+			file.seek(int(layer_defs["image_offset"][0]))
+			data = file.read(int(layer_defs["image_length"][0]))
 			results = {}
 			image = _read_layer_array(
 				photon_header.resolution_x,
@@ -215,7 +204,7 @@ class PhotonFile(SlicedModelFile):
 				0,
 				data)
 			try:
-				imlayer = np.array(image)
+				imlayer = np.asarray(image)
 				results = get_printarea(imlayer.shape,photon_header,imlayer)
 			except:
 				results = {}
@@ -236,7 +225,7 @@ class PhotonFile(SlicedModelFile):
 				resolution=(photon_header.resolution_x, photon_header.resolution_y),
 				print_time_secs=photon_header.print_time,
 				volume=photon_param.volume_ml,
-				end_byte_offset_by_layer=end_byte_offset_by_layer,
+				layer_table=layer_table,
 				slicer_version=".".join(
 					[
 						str(photon_slicer.version_release),
@@ -250,6 +239,48 @@ class PhotonFile(SlicedModelFile):
 				dimensions = results["dimensions"],
 			)
 
+	@classmethod
+	def read_header(cls, path: pathlib.Path) -> SlicedModelHeader:
+		with open(str(path), "rb") as file:
+			photon_header = PhotonHeader.unpack(file.read(PhotonHeader.get_size()))
+
+			file.seek(photon_header.param_offset)
+			photon_param = PhotonParam.unpack(file.read(PhotonParam.get_size()))
+
+			file.seek(photon_header.slicer_offset)
+			photon_slicer = PhotonSlicer.unpack(file.read(PhotonSlicer.get_size()))
+
+			file.seek(photon_slicer.machine_offset)
+			printer_name = file.read(min(photon_slicer.machine_size, MAX_PRINTER_NAME_SIZE)).decode()
+
+		return SlicedModelHeader(
+			filename=path.name,
+			bed_size_mm=(
+				round(photon_header.bed_size_x_mm, 4),
+				round(photon_header.bed_size_y_mm, 4),
+				round(photon_header.bed_size_z_mm, 4),
+			),
+			height_mm=photon_header.height_mm,
+			layer_height_mm=photon_header.layer_height_mm,
+			layer_count=photon_header.layer_count,
+			resolution=(photon_header.resolution_x, photon_header.resolution_y),
+			print_time_secs=photon_header.print_time,
+			volume=photon_param.volume_ml,
+			layer_exposure_secs=photon_header.layer_exposure,
+			bottom_exposure_secs=photon_header.bottom_exposure,
+			bottom_layer_count=photon_header.bottom_count,
+			layer_off_time_secs=photon_header.layer_off_time,
+			slicer_version=".".join(
+				[
+					str(photon_slicer.version_release),
+					str(photon_slicer.version_major),
+					str(photon_slicer.version_minor),
+					str(photon_slicer.version_patch),
+				]
+			),
+			printer_name=printer_name,
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "PhotonFile":
 		with open(str(path), "rb") as file:
@@ -261,15 +292,13 @@ class PhotonFile(SlicedModelFile):
 			file.seek(photon_header.slicer_offset)
 			photon_slicer = PhotonSlicer.unpack(file.read(PhotonSlicer.get_size()))
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, photon_header.layer_count):
-				file.seek(
-					photon_header.layer_defs_offset + layer * PhotonLayerDef.get_size()
-				)
-				layer_def = PhotonLayerDef.unpack(file.read(PhotonLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_defs(
+				file,
+				photon_header.layer_defs_offset,
+				photon_header.layer_count,
+				PHOTON_LAYER_DEF,
+			)
+			layer_table = _layer_table(photon_header, photon_param, layer_defs)
 				
 			return PhotonFile(
 					filename=path.name,
@@ -284,7 +313,7 @@ class PhotonFile(SlicedModelFile):
 					resolution = (photon_header.resolution_x, photon_header.resolution_y),
 					print_time_secs = metadata["estimatedPrintTime"],
 					volume = metadata["filament"]["tool0"]["volume"],
-					end_byte_offset_by_layer = end_byte_offset_by_layer,
+					layer_table=layer_table,
 					slicer_version=".".join(
 						[
 							str(photon_slicer.version_release),
@@ -298,6 +327,39 @@ class PhotonFile(SlicedModelFile):
 					dimensions = metadata["dimensions"],
 				)
 
+	@classmethod
+	def layer_source(cls, path: pathlib.Path) -> LayerSource:
+		with open(str(path), "rb") as file:
+			photon_header = PhotonHeader.unpack(file.read(PhotonHeader.get_size()))
+			layer_defs = read_layer_defs(
+				file,
+				photon_header.layer_defs_offset,
+				photon_header.layer_count,
+				PHOTON_LAYER_DEF,
+			)
+
+		def decode(index, data, out):
+			# 1 bit layers, lit pixels become white like in the other formats
+			image = _read_layer_array(
+				photon_header.resolution_x,
+				photon_header.resolution_y,
+				index,
+				data,
+				out)
+			return np.multiply(image, 0xff, out=image)
+
+		return LayerSource(
+			photon_header.resolution_x,
+			photon_header.resolution_y,
+			(
+				photon_header.bed_size_x_mm/photon_header.resolution_x,
+				photon_header.bed_size_y_mm/photon_header.resolution_y,
+			),
+			photon_header.layer_height_mm,
+			layer_defs,
+			decode,
+		)
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
@@ -309,4 +371,4 @@ class PhotonFile(SlicedModelFile):
 			file.seek(preview.image_offset)
 			data = file.read(preview.image_length)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_image(preview.resolution_x, preview.resolution_y, data)
@@ -1,14 +1,13 @@
 import pathlib
-import struct, os
 from dataclasses import dataclass
-from typing import List
-from typing import Mapping, Set, Type, Tuple
+from typing import Callable, Optional, Set, Type
 import numpy as np
 
 import png
 from typedstruct import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import SlicedModelFile, SlicedModelHeader, anycubic
+from .layers import LayerSource, LayerTable, raise_if_aborted, read_layer_defs
 from .rle import *
 
 @dataclass(frozen=True)
@@ -148,79 +147,21 @@ class PwmsLayerDef(LittleEndianStruct):
 	layer_exposure: float = StructType.float32()
 	layer_height_mm: float = StructType.float32()
 
-REPEAT_RGB15_MASK: int = 1 << 5
+# PwmsLayerDef as numpy record, used to parse the whole table in one read
+PWMS_LAYER_DEF = np.dtype([
+	("image_offset", "<u4"),
+	("image_length", "<u4"),
+	("lift_height", "<f4"),
+	("lift_speed", "<f4"),
+	("layer_exposure", "<f4"),
+	("layer_height_mm", "<f4"),
+])
 
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-	
-def _read_rle4image(width: int, height: int, antialias: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		color = 0
-		nr = grey & 0xf  # turn highest bit of
-		L = grey >> 4  # only read 1st bit
-		repeat = 1
-		if L == 0x0:
-			color = 0x00
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		elif L == 0xf:
-			color = 0xff - 1
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		else:
-			color = L << 4 | L
-			color &= antialias
-		i+=1
-
-		while repeat > 0:
-			array[-1] += [color]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-	return png.from_array(array, "L"), array
-	
 def _read_layer(width: int, height: int, antialias: int, layernum:int, data: bytes) -> png.Image:	
 	return read_rle4image(width, height, antialias, data)
 
-def _read_layer_array(width: int, height: int, antialias: int, layernum:int, data: bytes):
-	return read_rle4array(width, height, antialias, data)
+def _read_layer_array(width: int, height: int, antialias: int, layernum:int, data: bytes, out=None):
+	return decode_rle4(width, height, antialias, data, out)
 	
 def get_printarea(resolution,header,image, height):
 	resolutionX = header.resolution_x
@@ -246,27 +187,11 @@ def get_printarea(resolution,header,image, height):
 	return results
 
 	
-EXTENSION_TO_BED_SIZE: Mapping[str, Tuple[str, float, float, float]] = {
-	".pws": ("Anycubic Photon S", 68.04, 120.96, 165),
-	".pw0": ("Anycubic Photon Zero", 55.44, 98.64, 150),
-	".pwmo": ("Anycubic Photon Mono", 68.04, 120.96, 165),
-	".pwms": ("Anycubic Photon Mono SE", 78, 130, 160),
-	".pwmx": ("Anycubic Photon Mono X", 120, 192, 245),
-}
-
-def _get_printer_info(name):
-	#file_ext = name.suffix
-	(_, file_ext) = os.path.splitext(name)
-	printer_info = EXTENSION_TO_BED_SIZE.get(file_ext.lower())
-
-	assert printer_info is not None
-	return printer_info
-
 def _calc_print_time(header, layermark):
 	"""
-	Calculate print time using info from header and layercount
-	Simplistic calculation since it doesn't account for the
-	per layer override
+	Calculate print time using info from header and layercount,
+	used by read and read_header alike. It doesn't account for the
+	per layer override, the layer table's durations_secs does
 	"""
 	light_on_time = header.layer_exposure
 	light_off_time = header.layer_off_time
@@ -279,7 +204,7 @@ def _calc_print_time(header, layermark):
 	bottom_layers = header.bottom_count
 	
 	total_sec = light_on_time+light_off_time
-	total_sec = total_sec*total_layers-bottom_layers
+	total_sec = total_sec*(total_layers-bottom_layers)
 	bottom_sec = (bottom_light_on_time+light_off_time)*bottom_layers
 	
 	lift_time = lift_height/lift_speed
@@ -290,10 +215,23 @@ def _calc_print_time(header, layermark):
 	
 	return bottom_sec+total_sec+lift_time+retract_time
 
+def _layer_table(header, layer_defs) -> LayerTable:
+	# speeds are stored in mm/s, the off time only in the header
+	return LayerTable(
+		image_offset=layer_defs["image_offset"],
+		image_length=layer_defs["image_length"],
+		position_z_mm=layer_defs["layer_height_mm"],
+		exposure_secs=layer_defs["layer_exposure"],
+		off_time_secs=header.layer_off_time,
+		lift_height_mm=layer_defs["lift_height"],
+		lift_speed_mm_min=layer_defs["lift_speed"] * 60,
+		retract_speed_mm_min=header.retract_speed * 60,
+	)
+
 @dataclass(frozen=True)
 class PwmsFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "PwmsFile":
+	def read(self, path: pathlib.Path, is_aborted: Optional[Callable[[], bool]] = None) -> "PwmsFile":
 		with open(str(path), "rb") as file:
 			pwms_filemark = PwmsFileMark.unpack(file.read(PwmsFileMark.get_size()))
 			
@@ -303,26 +241,24 @@ class PwmsFile(SlicedModelFile):
 			file.seek(pwms_filemark.layer_defs_offset)
 			pwms_layermark = PwmsLayerMark.unpack(file.read(PwmsLayerMark.get_size()))
 			
-			printer_info = _get_printer_info(path.name)
+			printer_info = anycubic.printer_info(
+				pwms_header.resolution_x, pwms_header.resolution_y, pwms_header.pixel_size, path.name)
 			
 			height_mm = pwms_header.layer_height_mm*pwms_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pwms_layermark.layer_count):
-				file.seek(
-					pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size() + layer * PwmsLayerDef.get_size()
-				)
-				layer_def = PwmsLayerDef.unpack(file.read(PwmsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_defs(
+				file,
+				pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size(),
+				pwms_layermark.layer_count,
+				PWMS_LAYER_DEF,
+				is_aborted=is_aborted,
+			)
+			layer_table = _layer_table(pwms_header, layer_defs)
 			print_time = _calc_print_time(pwms_header, pwms_layermark)
 			
-			file.seek(pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size() +  0 * PwmsLayerDef.get_size())
-			first_layer = PwmsLayerDef.unpack(file.read(PwmsLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			raise_if_aborted(is_aborted)
+			file.seek(int(layer_defs["image_offset"][0]))
+			data = file.read(int(layer_defs["image_length"][0]))
 			results = {}
 			image = _read_layer_array(
 				pwms_header.resolution_x,
@@ -331,7 +267,7 @@ class PwmsFile(SlicedModelFile):
 				0,
 				data)
 			#try:
-			imlayer = np.array(image)
+			imlayer = np.asarray(image)
 			results = get_printarea(imlayer.shape,pwms_header,imlayer,height_mm)
 			#except:
 			#	results = {}
@@ -353,15 +289,49 @@ class PwmsFile(SlicedModelFile):
 				layer_height_mm=pwms_header.layer_height_mm,
 				layer_count=pwms_layermark.layer_count,
 				resolution=(pwms_header.resolution_x, pwms_header.resolution_y),
-				print_time_secs=_calc_print_time(pwms_header, pwms_layermark), # will have to calculate from file info
+				print_time_secs=print_time,
 				volume=pwms_header.volume_ml,
-				end_byte_offset_by_layer=end_byte_offset_by_layer,
+				layer_table=layer_table,
 				slicer_version="1.8.0.0",
-				printer_name=printer_info[0],# Use filename ending to determine printer name
+				printer_name=printer_info[0],# from the resolution and pixel size
 				printing_area = results["printing_area"],
 				dimensions = results["dimensions"],
 			)
 			
+	@classmethod
+	def read_header(cls, path: pathlib.Path) -> SlicedModelHeader:
+		with open(str(path), "rb") as file:
+			pwms_filemark = PwmsFileMark.unpack(file.read(PwmsFileMark.get_size()))
+
+			file.seek(pwms_filemark.header_offset)
+			pwms_header = PwmsHeader.unpack(file.read(PwmsHeader.get_size()))
+
+			file.seek(pwms_filemark.layer_defs_offset)
+			pwms_layermark = PwmsLayerMark.unpack(file.read(PwmsLayerMark.get_size()))
+
+		printer_info = anycubic.printer_info(
+			pwms_header.resolution_x, pwms_header.resolution_y, pwms_header.pixel_size, path.name)
+		return SlicedModelHeader(
+			filename=path.name,
+			bed_size_mm=(
+				round(pwms_header.resolution_x*pwms_header.pixel_size/1000.0, 4),
+				round(pwms_header.resolution_y*pwms_header.pixel_size/1000.0, 4),
+				printer_info[3],
+			),
+			height_mm=round(pwms_header.layer_height_mm*pwms_layermark.layer_count, 4),
+			layer_height_mm=pwms_header.layer_height_mm,
+			layer_count=pwms_layermark.layer_count,
+			resolution=(pwms_header.resolution_x, pwms_header.resolution_y),
+			print_time_secs=_calc_print_time(pwms_header, pwms_layermark),
+			volume=pwms_header.volume_ml,
+			layer_exposure_secs=pwms_header.layer_exposure,
+			bottom_exposure_secs=pwms_header.bottom_exposure,
+			bottom_layer_count=pwms_header.bottom_count,
+			layer_off_time_secs=pwms_header.layer_off_time,
+			slicer_version="1.8.0.0",
+			printer_name=printer_info[0],
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "PwmsFile":
 		with open(str(path), "rb") as file:
@@ -371,19 +341,18 @@ class PwmsFile(SlicedModelFile):
 			file.seek(pwms_filemark.layer_defs_offset)
 			pwms_layermark = PwmsLayerMark.unpack(file.read(PwmsLayerMark.get_size()))
 			
-			printer_info = _get_printer_info(path.name)
+			printer_info = anycubic.printer_info(
+				pwms_header.resolution_x, pwms_header.resolution_y, pwms_header.pixel_size, path.name)
 			
 			height_mm = pwms_header.layer_height_mm*pwms_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pwms_layermark.layer_count):
-				file.seek(
-					pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size() + layer * PwmsLayerDef.get_size()
-				)
-				layer_def = PwmsLayerDef.unpack(file.read(PwmsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_defs(
+				file,
+				pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size(),
+				pwms_layermark.layer_count,
+				PWMS_LAYER_DEF,
+			)
+			layer_table = _layer_table(pwms_header, layer_defs)
 				
 			return PwmsFile(
 				filename=path.name,
@@ -398,25 +367,56 @@ class PwmsFile(SlicedModelFile):
 				resolution=(pwms_header.resolution_x, pwms_header.resolution_y),
 				print_time_secs = metadata["estimatedPrintTime"],
 				volume = metadata["filament"]["tool0"]["volume"],
-				end_byte_offset_by_layer=end_byte_offset_by_layer,
+				layer_table=layer_table,
 				slicer_version = "1.8.0.0",
 				printer_name = metadata["printer_name"],
 				printing_area = metadata["printing_area"],
 				dimensions = metadata["dimensions"],
 			)
 
+	@classmethod
+	def layer_source(cls, path: pathlib.Path) -> LayerSource:
+		with open(str(path), "rb") as file:
+			pwms_filemark = PwmsFileMark.unpack(file.read(PwmsFileMark.get_size()))
+
+			file.seek(pwms_filemark.header_offset)
+			pwms_header = PwmsHeader.unpack(file.read(PwmsHeader.get_size()))
+
+			file.seek(pwms_filemark.layer_defs_offset)
+			pwms_layermark = PwmsLayerMark.unpack(file.read(PwmsLayerMark.get_size()))
+			layer_defs = read_layer_defs(
+				file,
+				pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size(),
+				pwms_layermark.layer_count,
+				PWMS_LAYER_DEF,
+			)
+
+		def decode(index, data, out):
+			return _read_layer_array(
+				pwms_header.resolution_x,
+				pwms_header.resolution_y,
+				pwms_header.anti_alias_level,
+				index,
+				data,
+				out)
+
+		return LayerSource(
+			pwms_header.resolution_x,
+			pwms_header.resolution_y,
+			(pwms_header.pixel_size/1000.0, pwms_header.pixel_size/1000.0),
+			pwms_header.layer_height_mm,
+			layer_defs,
+			decode,
+		)
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
 			pwms_filemark = PwmsFileMark.unpack(file.read(PwmsFileMark.get_size()))
 			file.seek(pwms_filemark.preview_offset)
-			pwms_preview = PwmsPreview.unpack(file.read(PwmsPreview.get_size()))
-			# image offset is PWMSpreview offset + pwmspreview.getsize()
-
-			file.seek(pwms_header.high_res_preview_offset)
 			preview = PwmsPreview.unpack(file.read(PwmsPreview.get_size()))
 
-			file.seek(preview.image_offset)
-			data = file.read(preview.image_length)
+			# the image follows the preview header, one RGB565 word per pixel
+			data = file.read(preview.resolution_x*preview.resolution_y*2)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_rgb565image(preview.resolution_x, preview.resolution_y, data)
@@ -1,13 +1,13 @@
-import os
 import pathlib
-import struct
 from dataclasses import dataclass
-from typing import List, Mapping, Type, Tuple
+from typing import Callable, Optional, Type
 
+import numpy as np
 import png
 from typedstruct import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import SlicedModelFile, SlicedModelHeader, anycubic
+from .layers import LayerSource, LayerTable, raise_if_aborted, read_layer_defs
 from .rle import *
 
 @dataclass(frozen=True)
@@ -136,59 +136,21 @@ class PwsLayerDef(LittleEndianStruct):
 	layer_exposure: float = StructType.float32()
 	layer_height_mm: float = StructType.float32()
 
-REPEAT_RGB15_MASK: int = 1 << 5
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-
-EXTENSION_TO_BED_SIZE: Mapping[str, Tuple[str, float, float, float]] = {
-	".pws": ("Anycubic Photon S", 68.04, 120.96, 165),
-	".pw0": ("Anycubic Photon Zero", 55.44, 98.64, 150),
-	".pwmo": ("Anycubic Photon Mono", 68.04, 120.96, 165),
-	".pwms": ("Anycubic Photon Mono SE", 78, 130, 160),
-	".pwmx": ("Anycubic Photon Mono X", 120, 192, 245),
-}
-
-def _get_printer_info(filename):
-	(_, extension) = os.path.splitext(filename)
-	
-	printer_info = EXTENSION_TO_BED_SIZE.get(extension.lower())
-
-	assert printer_info is not None
-	return printer_info
+# PwsLayerDef as numpy record, used to parse the whole table in one read
+PWS_LAYER_DEF = np.dtype([
+	("image_offset", "<u4"),
+	("image_length", "<u4"),
+	("lift_height", "<f4"),
+	("lift_speed", "<f4"),
+	("layer_exposure", "<f4"),
+	("layer_height_mm", "<f4"),
+])
 
 def _calc_print_time(header, layermark):
 	"""
-	Calculate print time using info from header and layercount
-	Simplistic calculation since it doesn't account for the
-	per layer override
+	Calculate print time using info from header and layercount,
+	used by read and read_header alike. It doesn't account for the
+	per layer override, the layer table's durations_secs does
 	"""
 	light_on_time = header.layer_exposure
 	light_off_time = header.layer_off_time
@@ -201,7 +163,7 @@ def _calc_print_time(header, layermark):
 	bottom_layers = header.bottom_count
 	
 	total_sec = light_on_time+light_off_time
-	total_sec = total_sec*total_layers-bottom_layers
+	total_sec = total_sec*(total_layers-bottom_layers)
 	bottom_sec = (bottom_light_on_time+light_off_time)*bottom_layers
 	
 	lift_time = lift_height/lift_speed
@@ -215,8 +177,8 @@ def _calc_print_time(header, layermark):
 def _read_layer(width: int, height: int, layernum:int, data: bytes) -> png.Image:	
 	return read_rle1image(width, height, data)
 
-def _read_layer_array(width: int, height: int, layernum:int, data: bytes):
-	return read_rle1array(width, height, data)
+def _read_layer_array(width: int, height: int, layernum:int, data: bytes, out=None):
+	return decode_rle1(width, height, data, out)
 	
 def get_printarea(resolution,header,image, height):
 	resolutionX = header.resolution_x
@@ -241,36 +203,47 @@ def get_printarea(resolution,header,image, height):
 	results["dimensions"] = {"width":width, "depth":depth, "height":float(height)}
 	return results
 
+def _layer_table(header, layer_defs) -> LayerTable:
+	# speeds are stored in mm/s, the off time only in the header
+	return LayerTable(
+		image_offset=layer_defs["image_offset"],
+		image_length=layer_defs["image_length"],
+		position_z_mm=layer_defs["layer_height_mm"],
+		exposure_secs=layer_defs["layer_exposure"],
+		off_time_secs=header.layer_off_time,
+		lift_height_mm=layer_defs["lift_height"],
+		lift_speed_mm_min=layer_defs["lift_speed"] * 60,
+		retract_speed_mm_min=header.retract_speed * 60,
+	)
+
 @dataclass(frozen=True)
 class PwsFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "PwsFile":
+	def read(self, path: pathlib.Path, is_aborted: Optional[Callable[[], bool]] = None) -> "PwsFile":
 		with open(str(path), "rb") as file:
 			pws_filemark = PwsFileMark.unpack(file.read(PwsFileMark.get_size()))
 			pws_header = PwsHeader.unpack(file.read(PwsHeader.get_size()))
 			pws_layermark = PwsLayerMark.unpack(file.read(PwsLayerMark.get_size()))
 						
-			printer_info = _get_printer_info(path.name)
+			printer_info = anycubic.printer_info(
+				pws_header.resolution_x, pws_header.resolution_y, pws_header.pixel_size, path.name)
 			printer_name = printer_info[0]
 			
 			height_mm = pws_header.layer_height_mm*pws_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pws_layermark.layer_count):
-				file.seek(
-					pws_filemark.layer_defs_offset + PwsLayerMark.get_size() + layer * PwsLayerDef.get_size()
-				)
-				layer_def = PwsLayerDef.unpack(file.read(PwsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_defs(
+				file,
+				pws_filemark.layer_defs_offset + PwsLayerMark.get_size(),
+				pws_layermark.layer_count,
+				PWS_LAYER_DEF,
+				is_aborted=is_aborted,
+			)
+			layer_table = _layer_table(pws_header, layer_defs)
 			print_time = _calc_print_time(pws_header, pws_layermark)
 			
-			file.seek(pws_filemark.layer_defs_offset + PwsLayerMark.get_size() +  0 * PwsLayerDef.get_size())
-			first_layer = PwsLayerDef.unpack(file.read(PwsLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			raise_if_aborted(is_aborted)
+			file.seek(int(layer_defs["image_offset"][0]))
+			data = file.read(int(layer_defs["image_length"][0]))
 			results = {}
 			image = _read_layer_array(
 				pws_header.resolution_x,
@@ -278,7 +251,7 @@ class PwsFile(SlicedModelFile):
 				0,
 				data)
 			#try:
-			imlayer = np.array(image)
+			imlayer = np.asarray(image)
 			results = get_printarea(imlayer.shape,pws_header,imlayer,height_mm)
 			#except:
 			#	results = {}
@@ -302,15 +275,45 @@ class PwsFile(SlicedModelFile):
 				resolution=(pws_header.resolution_x, pws_header.resolution_y),
 				print_time_secs = print_time,
 				volume=pws_header.volume_ml,
-				end_byte_offset_by_layer=end_byte_offset_by_layer,
+				layer_table=layer_table,
 				# ~ end_byte_offset_by_layer=[pws_header.layer_exposure,pws_header.layer_off_time,
 				slicer_version="1.8.0.0",
-				printer_name=printer_name,# Use filename ending to determine printer name
+				printer_name=printer_name,# from the resolution and pixel size
 				printing_area = results["printing_area"],
 				dimensions = results["dimensions"],
 			)
 
 
+	@classmethod
+	def read_header(cls, path: pathlib.Path) -> SlicedModelHeader:
+		with open(str(path), "rb") as file:
+			PwsFileMark.unpack(file.read(PwsFileMark.get_size()))
+			pws_header = PwsHeader.unpack(file.read(PwsHeader.get_size()))
+			pws_layermark = PwsLayerMark.unpack(file.read(PwsLayerMark.get_size()))
+
+		printer_info = anycubic.printer_info(
+			pws_header.resolution_x, pws_header.resolution_y, pws_header.pixel_size, path.name)
+		return SlicedModelHeader(
+			filename=path.name,
+			bed_size_mm=(
+				round(pws_header.resolution_x*pws_header.pixel_size/1000.0, 4),
+				round(pws_header.resolution_y*pws_header.pixel_size/1000.0, 4),
+				printer_info[3]
+			),
+			height_mm=round(pws_header.layer_height_mm*pws_layermark.layer_count, 4),
+			layer_height_mm=pws_header.layer_height_mm,
+			layer_count=pws_layermark.layer_count,
+			resolution=(pws_header.resolution_x, pws_header.resolution_y),
+			print_time_secs=_calc_print_time(pws_header, pws_layermark),
+			volume=pws_header.volume_ml,
+			layer_exposure_secs=pws_header.layer_exposure,
+			bottom_exposure_secs=pws_header.bottom_exposure,
+			bottom_layer_count=int(pws_header.bottom_count),
+			layer_off_time_secs=pws_header.layer_off_time,
+			slicer_version="1.8.0.0",
+			printer_name=printer_info[0],
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "PwsFile":
 		with open(str(path), "rb") as file:
@@ -318,20 +321,19 @@ class PwsFile(SlicedModelFile):
 			pws_header = PwsHeader.unpack(file.read(PwsHeader.get_size()))
 			pws_layermark = PwsLayerMark.unpack(file.read(PwsLayerMark.get_size()))
 						
-			printer_info = _get_printer_info(path.name)
+			printer_info = anycubic.printer_info(
+				pws_header.resolution_x, pws_header.resolution_y, pws_header.pixel_size, path.name)
 			printer_name = printer_info[0]
 			
 			height_mm = pws_header.layer_height_mm*pws_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pws_layermark.layer_count):
-				file.seek(
-					pws_filemark.layer_defs_offset + PwsLayerMark.get_size() + layer * PwsLayerDef.get_size()
-				)
-				layer_def = PwsLayerDef.unpack(file.read(PwsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_defs(
+				file,
+				pws_filemark.layer_defs_offset + PwsLayerMark.get_size(),
+				pws_layermark.layer_count,
+				PWS_LAYER_DEF,
+			)
+			layer_table = _layer_table(pws_header, layer_defs)
 				
 			return PwsFile(
 				filename=path.name,
@@ -346,25 +348,54 @@ class PwsFile(SlicedModelFile):
 				resolution=(pws_header.resolution_x, pws_header.resolution_y),
 				print_time_secs = metadata["estimatedPrintTime"],
 				volume = metadata["filament"]["tool0"]["volume"],
-				end_byte_offset_by_layer=end_byte_offset_by_layer,
+				layer_table=layer_table,
 				slicer_version = "1.8.0.0",
-				printer_name = metadata["printer_name"],# Use filename ending to determine printer name
+				printer_name = metadata["printer_name"],# from the resolution and pixel size
 				printing_area = metadata["printing_area"],
 				dimensions = metadata["dimensions"],
 			)
 
 
 	@classmethod
-	def read_preview(cls, path: pathlib.Path) -> png.Image:
+	def layer_source(cls, path: pathlib.Path) -> LayerSource:
 		with open(str(path), "rb") as file:
 			pws_filemark = PwsFileMark.unpack(file.read(PwsFileMark.get_size()))
 			pws_header = PwsHeader.unpack(file.read(PwsHeader.get_size()))
-			# image offset is PWSpreview offset + pwspreview.getsize()
+			pws_layermark = PwsLayerMark.unpack(file.read(PwsLayerMark.get_size()))
+			layer_defs = read_layer_defs(
+				file,
+				pws_filemark.layer_defs_offset + PwsLayerMark.get_size(),
+				pws_layermark.layer_count,
+				PWS_LAYER_DEF,
+			)
 
-			file.seek(pws_header.preview_offset)
+		def decode(index, data, out):
+			# 1 bit layers, lit pixels become white like in the other formats
+			image = _read_layer_array(
+				pws_header.resolution_x,
+				pws_header.resolution_y,
+				index,
+				data,
+				out)
+			return np.multiply(image, 0xff, out=image)
+
+		return LayerSource(
+			pws_header.resolution_x,
+			pws_header.resolution_y,
+			(pws_header.pixel_size/1000.0, pws_header.pixel_size/1000.0),
+			pws_header.layer_height_mm,
+			layer_defs,
+			decode,
+		)
+
+	@classmethod
+	def read_preview(cls, path: pathlib.Path) -> png.Image:
+		with open(str(path), "rb") as file:
+			pws_filemark = PwsFileMark.unpack(file.read(PwsFileMark.get_size()))
+			file.seek(pws_filemark.preview_offset)
 			preview = PwsPreview.unpack(file.read(PwsPreview.get_size()))
 
-			file.seek(pws_header.preview_offset+PwsPreview.get_size())
-			data = file.read(preview.image_length)
+			# the image follows the preview header, one RGB565 word per pixel
+			data = file.read(preview.resolution_x*preview.resolution_y*2)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_rgb565image(preview.resolution_x, preview.resolution_y, data)
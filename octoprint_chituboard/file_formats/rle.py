@@ -1,379 +1,320 @@
 import numpy as np
-import png, struct
+import png
+from typing import List, Optional
 
 REPEAT_RGB15_MASK: int = 1 << 5
 
 def read_image(width: int, height: int, data: bytes) -> png.Image:
-	""" 
-	Decodes a RLE byte array from PhotonFile object to a pygame surface.
-	Based on https://github.com/Reonarudo/pcb2photon/issues/2
-	Encoding scheme:
-	The color (R,G,B) of a pixel spans 2 bytes (little endian) and each 
-	color component is 5 bits: RRRRR GGG GG X BBBBB
-	If the X bit is set, then the next 2 bytes (little endian) masked
-	with 0xFFF represents how many more times to repeat that pixel.
 	"""
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		# Combine 2 bytes Little Endian so we get RRRRR GGG GG X BBBBB (and advance read byte counter)
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-			
-		# Retrieve color components and make pygame color tuple
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		# If the X bit is set, then the next 2 bytes (little endian) 
-		# masked with 0xFFF represents how many more times to repeat that pixel.
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
+	PNG wrapper around :func:`decode_rgb15`.
+	"""
+	return rgb_png(decode_rgb15(width, height, data))
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
+def read_rgb565image(width: int, height: int, data: bytes) -> png.Image:
+	"""
+	PNG wrapper around :func:`decode_rgb565`.
+	"""
+	return rgb_png(decode_rgb565(width, height, data))
 
-	array.pop()
+def rgb_png(image: np.ndarray) -> png.Image:
+	"""
+	Encodes a ``height x width x 3`` uint8 array from the preview decoders
+	as an 8 bit RGB PNG.
+	"""
+	height, width, _ = image.shape
+	return png.from_array(image.reshape(height, width*3), "RGB", {"width": width, "height": height})
 
-	return png.from_array(array, "RGB;5")
-	
 def read_grayimage(width: int, height: int, data: bytes) -> png.Image:
-    limit = width * height
-    array: List[List[int]] = [[]]
-    lastColor = 0xff
-    (i, x) = (0, 0)
-    n = 0
-    # i = index
-    while n < len(data):
-        code = struct.unpack_from("<B", data, n)[0]
-        n += 1
-        if (code & 0x80) == 0x80:
-            # Convert from 0..124 to 8bpp
-            lastColor = ((code & 0x7f) << 1) | (code & 1)
-            if lastColor >= 0xfc:
-                # Make 'white' actually white
-                lastColor = 0xff
-            if i < limit: 
-                array[-1] += [lastColor]
-                x += 1
-                if x == width:
-                    x = 0
-                    array.append([])
-            i += 1
-        else:
-            index = 0
-            while index < int(code):
-                if i < limit:
-                    array[-1] += [lastColor]
-                    x += 1
-                    if x == width:
-                        x = 0
-                        array.append([])
-                i += 1
-                index += 1
-
-    array.pop()
-    return png.from_array(array, "L")
+	return png.from_array(decode_gray(width, height, data), "L")
 
 def read_rle1image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data) and len(array) < height+1:
-		grey = struct.unpack_from("<B", data, i)[0]
-		i += 1
-		nr = grey & ~(1 << 7)  # turn highest bit of
-		L = grey >> 7  # only read 1st bit
-		repeat = 1
-		if grey & ~(1 << 7):
-			repeat = nr
+	return png.from_array(decode_rle1(width, height, data), "L;1")
 	
-		while repeat > 0:
-			array[-1] += [L]
-			repeat -= 1
-	
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
+def read_rle4image(width: int, height: int, antialias: int, data: bytes) -> png.Image:
+	return png.from_array(decode_rle4(width, height, antialias, data), "L")
+
+def read_rle7image(width: int, height: int, data: bytes) -> png.Image:
+	return png.from_array(decode_rle7(width, height, data), "L")
 	
-	array.pop()
-	return png.from_array(array, "L;1")
+def read_grayarray(width: int, height: int, data: bytes):
+	"""
+	List-of-lists wrapper around :func:`decode_gray`, kept for callers
+	that still expect rows of ints.
+	"""
+	return decode_gray(width, height, data).tolist()
+
+def read_rle1array(width: int, height: int, data: bytes):
+	"""
+	List-of-lists wrapper around :func:`decode_rle1`, kept for callers
+	that still expect rows of ints.
+	"""
+	return decode_rle1(width, height, data).tolist()
 	
-def read_rle4image(width: int, height: int, antialias: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
+def read_rle4array(width: int, height: int, antialias: int, data: bytes):
+	"""
+	List-of-lists wrapper around :func:`decode_rle4`, kept for callers
+	that still expect rows of ints.
+	"""
+	return decode_rle4(width, height, antialias, data).tolist()
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		color = 0
-		nr = grey & 0xf  # turn highest bit of
-		L = grey >> 4  # only read 1st bit
-		repeat = 1
-		if L == 0x0:
-			color = 0x00
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		elif L == 0xf:
-			color = 0xff - 1
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		else:
-			color = L << 4 | L
-			color &= antialias
-		i+=1
+def read_rle7array(width: int, height: int, data: bytes):
+	"""
+	List-of-lists wrapper around :func:`decode_rle7`, kept for callers
+	that still expect one Python list per image row.
+	"""
+	return decode_rle7(width, height, data).tolist()
 
-		while repeat > 0:
-			array[-1] += [color]
-			repeat -= 1
+# Size in bytes of a RLE7 run token (header byte plus 1-4 length bytes),
+# indexed by the first length byte. 0 marks an invalid length prefix.
+_RLE7_RUN_SIZE = np.array(
+	[2] * 0x80 + [3] * 0x40 + [4] * 0x20 + [5] * 0x10 + [0] * 0x10,
+	dtype=np.int64,
+)
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
+# 7-bit pixel value to 8-bit greymap, non zero values are bit extended
+_RLE7_GREY = np.array([0] + [(code << 1) | 1 for code in range(1, 0x80)], dtype=np.uint8)
 
-	array.pop()
-	return png.from_array(array, "L")
+def _scan_rle7(buf: np.ndarray) -> np.ndarray:
+	"""
+	Returns the offsets of all tokens in a RLE7 stream.
+	A token is either a single pixel byte (bit 7 clear) or a run header
+	(bit 7 set) followed by its 1-4 length bytes. The token chain is
+	inherently sequential, so only the walk over the precomputed next
+	offsets happens in Python, one step per token instead of per pixel.
+	A token with an invalid length prefix ends the stream.
+	"""
+	n = len(buf)
+	padded = np.zeros(n + 1, dtype=np.uint8)
+	padded[:n] = buf
+	return _walk_tokens(np.where(buf & 0x80, _RLE7_RUN_SIZE[padded[1:]], 1))
 
-def read_rle7image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
+def _walk_tokens(size: np.ndarray) -> np.ndarray:
+	"""
+	Returns the offsets of the tokens of a stream, given the size in bytes
+	of the token that would start at each byte, 0 for an invalid token.
+	Only the walk over the precomputed next offsets happens in Python,
+	one step per token. An invalid token, or one running past the end of
+	the stream, ends it.
+	"""
+	n = len(size)
+	invalid = size == 0
+	following = np.arange(n, dtype=np.int64) + size
+	invalid |= following > n
+	following[invalid] = n
+	following = following.tolist()
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		# From each byte retrieve 
-		# bit 7(MSB) (highest bit)  single unique pixel(0) or run(1)
-		# bits 6:0(LSB) (lowest 7 bits) number of pixels of that color
-		# If a run is present, its length is encoded in the following 1-4 bytes.
-		code = grey
-		repeat = 1
-		if (grey & 0x80) == 0x80:
-			# Its a run
-			code = code & 0x7f# value of pixel 0-127
-			i+=1
-			# get the run length
-			rlen = struct.unpack_from("<B", data, i)[0]
-			if (rlen&0x80) == 0:
-				# 7 bit run length
-				repeat = rlen
-				#print(i, repeat,type(repeat), L)
-			elif (rlen&0xC0) == 0x80:
-				# 14 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat = rlen&0x3f
-				repeat = repeat << 8 | repeat2
-				#print(i, repeat,type(repeat), L)
-				i+=1
-			elif (rlen&0xE0) == 0xC0:
-				# 21 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat = rlen&0x1F
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				i += 2
-			elif (rlen&0xF0) == 0xE0:
-				# 28 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat4 = struct.unpack_from("<B", data, i+3)[0]
-				repeat = rlen&0xf
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				repeat = repeat << 8 | repeat4
-				i += 3
-			else:
-				return png.from_array(array, "L"), array
+	offsets = []
+	append = offsets.append
+	i = 0
+	while i < n:
+		append(i)
+		i = following[i]
+	offsets = np.array(offsets, dtype=np.int64)
+	if len(offsets) and invalid[offsets[-1]]:
+		offsets = offsets[:-1]
+	return offsets
 
-		# Bit extend from 7-bit to 8-bit greymap
-		if (code != 0):
-			code = ((code << 1) | 1)
-			
-		while repeat > 0:# and len(array) < height+1:
-			array[-1] += [code]
-			repeat -= 1
+def decode_rle7(width: int, height: int, data: bytes, out: Optional[np.ndarray] = None) -> np.ndarray:
+	"""
+	Decodes a RLE7 encoded CTB layer into a ``height x width`` uint8 array.
+	From each token byte retrieve
+	bit 7(MSB) (highest bit)  single unique pixel(0) or run(1)
+	bits 6:0(LSB) (lowest 7 bits) value of the pixel(s)
+	If a run is present, its length is encoded in the following 1-4 bytes,
+	the number of leading one bits of the first length byte gives the
+	number of extra length bytes (7, 14, 21 or 28 bit run length).
+	Pixels past ``width*height`` are dropped, missing pixels stay black.
+	If given, the layer is decoded into ``out``, a contiguous ``height x
+	width`` uint8 array, so one buffer can be reused for many layers.
+	"""
+	buf = np.frombuffer(data, dtype=np.uint8)
+	offsets = _scan_rle7(buf)
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-		i+=1
-			
-	array.pop()
-	return png.from_array(array[0:-1], "L")
-	
-def read_grayarray(width: int, height: int, data: bytes):
-    limit = width * height
-    array: List[List[int]] = [[]]
-    lastColor = 0xff
-    (i, x) = (0, 0)
-    n = 0
-    # i = index
-    while n < len(data):
-        code = struct.unpack_from("<B", data, n)[0]
-        n += 1
-        if (code & 0x80) == 0x80:
-            # Convert from 0..124 to 8bpp
-            lastColor = ((code & 0x7f) << 1) | (code & 1)
-            if lastColor >= 0xfc:
-                # Make 'white' actually white
-                lastColor = 0xff
-            if i < limit: 
-                array[-1] += [lastColor]
-                x += 1
-                if x == width:
-                    x = 0
-                    array.append([])
-            i += 1
-        else:
-            index = 0
-            while index < int(code):
-                if i < limit:
-                    array[-1] += [lastColor]
-                    x += 1
-                    if x == width:
-                        x = 0
-                        array.append([])
-                i += 1
-                index += 1
+	padded = np.zeros(len(buf) + 4, dtype=np.uint8)
+	padded[:len(buf)] = buf
+	header = padded[offsets]
+	b1, b2, b3, b4 = (padded[offsets + k].astype(np.int64) for k in range(1, 5))
+	is_run = (header & 0x80) != 0
+	lengths = np.select(
+		[
+			(b1 & 0x80) == 0,
+			(b1 & 0xC0) == 0x80,
+			(b1 & 0xE0) == 0xC0,
+		],
+		[
+			b1,
+			(b1 & 0x3F) << 8 | b2,
+			(b1 & 0x1F) << 16 | b2 << 8 | b3,
+		],
+		(b1 & 0x0F) << 24 | b2 << 16 | b3 << 8 | b4,
+	)
+	lengths = np.where(is_run, lengths, 1)
+	values = _RLE7_GREY[header & 0x7F]
+	return _expand_runs(width, height, values, lengths, out)
 
-    array.pop()
-    return array
+def _expand_runs(
+	width: int,
+	height: int,
+	values: np.ndarray,
+	lengths: np.ndarray,
+	out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+	"""
+	Expands runs of pixel values into a ``height x width`` uint8 array,
+	runs are clipped to the image and missing pixels stay black.
+	"""
+	limit = width * height
+	if out is None:
+		image = np.zeros(limit, dtype=np.uint8)
+	else:
+		image = out.reshape(limit)
+		image.fill(0)
+	if len(lengths) == 0:
+		return image.reshape(height, width)
+	# clip the runs to the image so a corrupt length can't blow up memory
+	ends = np.minimum(np.cumsum(lengths), limit)
+	lengths = np.diff(ends, prepend=0)
+	image[:ends[-1]] = np.repeat(values, lengths)
+	return image.reshape(height, width)
 
+# RLE4 high nibble to pixel value, 0x0 and 0xf start a run of black or
+# white, the other nibbles are single anti-aliased pixels
+_RLE4_GREY = np.array([0] + [(nibble << 4) | nibble for nibble in range(1, 0xf)] + [0xfe], dtype=np.uint8)
 
-def read_rle1array(width: int, height: int, data: bytes):
-	array: List[List[int]] = [[]]
+def decode_rle4(
+	width: int,
+	height: int,
+	antialias: int,
+	data: bytes,
+	out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+	"""
+	Decodes a RLE4 encoded Anycubic layer into a ``height x width`` uint8
+	array. The high nibble of each token byte is the pixel value, 0x0 and
+	0xf are runs of black and white whose 12 bit length is the low nibble
+	followed by the next byte. Other values are single grey pixels that are
+	masked with the anti-alias level. Decodes into ``out`` if given.
+	"""
+	buf = np.frombuffer(data, dtype=np.uint8)
+	nibble = buf >> 4
+	is_run = (nibble == 0) | (nibble == 0xf)
+	offsets = _walk_tokens(np.where(is_run, 2, 1))
 
-	(i, x) = (0, 0)
-	while i < len(data) and len(array) < height+1:
-		grey = struct.unpack_from("<B", data, i)[0]
-		i += 1
-		nr = grey & ~(1 << 7)  # turn highest bit of
-		L = grey >> 7  # only read 1st bit
-		repeat = 1
-		if grey & ~(1 << 7):
-			repeat = nr
-	
-		while repeat > 0:
-			array[-1] += [L]
-			repeat -= 1
-	
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-	
-	array.pop()
-	return array
-	
-def read_rle4array(width: int, height: int, antialias: int, data: bytes):
-	array: List[List[int]] = [[]]
+	padded = np.zeros(len(buf) + 1, dtype=np.uint8)
+	padded[:len(buf)] = buf
+	header = buf[offsets]
+	is_run = is_run[offsets]
+	lengths = np.where(
+		is_run,
+		(header & 0x0f).astype(np.int64) << 8 | padded[offsets + 1],
+		1,
+	)
+	values = _RLE4_GREY[header >> 4]
+	values = np.where(is_run, values, values & (antialias & 0xff))
+	return _expand_runs(width, height, values, lengths, out)
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		color = 0
-		nr = grey & 0xf  # turn highest bit of
-		L = grey >> 4  # only read 1st bit
-		repeat = 1
-		if L == 0x0:
-			color = 0x00
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		elif L == 0xf:
-			color = 0xff - 1
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		else:
-			color = L << 4 | L
-			color &= antialias
-		i+=1
+def decode_rle1(
+	width: int,
+	height: int,
+	data: bytes,
+	out: Optional[np.ndarray] = None,
+	packed: bool = False,
+) -> np.ndarray:
+	"""
+	Decodes a RLE1 encoded Photon/PWS layer into a ``height x width``
+	uint8 array of 0 and 1. Bit 7 of each byte is the pixel value, bits
+	6:0 the run length, 0 meaning a single pixel. Every byte is a token,
+	so the whole stream is decoded with array operations. Decodes into
+	``out`` if given. With packed the rows are returned bit-packed by
+	``np.packbits``, a ``height x ceil(width/8)`` array.
+	"""
+	buf = np.frombuffer(data, dtype=np.uint8)
+	lengths = (buf & 0x7f).astype(np.int64)
+	lengths[lengths == 0] = 1
+	image = _expand_runs(width, height, buf >> 7, lengths, out)
+	if packed:
+		return np.packbits(image, axis=1)
+	return image
 
-		while repeat > 0:
-			array[-1] += [color]
-			repeat -= 1
+def decode_gray(width: int, height: int, data: bytes, out: Optional[np.ndarray] = None) -> np.ndarray:
+	"""
+	Decodes a grey RLE encoded FDG layer into a ``height x width`` uint8
+	array. A byte with bit 7 set is one pixel of a new colour, bits 6:0
+	scaled to 8 bit with values from 0xfc up made white. A byte with bit 7
+	clear repeats the last colour that many times, white before the first
+	colour. The last colour of every byte is found with a running maximum
+	over the colour byte positions. Decodes into ``out`` if given.
+	"""
+	buf = np.frombuffer(data, dtype=np.uint8)
+	is_colour = (buf & 0x80) != 0
+	colours = ((buf & 0x7f) << 1) | (buf & 1)
+	colours[colours >= 0xfc] = 0xff
+	# index of the last colour byte at or before each byte, -1 if none yet
+	last = np.where(is_colour, np.arange(len(buf)), -1)
+	np.maximum.accumulate(last, out=last)
+	values = np.where(last >= 0, colours[last], 0xff).astype(np.uint8)
+	lengths = np.where(is_colour, 1, buf).astype(np.int64)
+	return _expand_runs(width, height, values, lengths, out)
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
+def _extend_to_8bit(channel: np.ndarray, bits: int) -> np.ndarray:
+	"""Scales a 5 or 6 bit channel to 8 bit, repeating its top bits."""
+	return ((channel << (8 - bits)) | (channel >> (2*bits - 8))).astype(np.uint8)
 
-	array.pop()
-	return array
+def _rgb_image(width: int, height: int, r, g, b) -> np.ndarray:
+	image = np.empty((height, width, 3), dtype=np.uint8)
+	image[..., 0] = r.reshape(height, width)
+	image[..., 1] = g.reshape(height, width)
+	image[..., 2] = b.reshape(height, width)
+	return image
 
-def read_rle7array(width: int, height: int, data: bytes):
-	array: List[List[int]] = [[]]
+def decode_rgb15(width: int, height: int, data: bytes) -> np.ndarray:
+	"""
+	Decodes a RLE RGB15 preview of the Chitubox and Photon formats into a
+	``height x width x 3`` uint8 RGB array.
+	Based on https://github.com/Reonarudo/pcb2photon/issues/2
+	Encoding scheme:
+	The color (R,G,B) of a pixel spans 2 bytes (little endian) and each
+	color component is 5 bits: RRRRR GGG GG X BBBBB
+	If the X bit is set, then the next 2 bytes (little endian) masked
+	with 0xFFF represents how many more times to repeat that pixel.
+	The 5 bit components are scaled to 8 bit, missing pixels stay black.
+	"""
+	words = np.frombuffer(data, dtype="<u2", count=len(data) // 2)
+	is_run = (words & REPEAT_RGB15_MASK) != 0
+	offsets = _walk_tokens(np.where(is_run, 2, 1))
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		# From each byte retrieve 
-		# bit 7(MSB) (highest bit)  single unique pixel(0) or run(1)
-		# bits 6:0(LSB) (lowest 7 bits) number of pixels of that color
-		# If a run is present, its length is encoded in the following 1-4 bytes.
-		code = grey
-		repeat = 1
-		if (grey & 0x80) == 0x80:
-			# Its a run
-			code = code & 0x7f# value of pixel 0-127
-			i+=1
-			# get the run length
-			rlen = struct.unpack_from("<B", data, i)[0]
-			if (rlen&0x80) == 0:
-				# 7 bit run length
-				repeat = rlen
-				#print(i, repeat,type(repeat), L)
-			elif (rlen&0xC0) == 0x80:
-				# 14 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat = rlen&0x3f
-				repeat = repeat << 8 | repeat2
-				#print(i, repeat,type(repeat), L)
-				i+=1
-			elif (rlen&0xE0) == 0xC0:
-				# 21 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat = rlen&0x1F
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				i += 2
-			elif (rlen&0xF0) == 0xE0:
-				# 28 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat4 = struct.unpack_from("<B", data, i+3)[0]
-				repeat = rlen&0xf
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				repeat = repeat << 8 | repeat4
-				i += 3
-			else:
-				return png.from_array(array, "L"), array
+	padded = np.zeros(len(words) + 1, dtype=np.uint16)
+	padded[:len(words)] = words
+	colors = words[offsets]
+	lengths = np.where(is_run[offsets], 1 + (padded[offsets + 1] & 0xFFF).astype(np.int64), 1)
 
-		# Bit extend from 7-bit to 8-bit greymap
-		if (code != 0):
-			code = ((code << 1) | 1)
-			
-		while repeat > 0:# and len(array) < height+1:
-			array[-1] += [code]
-			repeat -= 1
+	limit = width * height
+	ends = np.minimum(np.cumsum(lengths), limit)
+	pixels = np.zeros(limit, dtype=np.uint16)
+	if len(ends):
+		pixels[:ends[-1]] = np.repeat(colors, np.diff(ends, prepend=0))
+	return _rgb_image(
+		width,
+		height,
+		_extend_to_8bit(pixels & 0x1F, 5),
+		_extend_to_8bit((pixels >> 6) & 0x1F, 5),
+		_extend_to_8bit((pixels >> 11) & 0x1F, 5),
+	)
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-		i+=1
-			
-	array.pop()
-	return array
+def decode_rgb565(width: int, height: int, data: bytes) -> np.ndarray:
+	"""
+	Decodes the uncompressed RGB565 preview of the Anycubic formats, one
+	little endian RRRRR GGGGGG BBBBB word per pixel, into a ``height x
+	width x 3`` uint8 RGB array. Missing pixels stay black.
+	"""
+	limit = width * height
+	pixels = np.zeros(limit, dtype=np.uint16)
+	words = np.frombuffer(data, dtype="<u2", count=min(len(data) // 2, limit))
+	pixels[:len(words)] = words
+	return _rgb_image(
+		width,
+		height,
+		_extend_to_8bit((pixels >> 11) & 0x1F, 5),
+		_extend_to_8bit((pixels >> 5) & 0x3F, 6),
+		_extend_to_8bit(pixels & 0x1F, 5),
+	)
@@ -0,0 +1,178 @@
+import concurrent.futures
+import multiprocessing
+import os
+import pathlib
+import runpy
+import threading
+from typing import TYPE_CHECKING, Callable, Optional
+
+import numpy as np
+
+from .utils import get_file_format, get_file_format_modules
+
+if TYPE_CHECKING:
+	from .layers import LayerTable
+
+# layers one worker decodes per task, small enough that an abort or the
+# end of the pass never waits long for a running task
+CHUNK_LAYERS = 32
+
+# seconds between abort checks while waiting for the workers
+ABORT_CHECK_INTERVAL = 0.1
+
+
+def _chunk_statistics(path: str, start: int, stop: int):
+	"""
+	Decodes layers start to stop of path one after another into the same
+	buffer. Returns start, the lit pixel count of every layer and which
+	rows and columns are lit in any of them.
+	"""
+	areas = []
+	with get_file_format(path).open_layers(pathlib.Path(path)) as layers:
+		source = layers.source
+		layer = np.zeros((source.height, source.width), dtype=np.uint8)
+		lit = np.empty(layer.shape, dtype=bool)
+		rows = np.zeros(source.height, dtype=bool)
+		cols = np.zeros(source.width, dtype=bool)
+		for index in range(start, stop):
+			decoded = layers.decode_layer(index, layer)
+			np.not_equal(decoded, 0, out=lit)
+			area = int(np.count_nonzero(lit))
+			if area:
+				rows |= lit.any(axis=1)
+				cols |= lit.any(axis=0)
+			areas.append(area)
+	return start, areas, rows, cols
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+def _get_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+	"""
+	The worker pool shared by all analyses, started on first use and again
+	if more workers are asked for. Workers are not forked from OctoPrint,
+	which is heavily threaded, but come from a fork server where available
+	or are spawned. stats_worker imports this module and the format modules
+	into them without the plugin package's __init__.
+	"""
+	global _pool, _pool_workers
+	with _pool_lock:
+		if _pool is None or _pool_workers < workers:
+			if _pool is not None:
+				_pool.shutdown(wait=False)
+			methods = multiprocessing.get_all_start_methods()
+			context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+			here = os.path.dirname(os.path.abspath(__file__))
+			_pool = concurrent.futures.ProcessPoolExecutor(
+				workers,
+				mp_context=context,
+				initializer=runpy.run_path,
+				initargs=(os.path.join(here, "stats_worker.py"), {
+					"PACKAGE": __package__.rpartition(".")[0],
+					"PACKAGE_PATH": os.path.dirname(here),
+					"MODULES": [__name__] + sorted(get_file_format_modules()),
+				}),
+			)
+			_pool_workers = workers
+		return _pool
+
+def _drop_pool(pool):
+	"""Forgets a pool whose workers died, the next analysis starts a new one."""
+	global _pool
+	with _pool_lock:
+		if _pool is pool:
+			_pool = None
+
+
+def layer_statistics(
+	path: str,
+	workers: Optional[int] = None,
+	is_aborted: Optional[Callable[[], bool]] = None,
+	layer_table: Optional["LayerTable"] = None,
+) -> Optional[dict]:
+	"""
+	Decodes every layer of the sliced file at path once and returns the
+	lit area of each layer, the bounding box of the whole print, the
+	volume as the sum of lit area times layer thickness and the largest
+	cross-section. The thickness of each layer is its Z step in
+	layer_table, or the header's layer height without one. Chunks of
+	layers are spread over a pool of worker processes, each decoding into
+	a single reused layer buffer. is_aborted is polled while waiting for
+	them, if it returns True the pass stops and None is returned.
+	"""
+	source = get_file_format(path).layer_source(pathlib.Path(path))
+	count = len(source)
+	chunks = [(start, min(start + CHUNK_LAYERS, count)) for start in range(0, count, CHUNK_LAYERS)]
+	if workers is None:
+		workers = os.cpu_count() or 1
+	workers = min(workers, len(chunks))
+
+	results = []
+	if workers <= 1:
+		for start, stop in chunks:
+			if is_aborted is not None and is_aborted():
+				return None
+			results.append(_chunk_statistics(path, start, stop))
+	else:
+		pool = _get_pool(workers)
+		try:
+			pending = {pool.submit(_chunk_statistics, path, start, stop) for start, stop in chunks}
+			while pending:
+				done, pending = concurrent.futures.wait(
+					pending,
+					timeout=ABORT_CHECK_INTERVAL,
+					return_when=concurrent.futures.FIRST_COMPLETED,
+				)
+				results.extend(future.result() for future in done)
+				if is_aborted is not None and is_aborted():
+					for future in pending:
+						future.cancel()
+					return None
+		except concurrent.futures.BrokenExecutor:
+			_drop_pool(pool)
+			raise
+
+	results.sort(key=lambda result: result[0])
+	areas = np.array([area for result in results for area in result[1]], dtype=np.int64)
+	rows = np.zeros(source.height, dtype=bool)
+	cols = np.zeros(source.width, dtype=bool)
+	for _, _, chunk_rows, chunk_cols in results:
+		rows |= chunk_rows
+		cols |= chunk_cols
+	position_z_mm = np.arange(1, count + 1)*float(source.layer_height_mm)
+	if layer_table is not None and len(layer_table) == count:
+		table_z_mm = layer_table.position_z_mm.astype(np.float64)
+		# some slicers leave Z unset, it has to rise over the print to be used
+		if count == 1 or (table_z_mm[-1] > table_z_mm[0] and np.all(np.diff(table_z_mm) >= 0)):
+			position_z_mm = table_z_mm
+	return _summarize(source, areas, rows, cols, position_z_mm)
+
+
+def _summarize(source, areas, rows, cols, position_z_mm) -> dict:
+	pixel_size_x, pixel_size_y = source.pixel_size_mm
+	pixel_area = pixel_size_x*pixel_size_y
+	layer_area_mm2 = areas*pixel_area
+	thickness_mm = np.diff(position_z_mm, prepend=0.0)
+
+	# same axes and pixel size as get_printarea of the format modules
+	minX = maxX = minY = maxY = height = 0.0
+	if rows.any():
+		lit_rows = np.flatnonzero(rows)
+		lit_cols = np.flatnonzero(cols)
+		minX = float(lit_rows[0]*pixel_size_x)
+		maxX = float((lit_rows[-1] + 1)*pixel_size_x)
+		minY = float(lit_cols[0]*pixel_size_x)
+		maxY = float((lit_cols[-1] + 1)*pixel_size_x)
+		height = float(position_z_mm[np.flatnonzero(areas)[-1]])
+
+	largest = int(np.argmax(areas)) if len(areas) else 0
+	return {
+		"layer_area_mm2": [round(area, 3) for area in layer_area_mm2.tolist()],
+		"max_area_mm2": round(float(layer_area_mm2[largest]), 3) if len(areas) else 0.0,
+		"max_area_layer": largest + 1,
+		"volume_ml": round(float(np.dot(layer_area_mm2, thickness_mm))/1000.0, 3),
+		"printing_area": {"minX": minX, "maxX": maxX, "minY": minY, "maxY": maxY},
+		"dimensions": {"width": maxX - minX, "depth": maxY - minY, "height": height},
+	}
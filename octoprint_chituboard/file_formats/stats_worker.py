@@ -0,0 +1,23 @@
+"""
+Initializer of the layer statistics worker processes, run by path with
+runpy.run_path instead of being imported, so the plugin package's
+__init__, which imports OctoPrint and flask, never runs in them.
+
+A bare module stands in for the plugin package, the stats and format
+modules are then imported under their usual names, the same ones the
+tasks sent to the workers refer to. run_path is given PACKAGE, the name
+of the plugin package, PACKAGE_PATH, its directory, and MODULES, the
+modules to import.
+"""
+
+import importlib
+import sys
+import types
+
+if PACKAGE not in sys.modules:
+	package = types.ModuleType(PACKAGE)
+	package.__path__ = [PACKAGE_PATH]
+	sys.modules[PACKAGE] = package
+
+for module in MODULES:
+	importlib.import_module(module)
@@ -1,34 +1,154 @@
+import dataclasses
+import importlib
+import importlib.util
+import logging
 import os
-from typing import Mapping, Set, Type
+import struct
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple, Type, Union
 
 from . import SlicedModelFile
-from .ctb import CTBFile
-from .cbddlp import CBDDLPFile
-from .fdg import FDGFile
-from .photon import PhotonFile
-from .pws import PwsFile
-from .pwms import PwmsFile
-
-EXTENSION_TO_FILE_FORMAT: Mapping[str, Type[SlicedModelFile]] = {
-	".ctb": CTBFile,
-	".cbddlp": CBDDLPFile,
-	".photon": PhotonFile,
-	".fdg": FDGFile,
-	".pws": PwsFile,
-	".pw0": PwmsFile,
-	".pwmo": PwmsFile,
-	".pwms": PwmsFile,
-	".pwmx": PwmsFile,
-}
+
+# most bytes detect_file_format reads from the start of a file
+MAX_HEADER_SIZE = 512
+
+
+class UnsupportedFileFormat(ValueError):
+	pass
+
+
+@dataclass(frozen=True)
+class FileFormatSpec:
+	"""
+	How to recognise a sliced file format and where its reader lives.
+
+	A file is of this format if it has magic at magic_offset and match, if
+	given, returns True for the first header_size bytes of the file. reader
+	is the SlicedModelFile subclass or its "module:Class" name, relative to
+	this package if it starts with a dot. Named readers are only imported
+	the first time a file of the format is looked up, the format modules
+	pull in numpy, png and typedstruct.
+	"""
+	name: str
+	extensions: Tuple[str, ...]
+	magic: bytes
+	reader: Union[str, Type[SlicedModelFile]]
+	magic_offset: int = 0
+	header_size: int = 0
+	match: Optional[Callable[[bytes], bool]] = None
+
+	def matches(self, header: bytes) -> bool:
+		end = self.magic_offset + len(self.magic)
+		if header[self.magic_offset:end] != self.magic:
+			return False
+		if self.match is None:
+			return True
+		return len(header) >= self.header_size and self.match(header)
+
+
+def _is_pws(header: bytes) -> bool:
+	# Photon S files are version 1. The 4 bit formats use later versions, or
+	# also version 1 like the Photon Zero, then only the extension tells.
+	return struct.unpack_from("<I", header, 12)[0] == 1
+
+_file_formats: List[FileFormatSpec] = []
+_extension_to_formats: Dict[str, List[FileFormatSpec]] = {}
+_loaded_file_formats: Dict[str, Type[SlicedModelFile]] = {}
+
+def register_file_format(spec: FileFormatSpec, first: bool = False):
+	"""
+	Adds a format to the registry, also from outside this package:
+
+		register_file_format(FileFormatSpec(
+			name="goo",
+			extensions=(".goo",),
+			magic=b"\\x07\\x00\\x00\\x00DLP\\x00",
+			magic_offset=4,
+			reader="my_plugin.goo:GooFile",
+		))
+
+	Formats registered with first are tried before the others, e.g. to
+	override a built-in one. A file matching several formats goes to the
+	one registered for its extension, or else to the first.
+	"""
+	if max(spec.magic_offset + len(spec.magic), spec.header_size) > MAX_HEADER_SIZE:
+		raise ValueError("Header of {} is longer than {} bytes".format(spec.name, MAX_HEADER_SIZE))
+	spec = dataclasses.replace(spec, extensions=tuple(extension.lower() for extension in spec.extensions))
+
+	for specs in [_file_formats] + [_extension_to_formats.setdefault(extension, []) for extension in spec.extensions]:
+		if first:
+			specs.insert(0, spec)
+		else:
+			specs.append(spec)
+	_loaded_file_formats.pop(spec.name, None)
+
+register_file_format(FileFormatSpec("ctb", (".ctb",), struct.pack("<I", 0x12FD0086), ".ctb:CTBFile"))
+register_file_format(FileFormatSpec("photon", (".photon", ".cbddlp"), struct.pack("<I", 0x12FD0019), ".photon:PhotonFile"))
+register_file_format(FileFormatSpec("fdg", (".fdg",), struct.pack("<I", 0xBD3C7AC8), ".fdg:FDGFile"))
+register_file_format(FileFormatSpec(
+	"pws", (".pws",), b"ANYCUBIC\0\0\0\0", ".pws:PwsFile", header_size=16, match=_is_pws))
+register_file_format(FileFormatSpec(
+	"pwms", (".pw0", ".pwmo", ".pwms", ".pwmx"), b"ANYCUBIC\0\0\0\0", ".pwms:PwmsFile"))
+
+def _load_file_format(spec: FileFormatSpec) -> Type[SlicedModelFile]:
+	file_format = _loaded_file_formats.get(spec.name)
+	if file_format is not None:
+		return file_format
+	if isinstance(spec.reader, str):
+		module_name, class_name = spec.reader.split(":")
+		start = time.perf_counter()
+		module = importlib.import_module(module_name, __package__)
+		file_format = getattr(module, class_name)
+		logging.getLogger(__name__).debug("Loaded {} for {} files in {:.1f}ms".format(
+			class_name, spec.name, (time.perf_counter() - start) * 1000))
+	else:
+		file_format = spec.reader
+	_loaded_file_formats[spec.name] = file_format
+	return file_format
+
+def detect_file_format_spec(path: str) -> FileFormatSpec:
+	"""
+	Finds the format of the file at path from the magic number at its start,
+	reading at most MAX_HEADER_SIZE bytes. Raises UnsupportedFileFormat if
+	no registered format matches.
+	"""
+	with open(path, "rb") as file:
+		header = file.read(MAX_HEADER_SIZE)
+	candidates = [spec for spec in _file_formats if spec.matches(header)]
+	if not candidates:
+		raise UnsupportedFileFormat("{} is not a supported sliced file".format(path))
+
+	(_, extension) = os.path.splitext(path)
+	for spec in _extension_to_formats.get(extension.lower(), ()):
+		if spec in candidates:
+			return spec
+	return candidates[0]
+
+def detect_file_format(path: str) -> Type[SlicedModelFile]:
+	return _load_file_format(detect_file_format_spec(path))
 
 def get_file_format(filename: str) -> Type[SlicedModelFile]:
+	"""
+	Reader for filename. Existing files are recognised by their magic
+	number, so a renamed file still gets the right reader, other names by
+	their extension.
+	"""
+	if os.path.isfile(filename):
+		return detect_file_format(filename)
+
 	(_, extension) = os.path.splitext(filename)
+	specs = _extension_to_formats.get(extension.lower())
+	if not specs:
+		raise UnsupportedFileFormat("No reader for {} files".format(extension))
+	return _load_file_format(specs[0])
 
-	file_format = EXTENSION_TO_FILE_FORMAT.get(extension.lower())
 
-	assert file_format is not None
-	return file_format
+def get_file_format_modules() -> Set[str]:
+	"""Absolute names of the modules of all named readers, e.g. to preload them."""
+	return set(importlib.util.resolve_name(spec.reader.split(":")[0], __package__)
+		for spec in _file_formats if isinstance(spec.reader, str))
 
 
 def get_supported_extensions() -> Set[str]:
-	return set(EXTENSION_TO_FILE_FORMAT.keys())
+	return set(_extension_to_formats.keys())
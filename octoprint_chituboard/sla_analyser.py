@@ -14,8 +14,136 @@ from octoprint.util import get_fully_qualified_classname as fqcn
 from octoprint.util import monotonic_time
 from octoprint.util.platform import CLOSE_FDS
 
+from .file_formats import ReadAborted
 from .file_formats.utils import get_file_format
+from .sla_cache import cached_read, preview_cache
 from pathlib import Path
+import subprocess
+
+# seconds between abort checks while waiting for the analysis subprocess
+ABORT_CHECK_INTERVAL = 0.1
+
+
+def children_cpu_time():
+	"""
+	CPU seconds (user + system) used so far by all terminated and waited
+	for child processes, None on platforms without the resource module.
+	"""
+	try:
+		import resource
+	except ImportError:
+		return None
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return usage.ru_utime + usage.ru_stime
+
+
+def analysis_in_process():
+	"""
+	Whether files are analysed inside OctoPrint's analysis worker thread
+	instead of a ``octoprint plugins chituboard:sla_analysis`` subprocess.
+	Defaults to True if the setting was never saved.
+	"""
+	return settings().getBoolean(["plugins", "chituboard", "analysisInProcess"]) is not False
+
+def analyse_all_layers():
+	"""
+	Whether the analysis decodes every layer for the whole-print statistics
+	or only looks at the first layer. Defaults to True if the setting was
+	never saved.
+	"""
+	return settings().getBoolean(["plugins", "chituboard", "analyseAllLayers"]) is not False
+
+def analyse_sliced_file(path, is_aborted=None):
+	"""
+	Runs the file_formats reader for path and returns the analysis as a
+	plain dict, with the same keys the sla_analysis CLI command prints.
+	is_aborted is polled between the analysis steps and while the layer
+	table is read, if it returns True AnalysisAborted is raised.
+	"""
+	from octoprint.filemanager.analysis import AnalysisAborted
+
+	def check_aborted():
+		if is_aborted is not None and is_aborted():
+			raise AnalysisAborted()
+
+	check_aborted()
+	file_format = get_file_format(path)
+	try:
+		sliced_model_file = cached_read(path, lambda: file_format.read(Path(path), is_aborted=is_aborted))
+	except ReadAborted:
+		raise AnalysisAborted()
+	check_aborted()
+	analysis = {
+		"filename": sliced_model_file.filename,
+		"path": path,
+		"bed_size_mm": list(sliced_model_file.bed_size_mm),
+		"height_mm": round(sliced_model_file.height_mm, 4),
+		"layer_count": sliced_model_file.layer_count,
+		"layer_height_mm": round(sliced_model_file.layer_height_mm, 4),
+		"resolution": list(sliced_model_file.resolution),
+		"print_time_secs": sliced_model_file.print_time_secs,
+		"total_time": sliced_model_file.print_time_secs/60,
+		"volume": sliced_model_file.volume,
+		"printer name": sliced_model_file.printer_name,
+		"printing_area": sliced_model_file.printing_area,
+		"dimensions": sliced_model_file.dimensions,
+		}
+	if not analyse_all_layers():
+		return analysis
+
+	from .file_formats.stats import layer_statistics
+	try:
+		statistics = layer_statistics(path, is_aborted=is_aborted, layer_table=sliced_model_file.layer_table)
+	except Exception:
+		logging.getLogger(__name__).exception(
+			"Decoding all layers of {} failed, using the first layer only".format(path))
+		return analysis
+	check_aborted()
+	analysis["printing_area"] = statistics.pop("printing_area")
+	analysis["dimensions"] = statistics.pop("dimensions")
+	analysis["volume"] = statistics["volume_ml"]
+	analysis["layer_statistics"] = statistics
+	return analysis
+
+def analysis_to_metadata(analysis, path):
+	"""
+	Converts the dict from analyse_sliced_file into the structure
+	OctoPrint stores as file analysis metadata.
+	"""
+	result = {}
+	try:
+		analysis["total_time"] = analysis["print_time_secs"]
+	except Exception as inst:
+		logging.getLogger(__name__).debug("Failed to set total_time: {}".format(inst))
+		analysis["total_time"] = analysis.get("print_time_secs", 0)
+	
+	result["printingArea"] = analysis.get("printing_area", {})
+	result["dimensions"] = analysis.get("dimensions", {})
+	
+	if analysis.get("total_time"):
+		result["estimatedPrintTime"] = analysis["print_time_secs"]
+		
+	if analysis.get("volume"):
+		result["filament"] = {}
+		radius = 1.75/2
+		result["filament"]["tool0"] = {
+				"length": analysis["volume"]/(math.pi*radius*radius),
+				"volume": analysis["volume"],}
+	
+	if analysis.get('layer_count'):
+		result['layer_count'] = analysis['layer_count']
+	
+	if analysis.get('layer_height_mm'):
+		result['layer_height_mm'] = analysis['layer_height_mm']
+	
+	if analysis.get('printer name'):
+		result['printer_name'] = analysis['printer name']
+	
+	if analysis.get('layer_statistics'):
+		result['layer_statistics'] = analysis['layer_statistics']
+	
+	result['path'] = analysis.get('path', path)
+	return result
 
 
 class sla_AnalysisQueue(AbstractAnalysisQueue):
@@ -31,10 +159,7 @@ class sla_AnalysisQueue(AbstractAnalysisQueue):
 		self._reenqueue = False
 
 	def _do_analysis(self, high_priority=False):
-		import sys
-		from io import TextIOWrapper
-		import sarge
-		import yaml
+		from octoprint.filemanager.analysis import AnalysisAborted
 		
 		if self._current.analysis and all(
 			map(
@@ -45,111 +170,26 @@ class sla_AnalysisQueue(AbstractAnalysisQueue):
 			return self._current.analysis
 		
 		try:
-			command = [
-				sys.executable,
-				"-m",
-				"octoprint",
-				"plugins",
-				"chituboard:sla_analysis",
-			]
-			command.append(self._current.absolute_path)
-			self._logger.debug("Invoking analysis commands: {}".format(" ".join(command)))
-		
 			self._aborted = False
-			p = sarge.run(
-				command, close_fds=CLOSE_FDS, async_=True, stdout=sarge.Capture()
-			)
-			self._logger.debug("check sarge process: ", p.commands[0])
-			while len(p.commands) == 0:
-				# somewhat ugly... we can't use wait_events because
-				# the events might not be all set if an exception
-				# by sarge is triggered within the async process
-				# thread
-				time.sleep(0.01)
-			self._logger.debug("check sarge process: ", p.commands[0])
-
-			# by now we should have a command, let's wait for its
-			# process to have been prepared
-			p.commands[0].process_ready.wait()
-			
-			if not p.commands[0].process:
-				# the process might have been set to None in case of any exception
-				raise RuntimeError(
-					"Error while trying to run command {}".format(" ".join(command))
-				)
-			try:
-				# let's wait for stuff to finish
-				while p.returncode is None:
-					if self._aborted:
-						# oh, we shall abort, let's do so!
-						p.commands[0].terminate()
-						from octoprint.filemanager.analysis import AnalysisAborted
-						raise AnalysisAborted(reenqueue=self._reenqueue)
-					# else continue
-					p.commands[0].poll()
-			finally:
-				p.close()
-			output = p.stdout.text
-			self._logger.debug("Got output: {!r}".format(output))
+			if analysis_in_process():
+				analysis = self._analyse_in_process()
+			else:
+				analysis = self._analyse_in_subprocess()
+			self._cache_preview()
 			
 			result = {}
-			if "ERROR:" in output:
-				_, error = output.split("ERROR:")
-				raise RuntimeError(error.strip())
-			elif "EMPTY:" in output:
+			if analysis is None:
 				self._logger.info("Result is empty, no extrusions found")
-			elif "RESULTS:" not in output:
-				raise RuntimeError("No analysis result found")
 			else:
-				self._logger.debug("passed if-else block")
-				_, output = output.split("RESULTS:")
-				self._logger.debug("passed output split {!r}".format(output))
-				analysis = {}
-				try:
-					analysis = yaml.safe_load(output)
-				except Exception as inst:
-					self._logger.debug("yaml load output failed, analysis type:", inst)
-					analysis = {
-						"printing_area": {'minX': 5.0,'minY': 5.0, 'minZ': 5.0, 'maxX': 10.0, 'maxY': 10.0, 'maxZ': 10.0},
-						"dimensions": {'width': 82.62, 'depth': 130.56, 'height': 12},
-						"print_time_secs": 5500,
-						"volume": 500
-					}
-				
-				try:
-					analysis["total_time"] = analysis["print_time_secs"]
-				except Exception as inst:
-					self._logger.debug("Failed to set total_time:", inst)
-					analysis["total_time"] = analysis.get("print_time_secs", 0)
-				
-				result["printingArea"] = analysis.get("printing_area", {})
-				result["dimensions"] = analysis.get("dimensions", {})
-				
-				if analysis.get("total_time"):
-					result["estimatedPrintTime"] = analysis["print_time_secs"]
-					
-				if analysis.get("volume"):
-					result["filament"] = {}
-					radius = 1.75/2
-					result["filament"]["tool0"] = {
-							"length": analysis["volume"]/(math.pi*radius*radius),
-							"volume": analysis["volume"],}
-				
-				if analysis.get('layer_count'):
-					result['layer_count'] = analysis['layer_count']
-				
-				if analysis.get('layer_height_mm'):
-					result['layer_height_mm'] = analysis['layer_height_mm']
-				
-				if analysis.get('printer name'):
-					result['printer_name'] = analysis['printer name']
-				
-				result['path'] = analysis.get('path', self._current.absolute_path)
+				result = analysis_to_metadata(analysis, self._current.absolute_path)
 
 			if self._current.analysis and isinstance(self._current.analysis, dict):
 				return dict_merge(result, self._current.analysis)
 			else:
 				return result
+		except AnalysisAborted as aborted:
+			aborted.reenqueue = self._reenqueue
+			raise
 		except Exception as inst:
 			self._logger.debug("Analysis for {} ran into error: {}".format(self._current, inst))
 			# Return a basic result structure to prevent complete failure
@@ -165,6 +205,121 @@ class sla_AnalysisQueue(AbstractAnalysisQueue):
 		finally:
 			self._gcode = None	
 
+	def _cache_preview(self):
+		"""
+		Renders the preview of the analysed file into the preview cache, so
+		the first request for its thumbnail does not have to decode it.
+		"""
+		cache = preview_cache()
+		if cache is not None:
+			cache.get_or_render(self._current.absolute_path)
+
+	def _analyse_in_process(self):
+		"""
+		Runs the file_formats reader directly in the analysis worker thread,
+		aborting cooperatively through self._aborted.
+		"""
+		start_time = monotonic_time()
+		cpu_before = time.thread_time()
+		try:
+			return analyse_sliced_file(
+				self._current.absolute_path,
+				is_aborted=lambda: self._aborted,
+			)
+		finally:
+			self._log_cpu_usage("In-process analysis", start_time, cpu_before, time.thread_time())
+
+	def _log_cpu_usage(self, kind, start_time, cpu_before, cpu_after):
+		if cpu_before is None or cpu_after is None:
+			return
+		self._logger.info("{} of {} used {:.2f}s CPU in {:.2f}s".format(
+			kind,
+			self._current.absolute_path,
+			cpu_after - cpu_before,
+			monotonic_time() - start_time))
+
+	def _analyse_in_subprocess(self):
+		"""
+		Runs the sla_analysis CLI command in a new interpreter and parses
+		the YAML it prints. Returns None if the result is empty.
+		"""
+		import sys
+		import sarge
+		import yaml
+		
+		command = [
+			sys.executable,
+			"-m",
+			"octoprint",
+			"plugins",
+			"chituboard:sla_analysis",
+		]
+		command.append(self._current.absolute_path)
+		self._logger.debug("Invoking analysis commands: {}".format(" ".join(command)))
+
+		start_time = monotonic_time()
+		cpu_before = children_cpu_time()
+		p = sarge.run(
+			command, close_fds=CLOSE_FDS, async_=True, stdout=sarge.Capture()
+		)
+		while len(p.commands) == 0:
+			# somewhat ugly... we can't use wait_events because
+			# the events might not be all set if an exception
+			# by sarge is triggered within the async process
+			# thread
+			time.sleep(0.01)
+		self._logger.debug("check sarge process: {}".format(p.commands[0]))
+
+		# by now we should have a command, let's wait for its
+		# process to have been prepared
+		p.commands[0].process_ready.wait()
+		
+		if not p.commands[0].process:
+			# the process might have been set to None in case of any exception
+			raise RuntimeError(
+				"Error while trying to run command {}".format(" ".join(command))
+			)
+		try:
+			# let's wait for stuff to finish, blocking on the child but
+			# waking up regularly to see whether we shall abort
+			while True:
+				try:
+					p.commands[0].wait(timeout=ABORT_CHECK_INTERVAL)
+					break
+				except subprocess.TimeoutExpired:
+					if self._aborted:
+						# oh, we shall abort, let's do so!
+						p.commands[0].terminate()
+						from octoprint.filemanager.analysis import AnalysisAborted
+						raise AnalysisAborted(reenqueue=self._reenqueue)
+		finally:
+			p.close()
+			self._log_cpu_usage("Analysis subprocess", start_time, cpu_before, children_cpu_time())
+		output = p.stdout.text
+		self._logger.debug("Got output: {!r}".format(output))
+		
+		if "ERROR:" in output:
+			_, error = output.split("ERROR:")
+			raise RuntimeError(error.strip())
+		elif "EMPTY:" in output:
+			return None
+		elif "RESULTS:" not in output:
+			raise RuntimeError("No analysis result found")
+
+		self._logger.debug("passed if-else block")
+		_, output = output.split("RESULTS:")
+		self._logger.debug("passed output split {!r}".format(output))
+		try:
+			return yaml.safe_load(output)
+		except Exception as inst:
+			self._logger.debug("yaml load output failed, analysis type: {}".format(inst))
+			return {
+				"printing_area": {'minX': 5.0,'minY': 5.0, 'minZ': 5.0, 'maxX': 10.0, 'maxY': 10.0, 'maxZ': 10.0},
+				"dimensions": {'width': 82.62, 'depth': 130.56, 'height': 12},
+				"print_time_secs": 5500,
+				"volume": 500
+			}
+
 	def _do_abort(self, reenqueue=True):
 		self._aborted = True
-		self._reenqueue = reenqueue
\ No newline at end of file
+		self._reenqueue = reenqueue
@@ -0,0 +1,284 @@
+# coding=utf-8
+
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import struct
+import tempfile
+import threading
+from typing import Callable, Optional, Tuple
+
+from .file_formats import SlicedModelFile
+from .file_formats.utils import get_file_format
+
+CACHE_MAGIC = b"CBSM"
+# bump whenever the stored fields change, older entries are then ignored
+CACHE_VERSION = 2
+CACHE_HEADER = struct.Struct("<4sHI")
+CACHE_SUFFIX = ".smf"
+# bump whenever the rendered previews change, so clients drop their copies
+PREVIEW_VERSION = 1
+
+
+def file_key(path, prefix="") -> Optional[str]:
+	"""
+	Hex digest identifying the current version of the file at path, from
+	its device, inode, size and mtime. None if the file does not exist.
+	"""
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	key = "{}{}:{}:{}:{}".format(prefix, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+	return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class _FileCache():
+	"""
+	Folder of cache entries derived from source files.
+
+	Entries are keyed by the file_key of the source file, so a modified or
+	re-uploaded file gets a fresh entry. Entries are written atomically,
+	hits touch the entry's mtime and the least recently used entries are
+	evicted once the folder grows past max_size bytes.
+	"""
+
+	# file name suffix of the entries, only those are ever evicted
+	suffix = ""
+	# part of the key, change it to invalidate all entries of a cache
+	key_prefix = ""
+
+	def __init__(self, folder, max_size):
+		self._logger = logging.getLogger(__name__)
+		self._folder = folder
+		self._max_size = max_size
+		self._lock = threading.Lock()
+		os.makedirs(self._folder, exist_ok=True)
+
+	def key(self, path) -> Optional[str]:
+		return file_key(path, self.key_prefix)
+
+	def _entry_path(self, path):
+		key = self.key(path)
+		if key is None:
+			return None
+		return os.path.join(self._folder, key + self.suffix)
+
+	def _touch(self, entry):
+		try:
+			os.utime(entry)
+		except OSError:
+			pass
+
+	def _write(self, path, entry, data) -> bool:
+		fd, tmp_path = tempfile.mkstemp(dir=self._folder, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as file:
+				file.write(data)
+			os.replace(tmp_path, entry)
+		except OSError:
+			self._logger.exception("Could not write cache entry for {}".format(path))
+			self._remove(tmp_path)
+			return False
+		self._evict()
+		return True
+
+	def _evict(self):
+		with self._lock:
+			entries = []
+			total = 0
+			with os.scandir(self._folder) as it:
+				for dir_entry in it:
+					if not dir_entry.name.endswith(self.suffix):
+						continue
+					try:
+						stat = dir_entry.stat()
+					except OSError:
+						continue
+					entries.append((stat.st_mtime_ns, stat.st_size, dir_entry.path))
+					total += stat.st_size
+			if total <= self._max_size:
+				return
+			entries.sort()
+			for _, size, entry in entries:
+				if total <= self._max_size:
+					break
+				self._remove(entry)
+				total -= size
+
+	def _remove(self, entry):
+		try:
+			os.remove(entry)
+		except OSError:
+			pass
+
+
+class SlicedModelFileCache(_FileCache):
+	"""
+	Persistent cache of parsed SlicedModelFile objects, so a file that is
+	selected again does not have to be parsed again. Each entry is one small
+	file: a header, the scalar fields as JSON and the layer table as written
+	by LayerTable.tobytes.
+	"""
+
+	suffix = CACHE_SUFFIX
+
+	def get(self, path) -> Optional[SlicedModelFile]:
+		entry = self._entry_path(path)
+		if entry is None:
+			return None
+		try:
+			with open(entry, "rb") as file:
+				data = file.read()
+			sliced_model_file = self._decode(path, data)
+		except FileNotFoundError:
+			return None
+		except Exception:
+			self._logger.exception("Dropping unreadable cache entry for {}".format(path))
+			self._remove(entry)
+			return None
+		if sliced_model_file is not None:
+			self._touch(entry)
+		return sliced_model_file
+
+	def put(self, path, sliced_model_file: SlicedModelFile):
+		entry = self._entry_path(path)
+		if entry is None:
+			return
+		try:
+			data = self._encode(sliced_model_file)
+		except (TypeError, ValueError):
+			self._logger.exception("Could not encode model data of {} for the cache".format(path))
+			return
+		self._write(path, entry, data)
+
+	def get_or_read(self, path, read: Callable[[], SlicedModelFile]) -> SlicedModelFile:
+		sliced_model_file = self.get(path)
+		if sliced_model_file is None:
+			sliced_model_file = read()
+			self.put(path, sliced_model_file)
+		else:
+			self._logger.debug("Using cached model data for {}".format(path))
+		return sliced_model_file
+
+	def _encode(self, sliced_model_file):
+		fields = {
+			"filename": sliced_model_file.filename,
+			"bed_size_mm": list(sliced_model_file.bed_size_mm),
+			"height_mm": sliced_model_file.height_mm,
+			"layer_height_mm": sliced_model_file.layer_height_mm,
+			"layer_count": sliced_model_file.layer_count,
+			"resolution": list(sliced_model_file.resolution),
+			"print_time_secs": sliced_model_file.print_time_secs,
+			"volume": sliced_model_file.volume,
+			"slicer_version": sliced_model_file.slicer_version,
+			"printer_name": sliced_model_file.printer_name,
+			"printing_area": sliced_model_file.printing_area,
+			"dimensions": sliced_model_file.dimensions,
+		}
+		meta = json.dumps(fields, separators=(",", ":")).encode("utf-8")
+		return CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(meta)) + meta + sliced_model_file.layer_table.tobytes()
+
+	def _decode(self, path, data):
+		from .file_formats.layers import LayerTable
+		magic, version, meta_size = CACHE_HEADER.unpack_from(data)
+		if magic != CACHE_MAGIC or version != CACHE_VERSION:
+			return None
+		start = CACHE_HEADER.size
+		fields = json.loads(data[start:start + meta_size].decode("utf-8"))
+		fields["bed_size_mm"] = tuple(fields["bed_size_mm"])
+		fields["resolution"] = tuple(fields["resolution"])
+		fields["layer_table"] = LayerTable.frombytes(memoryview(data)[start + meta_size:])
+		return get_file_format(path)(**fields)
+
+
+class PreviewCache(_FileCache):
+	"""
+	Persistent cache of the previews of sliced files, rendered once as PNG.
+	The key of an entry doubles as strong ETag of the preview, it changes
+	with the sliced file and with PREVIEW_VERSION.
+	"""
+
+	suffix = ".png"
+	key_prefix = "preview{}:".format(PREVIEW_VERSION)
+
+	def get(self, path) -> Optional[Tuple[str, bytes]]:
+		"""Returns the ETag and PNG data of the cached preview of path."""
+		entry = self._entry_path(path)
+		if entry is None:
+			return None
+		try:
+			with open(entry, "rb") as file:
+				data = file.read()
+		except OSError:
+			return None
+		self._touch(entry)
+		return os.path.basename(entry)[:-len(self.suffix)], data
+
+	def render(self, path) -> Optional[Tuple[str, bytes]]:
+		"""
+		Renders the preview of path and caches it. Returns None if the file
+		is gone or has no readable preview.
+		"""
+		entry = self._entry_path(path)
+		if entry is None:
+			return None
+		try:
+			image = get_file_format(path).read_preview(pathlib.Path(path))
+			buffer = io.BytesIO()
+			image.write(buffer)
+		except Exception:
+			self._logger.exception("Could not render the preview of {}".format(path))
+			return None
+		data = buffer.getvalue()
+		self._write(path, entry, data)
+		return os.path.basename(entry)[:-len(self.suffix)], data
+
+	def get_or_render(self, path) -> Optional[Tuple[str, bytes]]:
+		preview = self.get(path)
+		if preview is None:
+			preview = self.render(path)
+		return preview
+
+
+_model_cache = None
+
+def init_model_cache(folder, max_size):
+	"""
+	Sets up the cache shared by the printer and the analysis queue, called
+	by the plugin once its data folder is known.
+	"""
+	global _model_cache
+	_model_cache = SlicedModelFileCache(folder, max_size)
+	return _model_cache
+
+def model_cache() -> Optional[SlicedModelFileCache]:
+	return _model_cache
+
+def cached_read(path, read: Callable[[], SlicedModelFile]) -> SlicedModelFile:
+	"""
+	Returns the cached SlicedModelFile for path, or calls read and caches
+	its result. Just calls read if no cache has been set up, e.g. in the
+	sla_analysis CLI command.
+	"""
+	if _model_cache is None:
+		return read()
+	return _model_cache.get_or_read(path, read)
+
+
+_preview_cache = None
+
+def init_preview_cache(folder, max_size):
+	"""
+	Sets up the preview cache filled by the analysis queue and served by the
+	plugin's preview endpoint.
+	"""
+	global _preview_cache
+	_preview_cache = PreviewCache(folder, max_size)
+	return _preview_cache
+
+def preview_cache() -> Optional[PreviewCache]:
+	return _preview_cache
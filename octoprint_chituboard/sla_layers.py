@@ -0,0 +1,133 @@
+# coding=utf-8
+
+import collections
+import io
+import pathlib
+import threading
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from .file_formats.utils import get_file_format
+from .sla_cache import file_key
+
+if TYPE_CHECKING:
+	import numpy as np
+
+IMAGE_FORMATS = ("png", "webp")
+# width of rendered layers if the client does not ask for one
+DEFAULT_MAX_WIDTH = 800
+
+
+def downscale(image: "np.ndarray", max_width: int) -> "np.ndarray":
+	"""
+	Shrinks a ``height x width`` uint8 layer by the smallest integer factor
+	that makes it at most max_width wide. Every output pixel is the mean of
+	a factor x factor block, the image is padded with black to whole blocks.
+	"""
+	import numpy as np
+	height, width = image.shape
+	factor = -(-width // max(max_width, 1))
+	if factor <= 1:
+		return image
+	rows = -(-height // factor)
+	cols = -(-width // factor)
+	padded = np.zeros((rows * factor, cols * factor), dtype=np.uint8)
+	padded[:height, :width] = image
+	sums = padded.reshape(rows, factor, cols, factor).sum(axis=(1, 3), dtype=np.uint32)
+	return ((sums + (factor * factor) // 2) // (factor * factor)).astype(np.uint8)
+
+def webp_supported() -> bool:
+	try:
+		import PIL.Image
+	except ImportError:
+		return False
+	return True
+
+def encode_image(image: "np.ndarray", image_format: str) -> bytes:
+	"""
+	Encodes a greyscale uint8 array as PNG, or as lossless WebP if Pillow
+	is installed.
+	"""
+	buffer = io.BytesIO()
+	if image_format == "webp":
+		import PIL.Image
+		PIL.Image.fromarray(image, "L").save(buffer, "WEBP", lossless=True)
+	else:
+		import png
+		png.from_array(image, "L").write(buffer)
+	return buffer.getvalue()
+
+def render_layer(path, layer: int, max_width: int, image_format: str) -> bytes:
+	"""
+	Decodes the 0 based layer of the sliced file at path and returns it
+	downscaled to max_width and encoded. Raises IndexError for layers the
+	file does not have.
+	"""
+	with get_file_format(path).open_layers(pathlib.Path(path)) as layers:
+		image = layers.decode_layer(layer)
+	return encode_image(downscale(image, max_width), image_format)
+
+
+class LayerImageCache():
+	"""
+	In memory LRU cache of rendered layer images, so browsers watching the
+	same print share one decode per layer. Keys are the file_key of the
+	sliced file plus the render parameters, concurrent requests for the
+	same key wait for the first render instead of starting their own.
+	"""
+
+	def __init__(self, max_entries):
+		self._max_entries = max_entries
+		self._entries = collections.OrderedDict()
+		self._pending = {}
+		self._lock = threading.Lock()
+
+	def get_or_render(self, path, layer: int, max_width: int, image_format: str) -> Optional[Tuple[str, bytes]]:
+		"""
+		Returns an ETag and the encoded image of the 0 based layer of path,
+		None if the file does not exist.
+		"""
+		source_key = file_key(path)
+		if source_key is None:
+			return None
+		key = (source_key, layer, max_width, image_format)
+		while True:
+			with self._lock:
+				entry = self._entries.get(key)
+				if entry is not None:
+					self._entries.move_to_end(key)
+					return entry
+				pending = self._pending.get(key)
+				if pending is None:
+					pending = self._pending[key] = threading.Event()
+					break
+			# another request renders this layer, use its result or retry if it failed
+			pending.wait()
+
+		entry = None
+		try:
+			data = render_layer(path, layer, max_width, image_format)
+			entry = ("{}-{}-{}.{}".format(source_key, layer, max_width, image_format), data)
+			return entry
+		finally:
+			with self._lock:
+				if entry is not None:
+					self._entries[key] = entry
+					while len(self._entries) > self._max_entries:
+						self._entries.popitem(last=False)
+				del self._pending[key]
+			pending.set()
+
+
+_layer_image_cache = None
+
+def init_layer_image_cache(max_entries):
+	"""
+	Sets up the cache of the plugin's layer image endpoint, called by the
+	plugin once its settings are known.
+	"""
+	global _layer_image_cache
+	_layer_image_cache = LayerImageCache(max_entries)
+	return _layer_image_cache
+
+def layer_image_cache() -> Optional[LayerImageCache]:
+	return _layer_image_cache
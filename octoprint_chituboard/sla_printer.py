@@ -2,6 +2,8 @@
 
 import os, sys, glob
 import re
+import threading
+import time
 
 from octoprint.events import Events, eventManager
 from octoprint.filemanager import FileDestinations, NoSuchStorage, valid_file_type, full_extension_tree
@@ -28,6 +30,12 @@ from pathlib import Path
 import quopri
 import logging
 from .file_formats.utils import get_file_format	
+from .sla_cache import cached_read
+
+# seconds to wait for OctoPrint to close the serial port before an SD upload
+PORT_RELEASE_TIMEOUT = 10
+# and to reconnect after it
+RECONNECT_TIMEOUT = 30
 
 #################################################################################################
 #                                   Sla printer class                                           #
@@ -42,6 +50,8 @@ class Sla_printer(Printer):
 		self._fileManager = fileManager
 		self._printerProfileManager = printerProfileManager
 		self._sliced_model_file = None
+		# where the selected file is stored in OctoPrint's file system
+		self._sliced_model_path = None
 
 		self.fileType = None
 		self._logger.info("init Sla_printer object for global printer object")
@@ -68,32 +78,27 @@ class Sla_printer(Printer):
 		if sd:
 			path_on_disk = "/" + path
 			path_in_storage = path
-			file_format = get_file_format("/home/pi/.octoprint/uploads/resin"+path_on_disk)
-			sliced_model_file = file_format.read(Path("/home/pi/.octoprint/uploads/resin"+path_on_disk))
+			file_path = "/home/pi/.octoprint/uploads/resin"+path_on_disk
+			file_format = get_file_format(file_path)
+			sliced_model_file = cached_read(file_path, lambda: file_format.read(Path(file_path)))
+			sliced_model_path = file_path
 			printTime = sliced_model_file.print_time_secs
 			self._logger.debug("print time: ", printTime)
 			
 		else:
 			path_on_disk = self._fileManager.path_on_disk(origin, path)
-			file_format = get_file_format(path_on_disk)
-			try:
-				fileData = self._fileManager.get_metadata(
-						origin,
-						path_on_disk,
-					)
-				
-				sliced_model_file = file_format.read_dict(Path(path_on_disk),fileData["analysis"])
-				self._logger.info("Metadata %s" % str(fileData))
-			except Exception as inst:
-				self._logger.debug("yaml load output failed, analysis type:", inst)
-				sliced_model_file = file_format.read(Path(path_on_disk))	
+			sliced_model_file = cached_read(
+				path_on_disk,
+				lambda: self._read_local_model_file(origin, path_on_disk))
 
+			sliced_model_path = path_on_disk
 			printTime = sliced_model_file.print_time_secs
 			self._logger.info("print time: ", printTime)
 			self._logger.info("Path: %s" % path_on_disk)
 			path_in_storage = self._fileManager.path_in_storage(origin, path_on_disk)
 			path_on_disk = os.path.split(self._fileManager.path_on_disk(origin, path))[-1]
 		self._sliced_model_file = sliced_model_file
+		self._sliced_model_path = sliced_model_path
 		self._logger.debug("Path: %s" % path_on_disk)
 		self._logger.debug("Path filename: %s" % os.path.split(path_on_disk)[-1])
 		self._logger.debug("Printer state str: ", self._comm.getStateString())
@@ -112,11 +117,31 @@ class Sla_printer(Printer):
 		self._updateProgressData()
 		self._setCurrentZ(None)
 		
+	def _read_local_model_file(self, origin, path_on_disk):
+		"""
+		Parse a local file, taking the values the analysis already
+		determined from its metadata if possible
+		"""
+		file_format = get_file_format(path_on_disk)
+		try:
+			fileData = self._fileManager.get_metadata(
+					origin,
+					path_on_disk,
+				)
+			
+			sliced_model_file = file_format.read_dict(Path(path_on_disk),fileData["analysis"])
+			self._logger.info("Metadata %s" % str(fileData))
+		except Exception as inst:
+			self._logger.debug("yaml load output failed, analysis type:", inst)
+			sliced_model_file = file_format.read(Path(path_on_disk))	
+		return sliced_model_file
+
 	def unselect_file(self, *args, **kwargs):
 		if self._comm is not None and (self._comm.isBusy() or self._comm.isStreaming()):
 			return
 			
 		self._sliced_model_file = None
+		self._sliced_model_path = None
 		self._comm.unselectFile()
 		self._updateProgressData()
 		self._setCurrentZ(None)
@@ -364,21 +389,80 @@ class Sla_printer(Printer):
 		
 	def add_sd_file(self, filename, path, on_success=None, on_failure=None, *args, **kwargs):
 		"""
-		Todo: add method to properly upload SD files using the UART port.
-		Basic outline of sd upload procedure in 
-		https://www.improwis.com/projects/sw_PhotonControl/
-		https://docs.google.com/document/d/14UBMO0Vhh9Lr0V3xcdetQ2_4UDnjFnho7OnbNxLOs3o/view#
-		and photonsters github
+		Streams a file to the printer's SD card. G-code goes through
+		OctoPrint's own upload, sliced files are sent in binary chunks by
+		sla_transfer.ChituUploader. OctoPrint can't share the serial port
+		with it, so the printer is disconnected for the transfer and
+		reconnected afterwards.
 		"""
 		self.fileType = self.get_fileType(path)
 
 		if self.fileType == "gcode": 
-			ret = Printer.add_sd_file(self, filename, path, on_success, on_failure, *args, **kwargs)
+			return Printer.add_sd_file(self, filename, path, on_success, on_failure, *args, **kwargs)
 		elif self.fileType == "sla_bin":
-			if on_success:
-				on_success()
-			print("SLA file upload completed")
-			
+			if self._comm is None or self._comm.isBusy():
+				self._logger.error("No connection to printer or printer is busy")
+				return None
+			remote = os.path.basename(filename)
+			port, baudrate = self._comm.getConnection()[:2]
+			profile = self._printerProfileManager.get_current_or_default()["id"]
+			thread = threading.Thread(
+				target=self._upload_sla_file,
+				args=(filename, path, remote, port, baudrate, profile, on_success, on_failure),
+				name="sla_sd_upload")
+			thread.daemon = True
+			self.disconnect()
+			thread.start()
+			return remote
+
+	def _upload_sla_file(self, local, path, remote, port, baudrate, profile, on_success, on_failure):
+		import serial
+		from .sla_transfer import ACK_TIMEOUT, ChituUploader, TransferError
+
+		def progress(offset, size):
+			eventManager().fire(Events.PLUGIN_CHITUBOARD_TRANSFER_PROGRESS,
+				{"local": local, "remote": remote, "offset": offset, "size": size})
+
+		eventManager().fire(Events.TRANSFER_STARTED, {"local": local, "remote": remote})
+		start = monotonic_time()
+		success = False
+		try:
+			if not self._wait_for(lambda: self._comm is None, PORT_RELEASE_TIMEOUT):
+				raise TransferError("OctoPrint did not release {}".format(port))
+			with serial.Serial(port, baudrate, timeout=ACK_TIMEOUT) as serial_port:
+				uploader = ChituUploader(serial_port, progress=progress)
+				uploader.upload(path, remote)
+			success = True
+			self._logger.info("Uploaded {} to the SD card in {:.1f}s, {} resends, {} timeouts".format(
+				remote, monotonic_time() - start, uploader.resends, uploader.timeouts))
+		except (TransferError, OSError) as e:
+			self._logger.error("Upload of {} to the SD card failed at offset {}: {}".format(
+				remote, getattr(e, "acknowledged", 0), e))
+		except Exception:
+			self._logger.exception("Error uploading {} to the SD card".format(remote))
+		finally:
+			self.connect(port=port, baudrate=baudrate, profile=profile)
+
+		# the callbacks may select or print the file, so wait for the printer
+		self._wait_for(lambda: self._comm is not None and self._comm.isOperational(), RECONNECT_TIMEOUT)
+		payload = {"local": local, "remote": remote, "time": monotonic_time() - start}
+		if success:
+			eventManager().fire(Events.TRANSFER_DONE, payload)
+			if callable(on_success):
+				on_success(remote, remote, FileDestinations.SDCARD)
+		else:
+			eventManager().fire(Events.TRANSFER_FAILED, payload)
+			if callable(on_failure):
+				on_failure(remote, remote, FileDestinations.SDCARD)
+
+	def _wait_for(self, condition, timeout):
+		deadline = monotonic_time() + timeout
+		while not condition():
+			if monotonic_time() > deadline:
+				return False
+			time.sleep(0.1)
+		return True
+
 	def commands(self, commands, 
 		cmd_type=None, 
 		part_of_job=False, 
@@ -411,21 +495,25 @@ class Sla_printer(Printer):
 		return None
 	
 	def get_current_layer(self):
+		layer_progress = self.get_current_layer_progress()
+		if layer_progress is None:
+			return "-"
+		return layer_progress[0]
+
+	def get_current_layer_progress(self):
+		"""
+		Returns (layer, fraction) for the reported file position, the 1 based
+		layer being printed and how much of its image has been read, or None
+		if no position or sliced file is known.
+		"""
 		filepos = self.get_file_position()
-		current_layer = "-"
-		if filepos and self._sliced_model_file:
-			filepos = filepos["pos"]
-			if filepos == 0:
-				current_layer = 1
-			else:
-				try:
-					current_layer = (
-						self._sliced_model_file.end_byte_offset_by_layer.index(filepos) + 1
-					)
-				except (ValueError, AttributeError):
-					# If filepos not found in list or attribute doesn't exist
-					current_layer = "-"
-		return current_layer
+		if not filepos or not self._sliced_model_file:
+			return None
+		try:
+			return self._sliced_model_file.locate_layer(filepos["pos"])
+		except (ValueError, AttributeError):
+			# no layers or no layer offsets for this file
+			return None
 
 	def split_path(self, path):
 		path = to_unicode(path)
@@ -0,0 +1,220 @@
+# coding=utf-8
+
+import collections
+import logging
+import os
+import re
+import time
+from typing import Callable, Optional
+
+from .chitu_comm import TRAILER, pack_chunk
+
+# chunks sent before the first one has to be acknowledged
+DEFAULT_WINDOW = 4
+# the chunk size stays between these, Chitu boards take at most 0x500 bytes
+MIN_CHUNK_SIZE = 256
+MAX_CHUNK_SIZE = 1280
+# ack latency the chunk size is adapted to, short enough that a resend
+# costs little, long enough that the per chunk overhead does not matter
+TARGET_ACK_LATENCY = 0.5
+# weight of the latest ack in the latency average
+LATENCY_SMOOTHING = 0.25
+# seconds without ack until the outstanding chunks count as lost
+ACK_TIMEOUT = 5.0
+# resends and timeouts in a row before the transfer is given up
+MAX_RETRIES = 8
+# seconds between progress callbacks
+PROGRESS_INTERVAL = 1.0
+# start, 8 data and stop bit
+BITS_PER_BYTE = 10
+# added to the quiet time after which no reply is expected any more
+QUIET_MARGIN = 0.1
+
+REGEX_RESEND = re.compile(r"resend\s*:?\s*(?P<offset>\d+)", re.IGNORECASE)
+
+
+class TransferError(Exception):
+	"""Transfer failed, acknowledged is how much of the file the printer has."""
+
+	def __init__(self, message, acknowledged=0):
+		super().__init__(message)
+		self.acknowledged = acknowledged
+
+
+class ChituUploader():
+	"""
+	Sends a file to the SD card of a Chitu board over its serial port,
+	framed like Chitubox does over the network: M28 <name>, data packets
+	ending with their file offset, checksum and 0x83, then M29.
+
+	Up to window packets are sent before the oldest one has to be
+	acknowledged, the board answers every packet in order with "ok" or
+	"resend <offset>". The chunk size follows the measured ack latency,
+	errors halve it. After a resend or a timeout the upload continues from
+	the last acknowledged offset, the replies still due for the packets
+	sent before are skipped. M29 is only sent once the line is quiet, so
+	its reply can't be mistaken for one of theirs.
+
+	port is a pyserial like object with write, readline, a timeout and
+	baudrate attribute, e.g. serial.Serial.
+	"""
+
+	def __init__(
+		self,
+		port,
+		window: int = DEFAULT_WINDOW,
+		chunk_size: int = MAX_CHUNK_SIZE,
+		ack_timeout: float = ACK_TIMEOUT,
+		max_retries: int = MAX_RETRIES,
+		progress: Optional[Callable[[int, int], None]] = None,
+	):
+		self._logger = logging.getLogger(__name__)
+		self._port = port
+		self.window = max(window, 1)
+		self.chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+		self._ack_timeout = ack_timeout
+		self._max_retries = max_retries
+		self._progress = progress
+		self._last_progress = 0.0
+
+		self.latency = None
+		self.resends = 0
+		self.timeouts = 0
+
+	def upload(self, path, remote: str):
+		"""Sends the file at path as remote, raises TransferError if the printer does not take it."""
+		size = os.path.getsize(path)
+		self._port.timeout = self._ack_timeout
+		self._command("M28 {}".format(remote))
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			acknowledged = 0
+			retries = 0
+			while True:
+				acknowledged = self._send(fd, size, acknowledged)
+				self._drain()
+				reply = self._command("M29")
+				match = REGEX_RESEND.search(reply)
+				if match is None:
+					break
+				# the board missed data the acks said it had
+				acknowledged = int(match.group("offset"))
+				retries += 1
+				if retries > self._max_retries:
+					raise TransferError("Printer keeps asking for offset {}".format(acknowledged), acknowledged)
+		finally:
+			os.close(fd)
+		self._report(size, size, force=True)
+
+	def _send(self, fd, size: int, acknowledged: int) -> int:
+		"""Sends size bytes of fd from acknowledged on, returns once all are acknowledged."""
+		# (end offset, time sent, rewind count) of the packets awaiting a reply
+		outstanding = collections.deque()
+		offset = acknowledged
+		rewinds = 0
+		retries = 0
+
+		# past the end, also wait for the replies to stale packets, so none is
+		# taken for the reply to M29
+		while acknowledged < size or outstanding:
+			while offset < size and len(outstanding) < self.window:
+				data = os.pread(fd, self.chunk_size, offset)
+				self._port.write(pack_chunk(offset, data))
+				outstanding.append((offset + len(data), time.monotonic(), rewinds))
+				offset += len(data)
+
+			line = self._port.readline().decode("latin-1").strip()
+			if not line:
+				if time.monotonic() - outstanding[0][1] < self._ack_timeout:
+					continue
+				# the packet or its reply got lost, the board may still be
+				# working through the packets after it
+				rewinds += 1
+				self._drain()
+				# nothing is on its way any more, the rest of the replies got lost
+				outstanding.clear()
+				if acknowledged >= size:
+					break
+				self.timeouts += 1
+				self._logger.warning("No ack for the chunk at offset {}, resending".format(acknowledged))
+				offset = acknowledged
+				retries = self._retry(retries, acknowledged)
+				continue
+
+			match = REGEX_RESEND.search(line)
+			if not line.startswith("ok") and match is None:
+				self._logger.debug("Ignoring {!r} during upload".format(line))
+				continue
+			end, sent, rewind = outstanding.popleft()
+			if rewind != rewinds:
+				# reply to a packet sent before the last rewind
+				continue
+
+			if match is None:
+				acknowledged = end
+				retries = 0
+				self._adapt(time.monotonic() - sent)
+				self._report(acknowledged, size)
+			else:
+				self.resends += 1
+				acknowledged = offset = int(match.group("offset"))
+				self._logger.debug("Printer asks for offset {}".format(acknowledged))
+				rewinds += 1
+				retries = self._retry(retries, acknowledged)
+		return acknowledged
+
+	def _retry(self, retries: int, acknowledged: int) -> int:
+		retries += 1
+		if retries > self._max_retries:
+			raise TransferError("Giving up after {} errors in a row".format(retries), acknowledged)
+		self.chunk_size = max(self.chunk_size // 2, MIN_CHUNK_SIZE)
+		return retries
+
+	def _adapt(self, latency: float):
+		"""Scales the chunk size towards TARGET_ACK_LATENCY, at most doubling or halving it per ack."""
+		if self.latency is None:
+			self.latency = latency
+		else:
+			self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+		factor = min(max(TARGET_ACK_LATENCY / max(self.latency, 1e-6), 0.5), 2.0)
+		self.chunk_size = int(min(max(self.chunk_size * factor, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE))
+
+	def _report(self, acknowledged: int, size: int, force=False):
+		if self._progress is None:
+			return
+		now = time.monotonic()
+		if force or now - self._last_progress >= PROGRESS_INTERVAL:
+			self._last_progress = now
+			self._progress(acknowledged, size)
+
+	def _quiet_secs(self) -> float:
+		"""
+		Seconds without a reply after which none is on its way any more: the
+		board answers its queued packets one by one, at most one packet's
+		transmission time or one ack latency apart.
+		"""
+		baudrate = getattr(self._port, "baudrate", None)
+		packet_secs = (MAX_CHUNK_SIZE + TRAILER.size) * BITS_PER_BYTE / baudrate if baudrate else 0.0
+		return max(packet_secs, self.latency or 0.0) + QUIET_MARGIN
+
+	def _drain(self):
+		"""Drops replies until the line is quiet, so the next one belongs to what is sent next."""
+		timeout = self._port.timeout
+		self._port.timeout = self._quiet_secs()
+		try:
+			while self._port.readline():
+				pass
+		finally:
+			self._port.timeout = timeout
+
+	def _command(self, command: str) -> str:
+		"""Sends a command and returns the printer's reply, raises TransferError for errors and timeouts."""
+		self._port.write((command + "\n").encode("latin-1"))
+		deadline = time.monotonic() + self._ack_timeout
+		while time.monotonic() < deadline:
+			line = self._port.readline().decode("latin-1").strip()
+			if line.startswith("ok") or REGEX_RESEND.search(line):
+				return line
+			if line.lower().startswith("error"):
+				raise TransferError("Printer rejected {}: {}".format(command.split()[0], line))
+		raise TransferError("No reply to {}".format(command.split()[0]))
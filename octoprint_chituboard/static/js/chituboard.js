@@ -21,6 +21,7 @@ $(function() {
                 var text = gettext("Layer");
                 var tooltip = gettext("Might be inaccurate!");
                 element.before(text + ": <strong title='" + tooltip + "' data-bind='text: layerString'></strong><br>");
+                element.after("<img id='chituboard_layer_image' style='display: none; max-width: 100%; background: black'>");
             }
             self.retrieveData();
         };
@@ -31,6 +32,7 @@ $(function() {
                 .done(function(data) {
                     if (data && data.layerString) {
                         self.layerString(data.layerString);
+                        self.updateLayerImage(data.layerString);
                     }
                 })
                 .fail(function() {
@@ -48,9 +50,28 @@ $(function() {
             if (plugin === "chituboard") {
                 if (data && data.layerString) {
                     self.layerString(data.layerString);
+                    self.updateLayerImage(data.layerString);
                 }
             }
         };
+
+        // Image of the layer being printed, if layerImgDisplay is enabled
+        self.updateLayerImage = function (layerString) {
+            var image = $("#chituboard_layer_image");
+            var settings = self.settingsViewModel.settings;
+            var layer = parseInt(layerString, 10);
+            if (!image.length || !settings || !settings.plugins.chituboard.layerImgDisplay() || isNaN(layer)) {
+                image.hide();
+                return;
+            }
+
+            // requested by number, so the URL only changes with the layer
+            var url = OctoPrint.getBlueprintUrl("chituboard") + "layer/" + layer + "?max_width=400";
+            if (image.attr("src") !== url) {
+                image.attr("src", url);
+            }
+            image.show();
+        };
         
         // Enhanced file information display for SLA files
         self.filesViewModel.enableAdditionalData = function (data) {
@@ -69,6 +90,12 @@ $(function() {
             });
         };
 
+        // Preview PNG of a stored file, served from the plugin's preview cache
+        self.getPreviewUrl = function (data) {
+            var path = _.map(data["path"].split("/"), encodeURIComponent).join("/");
+            return OctoPrint.getBlueprintUrl("chituboard") + "preview/" + data["origin"] + "/" + path;
+        };
+
         self.filesViewModel.getAdditionalData = function (data) {
             var output = "";
             
@@ -105,6 +132,11 @@ $(function() {
                 
             } else if (data["analysis"]) {
                 // SLA file analysis
+                if (data["origin"] === "local") {
+                    output += "<img class='chituboard-preview' loading='lazy' style='max-width: 100%' src='" +
+                        _.escape(self.getPreviewUrl(data)) + "'><br>";
+                }
+
                 if (data["analysis"]["dimensions"]) {
                     var dimensions = data["analysis"]["dimensions"];
                     output += gettext("Model size") + ": " +
@@ -0,0 +1,305 @@
+# coding=utf-8
+
+import logging
+import os
+import pathlib
+import queue
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, List, Optional
+
+from .file_formats.utils import UnsupportedFileFormat, get_file_format
+from .sla_cache import cached_read
+
+if TYPE_CHECKING:
+	import numpy as np
+
+	from .file_formats import SlicedModelFile
+
+# port name OctoPrint connects to for the virtual board
+VIRTUAL_PORT = "VIRTUAL_CHITU"
+
+FIRMWARE_VERSION = "V4.13.3_LCDC"
+FIRMWARE_BANNER = "CBD make it.Date:Mar 20 2020 Time:14:28:59"
+# Z of the build plate when idle
+PARKED_Z_MM = 155.0
+# M27 polls answered with the full file size after a print, before the
+# board reports that it is not printing
+FINISHED_REPORTS = 2
+
+REGEX_LINE_NUMBER = re.compile(r"^N\d+\s+")
+REGEX_CHECKSUM = re.compile(r"\*\d+$")
+
+
+class VirtualPrint():
+	"""
+	Print of a sliced file on the virtual board. The print time runs speed
+	times faster than the wall clock and stands still while paused, the
+	file position follows the layers' durations from the layer table.
+	"""
+
+	def __init__(self, name: str, path: str, model: "SlicedModelFile", speed: float):
+		import numpy as np
+		self.name = name
+		self.size = os.path.getsize(path)
+		self._speed = speed
+		self._ends: "np.ndarray" = model.layer_table.end_offsets
+		self._z: "np.ndarray" = model.layer_table.position_z_mm
+		self._durations: "np.ndarray" = model.layer_table.durations_secs()
+		self._done_at: "np.ndarray" = np.cumsum(self._durations)
+		self._elapsed = 0.0
+		self._resumed_at: Optional[float] = time.monotonic()
+
+	@property
+	def paused(self) -> bool:
+		return self._resumed_at is None
+
+	def pause(self):
+		if self._resumed_at is not None:
+			self._elapsed = self.elapsed()
+			self._resumed_at = None
+
+	def resume(self):
+		if self._resumed_at is None:
+			self._resumed_at = time.monotonic()
+
+	def elapsed(self) -> float:
+		"""Simulated seconds printed so far."""
+		if self._resumed_at is None:
+			return self._elapsed
+		return self._elapsed + (time.monotonic() - self._resumed_at) * self._speed
+
+	def layer(self):
+		"""(0 based layer, fraction of it printed), None once all layers are done."""
+		import numpy as np
+		elapsed = self.elapsed()
+		layer = int(np.searchsorted(self._done_at, elapsed, side="right"))
+		if layer >= len(self._done_at):
+			return None
+		start = self._done_at[layer] - self._durations[layer]
+		fraction = (elapsed - start) / self._durations[layer] if self._durations[layer] > 0 else 1.0
+		return layer, min(max(float(fraction), 0.0), 1.0)
+
+	def position(self) -> int:
+		"""Byte of the file the board has read up to, within the image of the layer being printed."""
+		layer = self.layer()
+		if layer is None:
+			return self.size
+		layer, fraction = layer
+		start = int(self._ends[layer - 1]) if layer > 0 else 0
+		return start + int(fraction * (int(self._ends[layer]) - start))
+
+	def z_mm(self) -> float:
+		layer = self.layer()
+		if layer is None:
+			return float(self._z[-1]) if len(self._z) else 0.0
+		return float(self._z[layer[0]])
+
+
+class VirtualChituBoard():
+	"""
+	Serial port of a simulated Chitu mainboard, in the spirit of OctoPrint's
+	virtual printer, answering in the dialect the plugin's hooks rewrite:
+
+		M4002  ok V4.13.3_LCDC CBD make it.Date:...
+		M115   ok CBD make it.Date:...
+		M4000  ok B:25/0 X:0.000 Y:0.000 Z:0.050 F:256/256 D:35814/2405219/0 T:0
+		M114   ok C: X:0.000000 Y:0.000000 Z:0.050000 E:0.000000
+		M27    SD printing byte 35814/2405219, or Error:It's not printing now!
+
+	M6030 ':name' (or M23 and M24) prints a sliced file from folder, M25
+	and M24 pause and resume it and M33 stops it. The reported file
+	position advances through the layer images at speed times the
+	duration the layer table gives, so a print of hours takes seconds.
+	"""
+
+	def __init__(self, folder, speed: float = 1.0, read_timeout: float = 5.0, baudrate: int = 115200):
+		self._logger = logging.getLogger(__name__)
+		self._folder = folder
+		self._speed = speed
+		self._read_timeout = read_timeout
+		self._write_timeout = 10.0
+		self._baudrate = baudrate
+		self._output = queue.Queue()
+		self._lock = threading.RLock()
+		self._selected = None
+		self._print: Optional[VirtualPrint] = None
+		self._finished_reports = 0
+		self._closed = False
+
+		self._commands = {
+			"M4002": self._hello,
+			"M115": self._firmware_info,
+			"M4000": self._status,
+			"M114": self._position,
+			"M27": self._sd_status,
+			"M20": self._list_files,
+			"M23": self._select,
+			"M6030": self._start_print,
+			"M24": self._resume,
+			"M25": self._pause,
+			"M33": self._stop,
+		}
+
+	@property
+	def port(self):
+		return VIRTUAL_PORT
+
+	@property
+	def baudrate(self):
+		return self._baudrate
+
+	@property
+	def timeout(self):
+		return self._read_timeout
+
+	@timeout.setter
+	def timeout(self, value):
+		self._read_timeout = value
+
+	@property
+	def write_timeout(self):
+		return self._write_timeout
+
+	@write_timeout.setter
+	def write_timeout(self, value):
+		self._write_timeout = value
+
+	def write(self, data: bytes) -> int:
+		if self._closed:
+			raise OSError("Virtual Chitu board is closed")
+		for line in data.decode("latin-1").splitlines():
+			self._handle(line)
+		return len(data)
+
+	def readline(self) -> bytes:
+		try:
+			return self._output.get(timeout=self._read_timeout)
+		except queue.Empty:
+			return b""
+
+	def close(self):
+		self._closed = True
+
+	def _send(self, *lines: str):
+		for line in lines:
+			self._output.put((line + "\n").encode("latin-1"))
+
+	def _handle(self, line: str):
+		line = REGEX_CHECKSUM.sub("", REGEX_LINE_NUMBER.sub("", line.strip())).strip()
+		if not line:
+			return
+		command, _, args = line.partition(" ")
+		handler = self._commands.get(command.upper())
+		with self._lock:
+			if handler is None:
+				self._send("ok")
+			else:
+				handler(args.strip())
+
+	def _update(self):
+		"""Ends the print once all its layers are printed."""
+		if self._print is not None and self._print.layer() is None:
+			self._logger.debug("Virtual print of {} done".format(self._print.name))
+			self._print = None
+			self._finished_reports = FINISHED_REPORTS
+
+	def _find(self, name: str) -> Optional[str]:
+		"""Path of name in folder, or of the first file of its base name in a subfolder."""
+		name = name.strip().strip("'\"").lstrip(":/")
+		path = os.path.join(self._folder, name)
+		if os.path.isfile(path):
+			return path
+		base = os.path.basename(name)
+		for root, _, files in os.walk(self._folder):
+			if base in files:
+				return os.path.join(root, base)
+		return None
+
+	def _hello(self, args):
+		# version and identifier come on one line like from the real board
+		self._send("ok {} {}".format(FIRMWARE_VERSION, FIRMWARE_BANNER))
+
+	def _firmware_info(self, args):
+		self._send("ok {}".format(FIRMWARE_BANNER))
+
+	def _status(self, args):
+		self._update()
+		if self._print is None:
+			self._send("ok B:25/0 X:0.000 Y:0.000 Z:{:.3f} F:256/256 D:0/0/0 T:0".format(PARKED_Z_MM))
+			return
+		self._send("ok B:25/0 X:0.000 Y:0.000 Z:{:.3f} F:256/256 D:{}/{}/{} T:{}".format(
+			self._print.z_mm(), self._print.position(), self._print.size, int(self._print.paused),
+			int(self._print.elapsed())))
+
+	def _position(self, args):
+		self._update()
+		z = self._print.z_mm() if self._print is not None else PARKED_Z_MM
+		self._send("ok C: X:0.000000 Y:0.000000 Z:{:.6f} E:0.000000".format(z))
+
+	def _sd_status(self, args):
+		self._update()
+		if self._print is not None:
+			self._send("SD printing byte {}/{}".format(self._print.position(), self._print.size), "ok")
+		elif self._finished_reports and self._selected is not None:
+			self._finished_reports -= 1
+			size = os.path.getsize(self._selected)
+			self._send("SD printing byte {}/{}".format(size, size), "ok")
+		else:
+			self._send("Error:It's not printing now!", "ok")
+
+	def _list_files(self, args):
+		lines: List[str] = ["Begin file list"]
+		for name in sorted(os.listdir(self._folder)):
+			path = os.path.join(self._folder, name)
+			if os.path.isfile(path):
+				lines.append("{} {}".format(name, os.path.getsize(path)))
+		lines += ["End file list", "ok"]
+		self._send(*lines)
+
+	def _select(self, args):
+		path = self._find(args)
+		if path is None:
+			self._send("open failed, File: {}.".format(args), "ok")
+			return
+		self._selected = path
+		self._send("File opened: {} Size: {}".format(os.path.basename(path), os.path.getsize(path)),
+			"File selected", "ok")
+
+	def _start_print(self, args):
+		path = self._find(args.split("'")[1] if "'" in args else args.split()[0]) if args else self._selected
+		if path is None or not self._begin(path):
+			self._send("open failed, File: {}.".format(args), "ok")
+			return
+		self._send("ok N:0")
+
+	def _begin(self, path) -> bool:
+		try:
+			file_format = get_file_format(path)
+			model = cached_read(path, lambda: file_format.read(pathlib.Path(path)))
+		except (UnsupportedFileFormat, OSError):
+			self._logger.exception("Virtual board can't print {}".format(path))
+			return False
+		self._selected = path
+		self._print = VirtualPrint(os.path.basename(path), path, model, self._speed)
+		self._finished_reports = 0
+		self._logger.debug("Virtual print of {} started, {} layers".format(path, len(model.layer_table)))
+		return True
+
+	def _resume(self, args):
+		if self._print is not None:
+			self._print.resume()
+		elif self._selected is not None and not self._finished_reports:
+			self._begin(self._selected)
+		self._send("ok")
+
+	def _pause(self, args):
+		if self._print is not None:
+			self._print.pause()
+		self._send("ok")
+
+	def _stop(self, args):
+		self._print = None
+		self._finished_reports = 0
+		self._send("ok")
@@ -59,7 +59,7 @@ plugin_ignored_packages = []
 # Example:
 #     plugin_requires = ["someDependency==dev"]
 #     additional_setup_parameters = {"dependency_links": ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
-additional_setup_parameters = {"python_requires": ">=3.7,<4"}
+additional_setup_parameters = {"python_requires": ">=3.9,<4"}
 
 ########################################################################################################################
 